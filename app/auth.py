@@ -3,25 +3,83 @@ from fastapi.security import OAuth2PasswordBearer
 from jose import JWTError, jwt
 from passlib.context import CryptContext
 from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import os
 from .models import TokenData, User, UserInDB
-from .database import get_db
+from .database import get_db, mongo_budget
+from .cache import TTLCache
+from .indexes import register_index, register_query
 
 SECRET_KEY = "your-secret-key"
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 30
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+# Hashes below BCRYPT_ROUNDS are upgraded on the next successful login
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", "12"))
+pwd_context = CryptContext(
+    schemes=["bcrypt"], deprecated="auto",
+    bcrypt__default_rounds=BCRYPT_ROUNDS, bcrypt__min_rounds=BCRYPT_ROUNDS
+)
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="jwt/login")
 
-def verify_password(plain_password, hashed_password):
-    return pwd_context.verify(plain_password, hashed_password)
+# Registration looks users up by each of these, and they must stay unique
+for field in ("email", "username", "mobile"):
+    register_index("users", [(field, 1)], unique=True)
+    register_query("users", {field: "sample"})
 
-def get_password_hash(password):
-    return pwd_context.hash(password)
+# bcrypt is CPU-bound, so it runs on a small dedicated pool instead of the event loop.
+# Beyond PASSWORD_HASH_QUEUE_LIMIT pending operations requests are shed with a 503.
+PASSWORD_HASH_WORKERS = int(os.getenv("PASSWORD_HASH_WORKERS", "2"))
+PASSWORD_HASH_QUEUE_LIMIT = int(os.getenv("PASSWORD_HASH_QUEUE_LIMIT", "32"))
+password_pool = ThreadPoolExecutor(max_workers=PASSWORD_HASH_WORKERS, thread_name_prefix="bcrypt")
+pending_password_operations = 0
 
-def get_user(email: str):
-    db = get_db()
-    user_dict = db.users.find_one({"email": email})
+async def run_password_operation(func, *args):
+    global pending_password_operations
+    if pending_password_operations >= PASSWORD_HASH_QUEUE_LIMIT:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Too many password operations in progress, please retry shortly",
+            headers={"Retry-After": "1"},
+        )
+    pending_password_operations += 1
+    try:
+        return await asyncio.get_running_loop().run_in_executor(password_pool, func, *args)
+    finally:
+        pending_password_operations -= 1
+
+async def verify_password(plain_password, hashed_password):
+    return await run_password_operation(pwd_context.verify, plain_password, hashed_password)
+
+async def get_password_hash(password):
+    return await run_password_operation(pwd_context.hash, password)
+
+# Verified principals by subject (email), so authenticated requests skip the users lookup.
+# Entries are dropped whenever the user document changes.
+PRINCIPAL_CACHE_SIZE = int(os.getenv("PRINCIPAL_CACHE_SIZE", "10000"))
+PRINCIPAL_CACHE_TTL = float(os.getenv("PRINCIPAL_CACHE_TTL", "60"))
+principal_cache = TTLCache(maxsize=PRINCIPAL_CACHE_SIZE, ttl=PRINCIPAL_CACHE_TTL)
+
+# In stateless mode the user is embedded in the token and trusted until it expires,
+# so changes to the user are only seen by tokens issued afterwards
+AUTH_STATELESS = os.getenv("AUTH_STATELESS", "0") == "1"
+
+def invalidate_principal(email: str):
+    """Call after any change to the user document"""
+    principal_cache.pop(email)
+
+def principal_claims(user: User) -> dict:
+    """Claims for a new access token; includes the user itself in stateless mode"""
+    claims = {"sub": user.email}
+    if AUTH_STATELESS:
+        claims["user"] = User(**user.dict()).dict()
+    return claims
+
+async def get_user(email: str):
+    db = get_db("auth")
+    with mongo_budget("auth"):
+        user_dict = await db.users.find_one({"email": email})
     if user_dict:
         # Convert ObjectId to string
         user_dict['id'] = str(user_dict.pop('_id'))
@@ -31,12 +89,19 @@ def get_user(email: str):
         return UserInDB(**user_dict)
     return None
 
-def authenticate_user(email: str, password: str):
-    user = get_user(email)
+async def authenticate_user(email: str, password: str):
+    user = await get_user(email)
     if not user:
         return False
-    if not verify_password(password, user.hashed_password):
+    verified, new_hash = await run_password_operation(pwd_context.verify_and_update, password, user.hashed_password)
+    if not verified:
         return False
+    if new_hash:
+        # Stored hash uses an outdated scheme or cost factor; replace it while we have the password
+        db = get_db("auth")
+        with mongo_budget("auth"):
+            await db.users.update_one({"email": email}, {"$set": {"hashed_password": new_hash}})
+        user.hashed_password = new_hash
     return user
 
 def create_access_token(data: dict, expires_delta: timedelta | None = None):
@@ -63,7 +128,16 @@ async def get_current_user(token: str = Depends(oauth2_scheme)):
         token_data = TokenData(email=email)
     except JWTError:
         raise credentials_exception
-    user = get_user(email=token_data.email)
-    if user is None:
-        raise credentials_exception
-    return User(**user.dict())
\ No newline at end of file
+
+    # Signed claims are enough in stateless mode
+    if AUTH_STATELESS and "user" in payload:
+        return User(**payload["user"])
+
+    principal = principal_cache.get(token_data.email)
+    if principal is None:
+        user = await get_user(email=token_data.email)
+        if user is None:
+            raise credentials_exception
+        principal = User(**user.dict())
+        principal_cache.set(token_data.email, principal)
+    return principal
\ No newline at end of file
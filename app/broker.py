@@ -0,0 +1,162 @@
+"""
+Cross-worker fan-out of the websocket feeds.
+
+With several uvicorn workers, each worker has its own hubs and subscribers.
+So that every new document is still read from Mongo only once, one worker is
+elected broker by taking an exclusive lock on FEED_BROKER_LOCK. It tails the
+collection of every hub and writes each batch of new documents to all workers
+over the Unix socket FEED_BROKER_SOCKET, as a 4-byte big-endian length followed
+by BSON {"collection": ..., "docs": [...]}. Every worker, the broker's own
+included, reads these frames and dispatches them to its local subscribers.
+
+If the broker dies its lock is released and another worker takes over. Documents
+inserted before the new broker starts tailing are not pushed; clients pick them
+up by reconnecting with their resume cursor. Jobs that must run once per
+deployment (the rollup and date migration followers) run on the broker.
+
+On by default, whatever WORKERS says: under `uvicorn main:app --workers N` or
+several processes started by hand, nothing tells a worker it is not alone, and
+each would otherwise tail Mongo and run the once-per-deployment jobs itself.
+A single process simply elects itself. FEED_BROKER=0 turns it off, for
+deployments that are known to run one process. The default socket and lock
+paths are derived from MONGO_URI and MONGO_DB, so different deployments on one
+host do not share a broker.
+"""
+import asyncio
+import bson
+import fcntl
+import hashlib
+import os
+import struct
+from .hub import Hub, hubs
+
+ENABLED = os.getenv("FEED_BROKER", "1") == "1"
+DEPLOYMENT = hashlib.sha1(f"{os.getenv('MONGO_URI')}/{os.getenv('MONGO_DB')}".encode()).hexdigest()[:12]
+SOCKET_PATH = os.getenv("FEED_BROKER_SOCKET", f"/tmp/tinyteam-feed-{DEPLOYMENT}.sock")
+LOCK_PATH = os.getenv("FEED_BROKER_LOCK", SOCKET_PATH + ".lock")
+# A worker further behind than this many bytes is dropped and reconnects
+MAX_WORKER_BUFFER = int(os.getenv("FEED_BROKER_MAX_BUFFER", str(64 * 1024 * 1024)))
+RETRY_DELAY = 1.0
+
+HEADER = struct.Struct(">I")
+
+
+def encode_frame(collection: str, docs: list) -> bytes:
+    payload = bson.encode({"collection": collection, "docs": docs})
+    return HEADER.pack(len(payload)) + payload
+
+async def read_frame(reader: asyncio.StreamReader):
+    (length,) = HEADER.unpack(await reader.readexactly(HEADER.size))
+    frame = bson.decode(await reader.readexactly(length))
+    return frame["collection"], frame["docs"]
+
+
+class Broker:
+    """The elected worker's side: tail every hub's collection once and write to all workers"""
+
+    def __init__(self):
+        self.workers = set()
+        self.server = None
+
+    def publish(self, collection: str, docs: list):
+        frame = encode_frame(collection, docs)
+        for writer in list(self.workers):
+            if writer.transport.get_write_buffer_size() > MAX_WORKER_BUFFER:
+                print("Feed broker dropping a worker that stopped reading")
+                self.workers.discard(writer)
+                writer.close()
+                continue
+            writer.write(frame)
+
+    async def _accept(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.workers.add(writer)
+        try:
+            # Workers never write; EOF means the worker went away
+            await reader.read()
+        except asyncio.CancelledError:
+            # Shutting down. Ending normally, because asyncio's connection callback
+            # calls exception() on this task, which raises for a cancelled one.
+            pass
+        finally:
+            self.workers.discard(writer)
+            writer.close()
+
+    async def listen(self):
+        # Holding the lock means any socket file left behind belongs to a dead broker
+        if os.path.exists(SOCKET_PATH):
+            os.unlink(SOCKET_PATH)
+        self.server = await asyncio.start_unix_server(self._accept, SOCKET_PATH)
+
+    async def serve(self, jobs=()):
+        tasks = [
+            asyncio.create_task(hub.tail(lambda docs, collection=collection: self.publish(collection, docs)))
+            for collection, hub in hubs.items()
+        ]
+        tasks.extend(asyncio.create_task(job()) for job in jobs)
+        try:
+            async with self.server:
+                await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+            # Closing the server leaves accepted connections open; workers must see EOF to re-elect
+            for writer in list(self.workers):
+                writer.close()
+
+
+def try_lock(lock_file) -> bool:
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        return True
+    except BlockingIOError:
+        return False
+
+async def receive():
+    """Dispatch frames from the broker to the local hubs until the connection is lost"""
+    try:
+        reader, writer = await asyncio.open_unix_connection(SOCKET_PATH)
+    except (FileNotFoundError, ConnectionRefusedError):
+        return
+    try:
+        while True:
+            collection, docs = await read_frame(reader)
+            hub = hubs.get(collection)
+            if hub is not None:
+                hub.dispatch(docs)
+    except (asyncio.IncompleteReadError, ConnectionError):
+        print("Lost the feed broker, reconnecting")
+    finally:
+        writer.close()
+
+
+async def run(jobs=()):
+    """
+    Worker side: stand for election whenever there is no broker, and feed the
+    local hubs from whichever worker is the broker. `jobs` (coroutine functions)
+    run on the broker only.
+    """
+    Hub.shared_feed = True
+    lock_file = open(LOCK_PATH, "a")
+    leading = None
+    try:
+        while True:
+            if leading is not None and leading.done():
+                # The broker failed; let any worker (this one included) take over
+                print(f"Feed broker stopped: {leading.exception()!r}")
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+                leading = None
+            if leading is None and try_lock(lock_file):
+                print(f"Worker {os.getpid()} is the feed broker")
+                elected = Broker()
+                try:
+                    await elected.listen()
+                    leading = asyncio.create_task(elected.serve(jobs))
+                except OSError as e:
+                    print(f"Feed broker could not listen on {SOCKET_PATH}: {e}")
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+            await receive()
+            await asyncio.sleep(RETRY_DELAY)
+    finally:
+        if leading is not None:
+            leading.cancel()
+        lock_file.close()
@@ -1,10 +1,94 @@
-from pymongo import MongoClient
+"""
+One Mongo client per process, configured from the environment.
 
+Connection usage per deployment is roughly workers x MONGO_MAX_POOL_SIZE
+(plus the sync client for scripts, when used). Routes pick a workload:
+- "default": MONGO_READ_PREFERENCE (primary by default)
+- "analytics": MONGO_ANALYTICS_READ_PREFERENCE (secondaryPreferred by default),
+  for read-heavy dashboards and backfills that tolerate slightly stale data
+- "auth": always the primary, so a user sees their own writes
+
+Each workload also has a time budget for all Mongo operations in a request,
+applied with the `query_budget` dependency (or `mongo_budget` around the Mongo
+calls of handlers that also wait on something else). Compression needs the matching
+optional package (zstandard, python-snappy); unavailable compressors are skipped.
+"""
+import os
+import pymongo
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import MongoClient, ReadPreference
+from .metrics import command_listener
+from .profiling import slow_query_listener
+
+READ_PREFERENCES = {
+    "primary": ReadPreference.PRIMARY,
+    "primaryPreferred": ReadPreference.PRIMARY_PREFERRED,
+    "secondary": ReadPreference.SECONDARY,
+    "secondaryPreferred": ReadPreference.SECONDARY_PREFERRED,
+    "nearest": ReadPreference.NEAREST,
+}
+
+WORKLOADS = {
+    "default": (os.getenv("MONGO_READ_PREFERENCE", "primary"), os.getenv("MONGO_DEFAULT_TIMEOUT_MS", "10000")),
+    "analytics": (os.getenv("MONGO_ANALYTICS_READ_PREFERENCE", "secondaryPreferred"), os.getenv("MONGO_ANALYTICS_TIMEOUT_MS", "15000")),
+    "auth": ("primary", os.getenv("MONGO_AUTH_TIMEOUT_MS", "3000")),
+}
+
+client = None
+sync_client = None
+databases = {}
+
+
+def client_options():
+    """MongoClient keyword arguments from the MONGO_* environment variables"""
+    options = {
+        "maxPoolSize": int(os.getenv("MONGO_MAX_POOL_SIZE", "50")),
+        "minPoolSize": int(os.getenv("MONGO_MIN_POOL_SIZE", "0")),
+        "maxIdleTimeMS": int(os.getenv("MONGO_MAX_IDLE_TIME_MS", "300000")),
+        "connectTimeoutMS": int(os.getenv("MONGO_CONNECT_TIMEOUT_MS", "5000")),
+        "serverSelectionTimeoutMS": int(os.getenv("MONGO_SERVER_SELECTION_TIMEOUT_MS", "5000")),
+        "waitQueueTimeoutMS": int(os.getenv("MONGO_WAIT_QUEUE_TIMEOUT_MS", "5000")),
+        "read_preference": READ_PREFERENCES[WORKLOADS["default"][0]],
+        # Per-collection command timings for /metrics, and the slow-query log
+        "event_listeners": [command_listener, slow_query_listener],
+    }
+    compressors = os.getenv("MONGO_COMPRESSORS")  # e.g. "zstd,snappy"
+    if compressors:
+        options["compressors"] = compressors
+    return options
 
 def init_db(URI, db_name):
-    global client, db
-    client = MongoClient(URI)
-    db = client[db_name]
+    global client, _uri, _db_name
+    client = AsyncIOMotorClient(URI, **client_options())
+    databases.clear()
+    _uri, _db_name = URI, db_name
+
+def get_db(workload: str = "default"):
+    if workload not in databases:
+        read_preference = READ_PREFERENCES[WORKLOADS[workload][0]]
+        databases[workload] = client.get_database(_db_name, read_preference=read_preference)
+    return databases[workload]
+
+def get_sync_db():
+    """Blocking pymongo handle for scripts and CLI commands that run outside the event loop."""
+    global sync_client
+    if sync_client is None:
+        sync_client = MongoClient(_uri, **client_options())
+    return sync_client[_db_name]
+
+def mongo_budget(workload: str):
+    """
+    Context manager bounding the total time of the Mongo operations inside it.
+    For handlers that also wait on other things (e.g. the bcrypt pool), so only
+    time spent in Mongo counts against the budget.
+    """
+    return pymongo.timeout(int(WORKLOADS[workload][1]) / 1000)
+
+def query_budget(workload: str):
+    """Dependency bounding the total time a request spends in Mongo operations"""
+
+    async def dependency():
+        with mongo_budget(workload):
+            yield
 
-def get_db():
-    return db
\ No newline at end of file
+    return dependency
@@ -0,0 +1,195 @@
+"""
+Native BSON dates next to the legacy timestamp fields.
+
+`reddit.created_utc` is epoch seconds. The migration adds `reddit.created_at`
+as a date, so time ranges compare as dates on an index and the raw sentiment
+pipeline groups with $dateTrunc instead of arithmetic on every post.
+
+The legacy field stays: the ingesters, the feed cursors and the rollups use it.
+
+Documents are converted in `_id` order, BATCH_SIZE at a time, by a server-side
+update, pausing DATE_MIGRATION_PAUSE seconds between batches so it can run next
+to the app. `date_migrations` records per collection:
+- watermark: `_id` of the last document converted in `_id` order
+- backfilled: whether the documents that existed when the migration started are done
+
+Readers only use a date field once its collection is backfilled, and the legacy
+field for documents without it (`dual_range`). The follower, run by the app unless
+DATE_MIGRATION_FOLLOW=0, converts new inserts of started migrations. ObjectIds
+from several clients are not strictly increasing, so it also converts documents
+that land behind the watermark, up to DATE_MIGRATION_LOOKBACK seconds back;
+older stragglers keep being read through the legacy field.
+
+`stock_news` is not migrated: its `published_utc` strings already sort and compare
+like dates, and every news query (the feed, its cursors, the export) reads them.
+A collection gets an entry in MIGRATIONS once something reads its date field.
+
+A time-series collection is not used: change streams, which the feeds tail, are
+not available on them, and the rollup follower relies on `_id` order.
+Needs MongoDB 5.0 or later ($dateTrunc).
+
+Usage:
+    python -m app.dates backfill [--collection reddit]
+    python -m app.dates follow
+    python -m app.dates status
+"""
+import asyncio
+import calendar
+import os
+from bson import ObjectId
+from datetime import datetime, timedelta, timezone
+from pymongo.errors import PyMongoError
+from .cache import TTLCache
+from .database import get_db
+from .indexes import register_index, register_query
+
+BATCH_SIZE = int(os.getenv("DATE_MIGRATION_BATCH_SIZE", "5000"))
+PAUSE = float(os.getenv("DATE_MIGRATION_PAUSE", "0.1"))
+FOLLOW_INTERVAL = float(os.getenv("DATE_MIGRATION_FOLLOW_INTERVAL", "5.0"))
+LOOKBACK = float(os.getenv("DATE_MIGRATION_LOOKBACK", "3600"))
+STATE_TTL = float(os.getenv("DATE_MIGRATION_STATE_TTL", "30"))
+RETRY_DELAY = 5.0
+
+# collection -> (legacy field, date field, expression computing the date from the legacy field)
+MIGRATIONS = {
+    "reddit": (
+        "created_utc",
+        "created_at",
+        {"$toDate": {"$multiply": ["$created_utc", 1000]}},
+    ),
+}
+
+# Read on every dashboard request, so looked up at most once per STATE_TTL
+migration_states = TTLCache(maxsize=len(MIGRATIONS), ttl=STATE_TTL)
+
+register_index("reddit", [("keyword", 1), ("created_at", 1), ("subreddit", 1)])
+register_query("reddit", {"keyword": {"$in": ["tsla"]}, "created_at": {"$gte": datetime(2024, 1, 1), "$lt": datetime(2024, 1, 2)}})
+# The dual_range branch for posts without a date yet
+register_query("reddit", {"keyword": {"$in": ["tsla"]}, "created_at": None, "created_utc": {"$gte": 0, "$lt": 60}})
+
+
+def to_date(ts: float) -> datetime:
+    """Epoch seconds as a naive UTC datetime, as pymongo stores and returns dates"""
+    return datetime.fromtimestamp(ts, timezone.utc).replace(tzinfo=None)
+
+def to_timestamp(value: datetime) -> int:
+    return calendar.timegm(value.utctimetuple())
+
+
+async def backfilled(db, collection: str) -> bool:
+    """Whether the date field of `collection` can be read; cached for DATE_MIGRATION_STATE_TTL seconds"""
+    ready = migration_states.get(collection)
+    if ready is None:
+        state = await db.date_migrations.find_one({"_id": collection})
+        ready = bool(state and state.get("backfilled"))
+        migration_states.set(collection, ready)
+    return ready
+
+def dual_range(collection: str, date_range: dict, legacy_range: dict):
+    """
+    $or branches matching documents in a time range: by the date field, and by
+    the legacy field for documents without a date yet. A null lookup on the date
+    field's index only reaches the few unconverted documents.
+    """
+    legacy, field, _ = MIGRATIONS[collection]
+    return [{field: date_range}, {field: None, legacy: legacy_range}]
+
+def date_expr(collection: str):
+    """The date of a document, computed from the legacy field where it has none yet"""
+    _, field, expression = MIGRATIONS[collection]
+    return {"$ifNull": [f"${field}", expression]}
+
+
+async def _step(db, collection: str, state: dict):
+    """Convert the next batch after the watermark; True once caught up"""
+    _, field, expression = MIGRATIONS[collection]
+    watermark = state.get("watermark")
+    query = {"_id": {"$gt": watermark}} if watermark is not None else {}
+
+    ids = await db[collection].find(query, {"_id": 1}).sort("_id", 1).limit(BATCH_SIZE).to_list(length=BATCH_SIZE)
+    if ids:
+        last = ids[-1]["_id"]
+        # Documents already written with a date keep it
+        await db[collection].update_many(
+            {"_id": {**query.get("_id", {}), "$lte": last}},
+            [{"$set": {field: {"$ifNull": [f"${field}", expression]}}}]
+        )
+        state["watermark"] = last
+
+    caught_up = len(ids) < BATCH_SIZE
+    if caught_up:
+        state["backfilled"] = True
+        if isinstance(state["watermark"], ObjectId):
+            # Documents inserted with an _id behind the watermark
+            since = ObjectId.from_datetime(state["watermark"].generation_time - timedelta(seconds=LOOKBACK))
+            await db[collection].update_many(
+                {"_id": {"$gt": since, "$lte": state["watermark"]}, field: {"$exists": False}},
+                [{"$set": {field: expression}}]
+            )
+    await db.date_migrations.update_one({"_id": collection}, {"$set": state}, upsert=True)
+    return caught_up
+
+
+async def backfill(db, collection: str):
+    """Start (or resume) the migration of `collection` and run it until caught up"""
+    state = await db.date_migrations.find_one({"_id": collection}) or {"watermark": None, "backfilled": False}
+    state.pop("_id", None)
+    converted = 0
+    while not await _step(db, collection, state):
+        converted += BATCH_SIZE
+        print(f"{collection}: {converted} documents converted")
+        await asyncio.sleep(PAUSE)
+    print(f"{collection}: backfilled up to {state['watermark']}")
+
+
+async def follow():
+    """Convert new documents of every started migration until cancelled"""
+    db = get_db()
+    while True:
+        try:
+            caught_up = True
+            async for state in db.date_migrations.find({"_id": {"$in": list(MIGRATIONS)}}):
+                collection = state.pop("_id")
+                caught_up = await _step(db, collection, state) and caught_up
+        except asyncio.CancelledError:
+            raise
+        except PyMongoError as e:
+            print(f"Date migration follower interrupted, retrying: {e}")
+            await asyncio.sleep(RETRY_DELAY)
+            continue
+        await asyncio.sleep(FOLLOW_INTERVAL if caught_up else PAUSE)
+
+
+async def status(db):
+    for collection, (_, field, _) in MIGRATIONS.items():
+        state = await db.date_migrations.find_one({"_id": collection})
+        missing = await db[collection].count_documents({field: {"$exists": False}})
+        print(f"{collection}.{field}: {state or 'not started'}, {missing} documents without it")
+
+
+if __name__ == "__main__":
+    import argparse
+    from dotenv import load_dotenv
+    from .database import init_db
+
+    load_dotenv()
+    parser = argparse.ArgumentParser(description="Add native date fields next to the legacy timestamps")
+    subcommands = parser.add_subparsers(dest="command", required=True)
+    backfill_parser = subcommands.add_parser("backfill", help="Convert the existing documents")
+    backfill_parser.add_argument("--collection", choices=list(MIGRATIONS), action="append", default=None)
+    subcommands.add_parser("follow", help="Keep converting new documents")
+    subcommands.add_parser("status", help="Show the progress of each migration")
+    args = parser.parse_args()
+
+    init_db(os.getenv("MONGO_URI"), os.getenv("MONGO_DB"))
+
+    async def main():
+        if args.command == "backfill":
+            for collection in args.collection or MIGRATIONS:
+                await backfill(get_db(), collection)
+        elif args.command == "follow":
+            await follow()
+        else:
+            await status(get_db())
+
+    asyncio.run(main())
@@ -0,0 +1,296 @@
+import asyncio
+import base64
+import bson
+import os
+from collections import defaultdict
+from fastapi import WebSocket, WebSocketDisconnect
+from pymongo.errors import OperationFailure, PyMongoError
+from .database import get_db
+from .metrics import Gauge
+
+POLL_INTERVAL = float(os.getenv("FEED_POLL_INTERVAL", "1.0"))
+POLL_BATCH_SIZE = int(os.getenv("FEED_POLL_BATCH_SIZE", "500"))
+RETRY_DELAY = 5.0
+
+# Reconnects with ?since= get at most BACKFILL_LIMIT missed documents, in frames of BACKFILL_BATCH_SIZE
+BACKFILL_LIMIT = int(os.getenv("FEED_BACKFILL_LIMIT", "1000"))
+BACKFILL_BATCH_SIZE = int(os.getenv("FEED_BACKFILL_BATCH_SIZE", "100"))
+
+# Slow consumers: each subscriber has up to SEND_QUEUE_SIZE batches pending; when the queue is full
+# OVERFLOW_POLICY "latest" keeps only the newest batch, "drop_oldest" drops the oldest one and
+# "disconnect" closes the socket. A single send taking longer than SEND_TIMEOUT also disconnects.
+SEND_QUEUE_SIZE = int(os.getenv("FEED_SEND_QUEUE_SIZE", "64"))
+SEND_TIMEOUT = float(os.getenv("FEED_SEND_TIMEOUT", "10"))
+OVERFLOW_POLICY = os.getenv("FEED_OVERFLOW_POLICY", "drop_oldest")
+if OVERFLOW_POLICY not in ("latest", "drop_oldest", "disconnect"):
+    raise ValueError(f"Unknown FEED_OVERFLOW_POLICY {OVERFLOW_POLICY!r}")
+
+# Cap on feed connections per worker, across all hubs
+MAX_CONNECTIONS = int(os.getenv("FEED_MAX_CONNECTIONS", "1000"))
+connected = set()
+
+# Every hub by collection, for the cross-worker broker
+hubs = {}
+
+Gauge("websocket_connections", "Open feed websockets", ["feed"],
+      collect=lambda: {(name,): len(hub.subscribers) for name, hub in hubs.items()})
+Gauge("websocket_subscribed_keys", "Distinct keywords/tickers subscribed to", ["feed"],
+      collect=lambda: {(name,): len(hub.index) for name, hub in hubs.items()})
+Gauge("websocket_send_queue_depth", "Batches waiting to be sent, over all subscribers", ["feed"],
+      collect=lambda: {(name,): sum(s.queue.qsize() for s in hub.subscribers) for name, hub in hubs.items()})
+Gauge("websocket_send_queue_max_depth", "Batches waiting for the most backed-up subscriber", ["feed"],
+      collect=lambda: {(name,): max((s.queue.qsize() for s in hub.subscribers), default=0) for name, hub in hubs.items()})
+
+
+def encode_cursor(timestamp, _id) -> str:
+    """Opaque resume token for a position in (timestamp, _id) order"""
+    return base64.urlsafe_b64encode(bson.encode({"t": timestamp, "i": _id})).decode().rstrip("=")
+
+def decode_cursor(token: str):
+    """(timestamp, _id) of a resume token; ValueError if it is not one"""
+    try:
+        doc = bson.decode(base64.urlsafe_b64decode(token + "=" * (-len(token) % 4)))
+        return doc["t"], doc["i"]
+    except (ValueError, KeyError, bson.errors.InvalidBSON) as e:
+        raise ValueError("Invalid cursor") from e
+
+def at_capacity() -> bool:
+    return len(connected) >= MAX_CONNECTIONS
+
+
+class Subscriber:
+    """A connected websocket, the routing keys it is interested in and its wire format"""
+
+    def __init__(self, websocket: WebSocket, keys, format: str = "json"):
+        self.websocket = websocket
+        self.keys = set(keys)
+        self.format = format
+        self.queue = asyncio.Queue(maxsize=SEND_QUEUE_SIZE)
+        self.dropped = 0
+        self.evicted = asyncio.Event()
+
+    def offer(self, batch: list):
+        """Queue a batch for sending, applying OVERFLOW_POLICY when the queue is full"""
+        if self.evicted.is_set():
+            return
+        if self.queue.full():
+            if OVERFLOW_POLICY == "disconnect":
+                self.evicted.set()
+                return
+            # "latest" drops everything pending, "drop_oldest" just makes room
+            while not self.queue.empty():
+                self.dropped += len(self.queue.get_nowait())
+                if OVERFLOW_POLICY == "drop_oldest":
+                    break
+        self.queue.put_nowait(batch)
+
+
+class Hub:
+    """
+    Process-wide fan-out of newly inserted documents to websocket subscribers.
+
+    A hub tails its collection once (a change stream, or a single shared
+    `_id` high-water-mark poller when the deployment has no replica set) and
+    routes every new document through an inverted index from routing key to
+    subscribers, so Mongo load follows the ingest rate instead of the number
+    of connected clients. Subclasses say which keys a document is routed to
+    and how a batch is encoded for a given subscriber. Items carry resume
+    cursors over (`timestamp_field`, `_id`), which `backfill` picks up from.
+
+    With several workers the tailing moves to app.broker, which sets
+    `shared_feed` and calls `dispatch` with the documents it receives.
+    """
+
+    collection: str = None
+    timestamp_field: str = None
+    shared_feed = False
+
+    def __init__(self):
+        self.index = defaultdict(set)
+        self.subscribers = set()
+        self._task = None
+        hubs[self.collection] = self
+
+    def prepare(self, doc):
+        """Turn a new document into the item that is routed; runs once per document"""
+        return doc
+
+    def item_id(self, item):
+        return item["_id"]
+
+    def routing_keys(self, item):
+        """Keys under which subscribers interested in `item` are indexed"""
+        raise NotImplementedError
+
+    def encode(self, subscriber: Subscriber, items: list):
+        """Serialize a batch of items for one subscriber: str for a text frame, bytes for a binary one"""
+        raise NotImplementedError
+
+    async def send(self, subscriber: Subscriber, items: list):
+        """Send a batch; a client that does not take it within SEND_TIMEOUT is disconnected"""
+        payload = self.encode(subscriber, items)
+        if isinstance(payload, bytes):
+            send = subscriber.websocket.send_bytes(payload)
+        else:
+            send = subscriber.websocket.send_text(payload)
+        try:
+            await asyncio.wait_for(send, SEND_TIMEOUT)
+        except asyncio.TimeoutError:
+            subscriber.evicted.set()
+            raise WebSocketDisconnect(1008, "Client too slow")
+
+    async def backfill(self, db, query: dict, position):
+        """
+        Documents matching `query` after the cursor `position` (as returned by
+        `decode_cursor`), oldest first, as an async iterator of pages.
+
+        Returns None when more than BACKFILL_LIMIT were missed; the caller
+        should then start over as on a fresh connect.
+        """
+        timestamp, _id = position
+        query = {"$and": [query, {"$or": [
+            {self.timestamp_field: {"$gt": timestamp}},
+            {self.timestamp_field: timestamp, "_id": {"$gt": _id}},
+        ]}]}
+        collection = db[self.collection]
+        if await collection.count_documents(query, limit=BACKFILL_LIMIT + 1) > BACKFILL_LIMIT:
+            return None
+
+        async def pages():
+            cursor = (
+                collection.find(query)
+                .sort([(self.timestamp_field, 1), ("_id", 1)])
+                .limit(BACKFILL_LIMIT)
+                .batch_size(BACKFILL_BATCH_SIZE)
+            )
+            page = []
+            async for doc in cursor:
+                page.append(doc)
+                if len(page) == BACKFILL_BATCH_SIZE:
+                    yield page
+                    page = []
+            if page:
+                yield page
+
+        return pages()
+
+    def subscribe(self, subscriber: Subscriber):
+        connected.add(subscriber)
+        self.subscribers.add(subscriber)
+        for key in subscriber.keys:
+            self.index[key].add(subscriber)
+
+        # Start tailing lazily, so an idle worker does not poll Mongo
+        if not self.shared_feed and (self._task is None or self._task.done()):
+            self._task = asyncio.create_task(self.tail(self.dispatch))
+
+    def unsubscribe(self, subscriber: Subscriber):
+        connected.discard(subscriber)
+        self.subscribers.discard(subscriber)
+        for key in subscriber.keys:
+            subscribers = self.index.get(key)
+            if subscribers is not None:
+                subscribers.discard(subscriber)
+                if not subscribers:
+                    del self.index[key]
+
+        if not self.subscribers and self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def dispatch(self, docs: list):
+        """Queue each document for every subscriber whose keys match it"""
+        batches = defaultdict(list)
+        for doc in docs:
+            item = self.prepare(doc)
+            matched = set()
+            for key in self.routing_keys(item):
+                matched.update(self.index.get(key, ()))
+            for subscriber in matched:
+                batches[subscriber].append(item)
+
+        for subscriber, batch in batches.items():
+            subscriber.offer(batch)
+
+    async def serve(self, subscriber: Subscriber, skip_ids=()):
+        """
+        Forward queued batches to the subscriber's socket until it disconnects.
+
+        Items whose id is in `skip_ids` were already sent as part of the
+        initial snapshot and are dropped. Messages from the client are only
+        treated as keep-alives; dead connections are detected by the server's
+        websocket pings. Each subscriber is served by its own task, so a slow
+        one only ever delays itself, and one that overflows its queue under
+        the "disconnect" policy is closed with code 1008.
+        """
+        skip_ids = set(skip_ids)
+
+        async def forward():
+            while True:
+                batch = await subscriber.queue.get()
+                if skip_ids:
+                    batch = [item for item in batch if self.item_id(item) not in skip_ids]
+                    if not batch:
+                        continue
+                await self.send(subscriber, batch)
+
+        sender = asyncio.create_task(forward())
+        receiver = asyncio.create_task(self._drain(subscriber.websocket))
+        evicted = asyncio.create_task(subscriber.evicted.wait())
+        try:
+            done, _ = await asyncio.wait({sender, receiver, evicted}, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                task.result()
+            if evicted in done:
+                sender.cancel()
+                try:
+                    await asyncio.wait_for(subscriber.websocket.close(code=1008, reason="Client too slow"), SEND_TIMEOUT)
+                except Exception:
+                    pass
+                raise WebSocketDisconnect(1008, "Client too slow")
+        finally:
+            sender.cancel()
+            receiver.cancel()
+            evicted.cancel()
+
+    @staticmethod
+    async def _drain(websocket: WebSocket):
+        while True:
+            message = await websocket.receive()
+            if message["type"] == "websocket.disconnect":
+                raise WebSocketDisconnect(message.get("code", 1000))
+
+    async def tail(self, deliver):
+        """Pass every batch of newly inserted documents to `deliver` until cancelled"""
+        collection = get_db()[self.collection]
+        while True:
+            try:
+                try:
+                    await self._watch(collection, deliver)
+                except OperationFailure:
+                    # Change streams need a replica set; fall back to one shared poller
+                    await self._poll(collection, deliver)
+            except asyncio.CancelledError:
+                raise
+            except PyMongoError as e:
+                print(f"{self.collection} feed interrupted, retrying: {e}")
+                await asyncio.sleep(RETRY_DELAY)
+
+    async def _watch(self, collection, deliver):
+        async with collection.watch([{"$match": {"operationType": "insert"}}]) as stream:
+            async for change in stream:
+                deliver([change["fullDocument"]])
+
+    async def _poll(self, collection, deliver):
+        # ObjectIds grow with insertion time, so `_id` works as a high-water mark
+        latest = await collection.find_one({}, {"_id": 1}, sort=[("_id", -1)])
+        high_water_mark = latest["_id"] if latest else None
+
+        while True:
+            query = {"_id": {"$gt": high_water_mark}} if high_water_mark is not None else {}
+            docs = await collection.find(query).sort("_id", 1).limit(POLL_BATCH_SIZE).to_list(length=POLL_BATCH_SIZE)
+            if docs:
+                high_water_mark = docs[-1]["_id"]
+                deliver(docs)
+            if len(docs) < POLL_BATCH_SIZE:
+                await asyncio.sleep(POLL_INTERVAL)
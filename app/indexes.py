@@ -0,0 +1,109 @@
+"""
+Declarative index registry.
+
+Route modules declare the indexes their queries need with `register_index`,
+and sample query shapes with `register_query`. At startup `ensure_indexes`
+reconciles the registry against the database (creating an existing index is
+a no-op), and `audit_query_plans` runs explain() on every registered shape
+and reports the ones that would scan a whole collection.
+
+Usage:
+    python -m app.indexes            # create missing indexes
+    python -m app.indexes --audit    # ... then explain every registered query shape
+    python -m app.indexes --strict   # ... and exit non-zero on any COLLSCAN
+"""
+import os
+from pymongo.errors import OperationFailure
+
+INDEXES = {}
+QUERY_SHAPES = []
+
+
+def register_index(collection: str, keys, **options):
+    """Declare that `collection` needs an index on `keys` (a list of (field, direction))"""
+    INDEXES[(collection, tuple(keys))] = options
+
+def register_query(collection: str, filter: dict, sort=None):
+    """Declare a query shape to audit; use representative sample values in `filter`"""
+    QUERY_SHAPES.append((collection, filter, sort))
+
+
+async def ensure_indexes(db):
+    """Create every registered index; conflicts with existing indexes are reported, not fatal"""
+    for (collection, keys), options in INDEXES.items():
+        try:
+            await db[collection].create_index(list(keys), **options)
+        except OperationFailure as e:
+            print(f"Could not create index {list(keys)} on {collection}: {e}")
+
+
+def _collection_scans(plan):
+    """Yield every COLLSCAN stage in an explain() plan tree"""
+    if isinstance(plan, dict):
+        if plan.get("stage") == "COLLSCAN":
+            yield plan
+        for value in plan.values():
+            yield from _collection_scans(value)
+    elif isinstance(plan, list):
+        for value in plan:
+            yield from _collection_scans(value)
+
+
+async def audit_query_plans(db, strict: bool = False):
+    """
+    Explain every registered query shape and warn about winning plans that
+    scan a whole collection. With `strict`, raise instead.
+    """
+    problems = []
+    for collection, filter, sort in QUERY_SHAPES:
+        command = {"find": collection, "filter": filter}
+        if sort:
+            command["sort"] = dict(sort)
+        explain = await db.command("explain", command, verbosity="queryPlanner")
+        if any(_collection_scans(explain["queryPlanner"]["winningPlan"])):
+            problems.append(f"COLLSCAN on {collection} for filter={filter} sort={sort}")
+
+    for problem in problems:
+        print(f"Query plan audit: {problem}")
+    if problems and strict:
+        raise RuntimeError(f"{len(problems)} registered queries would scan a whole collection")
+    return problems
+
+
+async def reconcile(db):
+    """Startup hook: ensure indexes, then audit according to INDEX_AUDIT (off, warn or strict)"""
+    if os.getenv("ENSURE_INDEXES", "1") == "1":
+        await ensure_indexes(db)
+    audit = os.getenv("INDEX_AUDIT", "off")
+    if audit in ("warn", "strict"):
+        await audit_query_plans(db, strict=audit == "strict")
+
+
+if __name__ == "__main__":
+    import argparse
+    import asyncio
+    import sys
+    from dotenv import load_dotenv
+    from .database import init_db, get_db
+
+    load_dotenv()
+
+    # Importing the routes fills the registry of the `app.indexes` module (not this `__main__` copy)
+    from .routes import auth, posts, sentiments, tickers, news
+    from . import indexes
+
+    parser = argparse.ArgumentParser(description="Create registered indexes and audit query plans")
+    parser.add_argument("--audit", action="store_true", help="Explain every registered query shape")
+    parser.add_argument("--strict", action="store_true", help="Exit non-zero if any of them is a COLLSCAN")
+    args = parser.parse_args()
+
+    init_db(os.getenv("MONGO_URI"), os.getenv("MONGO_DB"))
+
+    async def main():
+        await indexes.ensure_indexes(get_db())
+        if args.audit or args.strict:
+            return await indexes.audit_query_plans(get_db())
+        return []
+
+    problems = asyncio.run(main())
+    sys.exit(1 if problems and args.strict else 0)
@@ -0,0 +1,235 @@
+"""
+Process metrics in the Prometheus text format, served at /metrics.
+
+- http_request_duration_seconds / http_requests_total: per method and route
+  template, recorded by MetricsMiddleware
+- mongo_command_duration_seconds / mongo_documents_returned_total /
+  mongo_command_failures_total: per collection and command, from the
+  CommandListener registered on the Mongo clients
+- websocket gauges, computed from the hubs when scraped (app.hub)
+- openai_request_duration_seconds: outbound OpenAI calls (app.routes.llm)
+
+Recording is a dict lookup and a few additions under an uncontended lock;
+gauges cost nothing until scraped. Every worker keeps its own numbers, so
+with WORKERS > 1 each scrape sees one worker.
+"""
+import threading
+import time
+from bisect import bisect_left
+from collections import defaultdict
+from contextlib import contextmanager
+from fastapi import APIRouter
+from fastapi.responses import PlainTextResponse
+from pymongo import monitoring
+
+REGISTRY = []
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+MONGO_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+OPENAI_BUCKETS = (0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def _labels(names, values, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Metric:
+    type: str = None
+
+    def __init__(self, name: str, help: str, labels=()):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def samples(self):
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+        lines.extend(f"{name}{labels} {value}" for name, labels, value in self.samples())
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def __init__(self, name, help, labels=()):
+        super().__init__(name, help, labels)
+        self._values = defaultdict(float)
+
+    def inc(self, *labels, amount: float = 1):
+        with self._lock:
+            self._values[labels] += amount
+
+    def samples(self):
+        with self._lock:
+            values = list(self._values.items())
+        for labels, value in values:
+            yield self.name, _labels(self.label_names, labels), value
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+        # labels -> [count per bucket (last one is +Inf), sum]
+        self._values = {}
+
+    def observe(self, value: float, *labels):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(labels)
+            if entry is None:
+                entry = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            entry[0][index] += 1
+            entry[1] += value
+
+    @contextmanager
+    def time(self, *labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, *labels)
+
+    def samples(self):
+        with self._lock:
+            values = [(labels, list(counts), total) for labels, (counts, total) in self._values.items()]
+        for labels, counts, total in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                yield f"{self.name}_bucket", _labels(self.label_names, labels, f'le="{bound}"'), cumulative
+            yield f"{self.name}_sum", _labels(self.label_names, labels), total
+            yield f"{self.name}_count", _labels(self.label_names, labels), cumulative
+
+
+class Gauge(Metric):
+    """Computed when scraped: `collect` returns {label values tuple: value}"""
+
+    type = "gauge"
+
+    def __init__(self, name, help, labels=(), collect=None):
+        super().__init__(name, help, labels)
+        self.collect = collect
+
+    def samples(self):
+        for labels, value in self.collect().items():
+            yield self.name, _labels(self.label_names, labels), value
+
+
+def render() -> str:
+    return "\n".join(metric.render() for metric in REGISTRY) + "\n"
+
+
+# HTTP
+
+http_requests = Counter("http_requests_total", "HTTP requests", ["method", "route", "status"])
+http_duration = Histogram("http_request_duration_seconds", "HTTP request latency", ["method", "route"])
+
+
+class MetricsMiddleware:
+    """Records every HTTP request under its route template, e.g. /tickers/stock_details/{ticker}"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        status = 500
+        started = time.perf_counter()
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            # The router stores the matched route in the scope; unmatched paths share one label
+            route = scope.get("route")
+            template = getattr(route, "path", "unmatched")
+            http_duration.observe(time.perf_counter() - started, scope["method"], template)
+            http_requests.inc(scope["method"], template, str(status))
+
+
+# Mongo
+
+mongo_duration = Histogram(
+    "mongo_command_duration_seconds", "Mongo command latency", ["collection", "command"], buckets=MONGO_BUCKETS
+)
+mongo_documents = Counter("mongo_documents_returned_total", "Documents returned by Mongo", ["collection", "command"])
+mongo_failures = Counter("mongo_command_failures_total", "Failed Mongo commands", ["collection", "command"])
+
+# Commands that are not about a collection are not recorded
+COLLECTION_COMMANDS = {
+    "find", "getMore", "aggregate", "count", "distinct", "insert", "update", "delete", "findAndModify",
+}
+
+
+def command_collection(command_name: str, command) -> str:
+    if command_name == "getMore":
+        return command.get("collection")
+    value = command.get(command_name)
+    return value if isinstance(value, str) else None
+
+
+class CommandMetrics(monitoring.CommandListener):
+    """Times commands by collection; pymongo calls it from whichever thread ran the command"""
+
+    def __init__(self):
+        self._pending = {}
+
+    def started(self, event):
+        if event.command_name in COLLECTION_COMMANDS:
+            collection = command_collection(event.command_name, event.command)
+            if collection:
+                self._pending[(event.connection_id, event.request_id)] = collection
+
+    def succeeded(self, event):
+        collection = self._pending.pop((event.connection_id, event.request_id), None)
+        if collection is None:
+            return
+        mongo_duration.observe(event.duration_micros / 1e6, collection, event.command_name)
+        cursor = event.reply.get("cursor") if isinstance(event.reply, dict) else None
+        if cursor:
+            batch = cursor.get("firstBatch", cursor.get("nextBatch", ()))
+            mongo_documents.inc(collection, event.command_name, amount=len(batch))
+
+    def failed(self, event):
+        collection = self._pending.pop((event.connection_id, event.request_id), None)
+        if collection is not None:
+            mongo_duration.observe(event.duration_micros / 1e6, collection, event.command_name)
+            mongo_failures.inc(collection, event.command_name)
+
+
+command_listener = CommandMetrics()
+
+
+# OpenAI
+
+openai_duration = Histogram(
+    "openai_request_duration_seconds", "Outbound OpenAI API calls", ["operation"], buckets=OPENAI_BUCKETS
+)
+
+
+router = APIRouter()
+
+@router.get("/metrics", include_in_schema=False)
+async def metrics():
+    return PlainTextResponse(render(), media_type="text/plain; version=0.0.4")
@@ -0,0 +1,255 @@
+"""
+On-demand request profiling and the slow-query log, behind ADMIN_TOKEN.
+
+Profiling: a request is profiled when it carries `X-Profile: 1` with a valid
+`X-Admin-Token`, or at random with probability PROFILE_SAMPLE_RATE. A thread
+samples the event loop's stack every PROFILE_INTERVAL seconds while the request
+runs; the profile is kept in memory (the last PROFILE_KEEP, and as files in
+PROFILE_DIR if set) in the collapsed-stack format that flamegraph.pl and
+speedscope read. Its id is returned in the `X-Profile-Id` response header.
+The loop is shared, so samples include anything else running concurrently,
+and time spent waiting on Mongo shows up as the loop's selector. One request
+is profiled at a time.
+
+Slow-query log: every find/aggregate/count/distinct/getMore taking at least
+SLOW_QUERY_MS is kept (the last SLOW_QUERY_KEEP) with its command, and an
+explain() summary of its plan is added in the background.
+
+    GET /debug/profiles              recent profiles
+    GET /debug/profiles/{id}         one profile, collapsed stacks
+    GET /debug/slow_queries          recent slow queries
+"""
+import hmac
+import os
+import random
+import sys
+import threading
+import time
+import uuid
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from typing import Optional
+from fastapi import APIRouter, Header, HTTPException
+from fastapi.responses import PlainTextResponse
+from pymongo import monitoring
+from pymongo.errors import PyMongoError
+from starlette.datastructures import Headers, MutableHeaders
+
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN")
+
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0"))
+PROFILE_INTERVAL = float(os.getenv("PROFILE_INTERVAL", "0.005"))
+PROFILE_KEEP = int(os.getenv("PROFILE_KEEP", "50"))
+PROFILE_DIR = os.getenv("PROFILE_DIR")
+
+SLOW_QUERY_MS = float(os.getenv("SLOW_QUERY_MS", "500"))
+SLOW_QUERY_KEEP = int(os.getenv("SLOW_QUERY_KEEP", "200"))
+
+
+def is_admin(token: Optional[str]) -> bool:
+    return bool(ADMIN_TOKEN and token and hmac.compare_digest(token, ADMIN_TOKEN))
+
+def require_admin(x_admin_token: Optional[str] = Header(None)):
+    """Dependency for the /debug routes"""
+    if not is_admin(x_admin_token):
+        raise HTTPException(status_code=403, detail="Admin token required")
+
+
+# Profiling
+
+profiles = deque(maxlen=PROFILE_KEEP)
+profiling = threading.Lock()
+
+
+def collapse(frame) -> str:
+    """One stack as `outermost;...;innermost`, each frame as `function (file:line)`"""
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+
+class Sampler(threading.Thread):
+    """Counts the stacks of one thread, sampled every `interval` seconds"""
+
+    def __init__(self, thread_id: int, interval: float):
+        super().__init__(daemon=True)
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is not None:
+                self.stacks[collapse(frame)] += 1
+
+    def stop(self):
+        self._stopped.set()
+        self.join()
+
+
+class ProfilingMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    def wanted(self, scope) -> bool:
+        headers = Headers(scope=scope)
+        if headers.get("x-profile") == "1" and is_admin(headers.get("x-admin-token")):
+            return True
+        return PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not self.wanted(scope) or not profiling.acquire(blocking=False):
+            await self.app(scope, receive, send)
+            return
+
+        profile_id = uuid.uuid4().hex[:12]
+        status = None
+
+        async def send_with_id(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                MutableHeaders(scope=message).append("X-Profile-Id", profile_id)
+            await send(message)
+
+        sampler = Sampler(threading.get_ident(), PROFILE_INTERVAL)
+        started = time.perf_counter()
+        sampler.start()
+        try:
+            await self.app(scope, receive, send_with_id)
+        finally:
+            sampler.stop()
+            profiling.release()
+            store_profile({
+                "id": profile_id,
+                "method": scope["method"],
+                "path": scope["path"],
+                "query": scope["query_string"].decode(),
+                "status": status,
+                "duration_ms": round((time.perf_counter() - started) * 1000, 2),
+                "samples": sum(sampler.stacks.values()),
+                "at": datetime.now(timezone.utc).isoformat(),
+                "stacks": sampler.stacks,
+            })
+
+
+def collapsed(profile) -> str:
+    return "".join(f"{stack} {count}\n" for stack, count in profile["stacks"].most_common())
+
+def store_profile(profile):
+    profiles.append(profile)
+    if PROFILE_DIR:
+        with open(os.path.join(PROFILE_DIR, f"{profile['id']}.collapsed"), "w") as f:
+            f.write(collapsed(profile))
+
+
+# Slow-query log
+
+slow_queries = deque(maxlen=SLOW_QUERY_KEEP)
+# A single thread, so a burst of slow queries cannot turn into a burst of explains
+explainer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="explain")
+
+QUERY_COMMANDS = {"find", "aggregate", "count", "distinct", "getMore"}
+# Added by the driver; explain() rejects or does not need them
+DRIVER_FIELDS = {
+    "lsid", "$db", "$clusterTime", "$readPreference", "txnNumber", "autocommit",
+    "startTransaction", "maxTimeMS", "readConcern", "$client",
+}
+
+
+def plan_summary(explain) -> dict:
+    """Stages and indexes of an explain() winning plan"""
+    stages, indexes = [], []
+
+    def walk(plan):
+        if isinstance(plan, dict):
+            if "stage" in plan:
+                stages.append(plan["stage"])
+                if "indexName" in plan:
+                    indexes.append(plan["indexName"])
+            for value in plan.values():
+                walk(value)
+        elif isinstance(plan, list):
+            for value in plan:
+                walk(value)
+
+    walk(explain.get("queryPlanner", {}).get("winningPlan") or explain.get("stages") or explain)
+    return {"stages": stages, "indexes": indexes, "collscan": "COLLSCAN" in stages}
+
+
+def explain_into(entry: dict, database: str, command: dict):
+    from .database import get_sync_db
+    try:
+        explain = get_sync_db().client[database].command("explain", command, verbosity="queryPlanner")
+        entry["plan"] = plan_summary(explain)
+    except PyMongoError as e:
+        entry["plan"] = {"error": str(e)}
+
+
+class SlowQueryLog(monitoring.CommandListener):
+    def __init__(self):
+        self._pending = {}
+
+    def started(self, event):
+        if SLOW_QUERY_MS >= 0 and event.command_name in QUERY_COMMANDS:
+            command = {key: value for key, value in event.command.items() if key not in DRIVER_FIELDS}
+            self._pending[(event.connection_id, event.request_id)] = (event.database_name, command)
+
+    def succeeded(self, event):
+        pending = self._pending.pop((event.connection_id, event.request_id), None)
+        if pending is not None and event.duration_micros >= SLOW_QUERY_MS * 1000:
+            self.record(event, *pending)
+
+    def failed(self, event):
+        pending = self._pending.pop((event.connection_id, event.request_id), None)
+        if pending is not None and event.duration_micros >= SLOW_QUERY_MS * 1000:
+            self.record(event, *pending, error=str(event.failure))
+
+    def record(self, event, database: str, command: dict, error: str = None):
+        name = event.command_name
+        collection = command.get("collection") if name == "getMore" else command.get(name)
+        entry = {
+            "at": datetime.now(timezone.utc).isoformat(),
+            "database": database,
+            "collection": collection,
+            "command": name,
+            "duration_ms": round(event.duration_micros / 1000, 2),
+            "spec": command,
+            "error": error,
+            "plan": None,
+        }
+        slow_queries.append(entry)
+        print(f"Slow query: {name} on {collection} took {entry['duration_ms']}ms")
+        # getMore only continues a cursor; its plan is the one of the find/aggregate before it
+        if name != "getMore":
+            explainer.submit(explain_into, entry, database, command)
+
+
+slow_query_listener = SlowQueryLog()
+
+
+router = APIRouter()
+
+@router.get("/profiles")
+async def list_profiles():
+    """Most recent profiles first, without their stacks"""
+    return [{k: v for k, v in profile.items() if k != "stacks"} for profile in reversed(profiles)]
+
+@router.get("/profiles/{profile_id}", response_class=PlainTextResponse)
+async def get_profile(profile_id: str):
+    """A profile in collapsed-stack format, for flamegraph.pl or speedscope"""
+    for profile in profiles:
+        if profile["id"] == profile_id:
+            return PlainTextResponse(collapsed(profile))
+    raise HTTPException(status_code=404, detail="Profile not found")
+
+@router.get("/slow_queries")
+async def list_slow_queries():
+    """Most recent slow queries first"""
+    return list(reversed(slow_queries))
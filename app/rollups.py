@@ -0,0 +1,367 @@
+"""
+Incrementally maintained sentiment rollups for the /sentiments endpoints.
+
+`sentiment_rollups` holds positive/negative/neutral counts per
+(keyword, subreddit, bucket) at minute and hour resolution, so dashboard
+queries cost one document per bucket instead of one per post. The follower
+tails new `reddit` inserts by `_id` and `$inc`s the matching buckets; the
+`rebuild` command recomputes everything from the raw collection.
+
+`rollup_state` records how far the rollups can be trusted:
+- watermark: `_id` of the last post claimed by the follower
+- applying: number of claimed batches whose increments are still being applied
+- covered_from / covered_until: epoch seconds range of `created_utc` the rollups are complete for
+
+Anything outside that range is served from the raw pipeline, which reads
+`created_at` and groups with $dateTrunc once that field is backfilled (app.dates).
+
+Usage:
+    python -m app.rollups rebuild [--since 2024-01-01T00:00:00]  # UTC unless an offset is given
+    python -m app.rollups follow
+"""
+import asyncio
+import os
+import time
+from collections import defaultdict
+from datetime import datetime
+from pymongo import UpdateOne
+from pymongo.errors import PyMongoError
+from .database import get_db
+from .dates import backfilled, dual_range, date_expr, to_date, to_timestamp
+from .export import utc_timestamp
+from .indexes import register_index, register_query
+
+MINUTE = 60
+HOUR = 3600
+DAY = 86400
+WEEK = 7 * DAY
+UNITS = {"minute": MINUTE, "hour": HOUR}
+SENTIMENT_FIELDS = {"positive": "positives", "negative": "negatives", "neutral": "neutrals"}
+
+STATE_ID = "sentiment_rollups"
+FOLLOW_INTERVAL = float(os.getenv("ROLLUP_FOLLOW_INTERVAL", "2.0"))
+FOLLOW_BATCH_SIZE = int(os.getenv("ROLLUP_FOLLOW_BATCH_SIZE", "1000"))
+RETRY_DELAY = 5.0
+# How long a rebuild waits for a follower to finish applying a claimed batch
+APPLY_GRACE = 30.0
+# $dateTrunc bins count from 2000-01-01T00:00:00Z
+DATE_TRUNC_ORIGIN = 946684800
+
+
+def _floor(ts, unit, offset=0):
+    return int((ts - offset) // unit * unit + offset)
+
+def _ceil(ts, unit, offset=0):
+    return int(-(-(ts - offset) // unit) * unit + offset)
+
+def _bucket_expr(field, unit, offset=0):
+    """Start of the `unit`-second bucket (shifted by `offset`) containing an epoch-seconds field"""
+    return {"$subtract": [field, {"$mod": [{"$subtract": [field, offset]}, unit]}]}
+
+def _date_bucket_expr(unit, offset=0):
+    """$dateTrunc of a post's date to `unit`-second buckets, or None if they would not line up with _bucket_expr"""
+    if (DATE_TRUNC_ORIGIN - offset) % unit:
+        return None
+    return {"$dateTrunc": {"date": date_expr("reddit"), "unit": "minute", "binSize": unit // MINUTE}}
+
+def _bucket_key(value):
+    """Bucket start in epoch seconds, from either kind of bucket expression"""
+    return to_timestamp(value) if isinstance(value, datetime) else int(value)
+
+def _count_fields(value):
+    """$group accumulators counting each sentiment label in `value`"""
+    return {
+        name: {"$sum": {"$cond": [{"$eq": ["$sentiment_label", label]}, value, 0]}}
+        for label, name in SENTIMENT_FIELDS.items()
+    }
+
+
+# Unique key for upserts and $merge; also serves range scans per keyword
+ROLLUP_KEY = [("unit", 1), ("keyword", 1), ("bucket", 1), ("subreddit", 1)]
+register_index("sentiment_rollups", ROLLUP_KEY, unique=True)
+register_query("sentiment_rollups", {"unit": "hour", "keyword": {"$in": ["tsla"]}, "bucket": {"$gte": 0, "$lt": 3600}})
+register_query("reddit", {"keyword": {"$in": ["tsla"]}, "created_utc": {"$gte": 0, "$lt": 60}})
+
+
+async def sentiment_counts(db, keyword_list, subreddit, start_ts, end_ts, unit, offset=0, by=()):
+    """
+    Sentiment counts for posts with `start_ts <= created_utc < end_ts`,
+    grouped into `unit`-second buckets starting at `offset` past the epoch.
+    `unit` and `offset` must be whole minutes.
+
+    Whole minutes inside the covered range are read from the rollups (whole
+    hours from the hourly rollups when buckets are hour-aligned); the ragged
+    edges and anything not covered yet go through the raw pipeline.
+    Returns {bucket_start: {field: count}}, or with `by` (a tuple of
+    "keyword"/"subreddit") {(bucket_start, *values): {field: count}}.
+    """
+    def group_id(bucket):
+        if not by:
+            return bucket
+        return {"bucket": bucket, **{name: f"${name}" for name in by}}
+
+    state = await db.rollup_state.find_one({"_id": STATE_ID})
+
+    # Covered segment [lo, hi), aligned to minutes
+    lo = hi = start_ts
+    if state and not state.get("rebuilding"):
+        lo = max(_ceil(start_ts, MINUTE), state["covered_from"])
+        hi = min(_floor(end_ts, MINUTE), _floor(state["covered_until"], MINUTE))
+    if lo >= hi:
+        lo = hi = end_ts
+
+    queries = []
+
+    if lo < hi:
+        # Whole hours come from hourly rollups when they don't need splitting
+        hours_lo, hours_hi = lo, lo
+        hour_aligned = unit % HOUR == 0 and offset % HOUR == 0
+        if hour_aligned and _ceil(lo, HOUR) < _floor(hi, HOUR):
+            hours_lo, hours_hi = _ceil(lo, HOUR), _floor(hi, HOUR)
+        ranges = [
+            {"unit": "hour", "bucket": {"$gte": hours_lo, "$lt": hours_hi}},
+            {"unit": "minute", "bucket": {"$gte": lo, "$lt": hours_lo}},
+            {"unit": "minute", "bucket": {"$gte": hours_hi, "$lt": hi}},
+        ]
+        match = {
+            "keyword": {"$in": keyword_list},
+            "$or": [r for r in ranges if r["bucket"]["$gte"] < r["bucket"]["$lt"]],
+        }
+        if subreddit:
+            match["subreddit"] = subreddit
+        pipeline = [
+            {"$match": match},
+            {"$group": {
+                "_id": group_id(_bucket_expr("$bucket", unit, offset)),
+                **{name: {"$sum": f"${name}"} for name in SENTIMENT_FIELDS.values()}
+            }}
+        ]
+        queries.append(db.sentiment_rollups.aggregate(pipeline).to_list(length=None))
+
+    # Raw pipeline for [start_ts, lo) and [hi, end_ts)
+    raw_ranges = [(a, b) for a, b in ((start_ts, lo), (hi, end_ts)) if a < b]
+    if raw_ranges:
+        date_bucket = _date_bucket_expr(unit, offset)
+        if date_bucket and await backfilled(db, "reddit"):
+            # Indexed dates, with created_utc for posts that have no date yet
+            branches = [
+                branch for a, b in raw_ranges
+                for branch in dual_range("reddit", {"$gte": to_date(a), "$lt": to_date(b)}, {"$gte": a, "$lt": b})
+            ]
+            bucket = date_bucket
+        else:
+            branches = [{"created_utc": {"$gte": a, "$lt": b}} for a, b in raw_ranges]
+            bucket = _bucket_expr("$created_utc", unit, offset)
+        match = {"keyword": {"$in": keyword_list}, "$or": branches}
+        if subreddit:
+            match["subreddit"] = subreddit
+        pipeline = [
+            {"$match": match},
+            # Count a post once per requested keyword it has, as the rollups do
+            {"$unwind": "$keyword"},
+            {"$match": {"keyword": {"$in": keyword_list}}},
+            {"$group": {"_id": group_id(bucket), **_count_fields(1)}}
+        ]
+        queries.append(db.reddit.aggregate(pipeline).to_list(length=None))
+
+    counts = defaultdict(lambda: dict.fromkeys(SENTIMENT_FIELDS.values(), 0))
+    for results in await asyncio.gather(*queries):
+        for result in results:
+            if by:
+                key = (_bucket_key(result["_id"]["bucket"]), *(result["_id"].get(name) for name in by))
+            else:
+                key = _bucket_key(result["_id"])
+            bucket = counts[key]
+            for name in SENTIMENT_FIELDS.values():
+                bucket[name] += result[name]
+    return dict(counts)
+
+
+def _increments(posts):
+    """Rollup upserts for a batch of newly inserted posts"""
+    increments = defaultdict(lambda: defaultdict(int))
+    for post in posts:
+        name = SENTIMENT_FIELDS.get(post.get("sentiment_label"))
+        if name is None or post.get("created_utc") is None:
+            continue
+        # A post can carry several keywords, as in PostHub.routing_keys
+        keywords = post.get("keyword")
+        if not isinstance(keywords, list):
+            keywords = [keywords]
+        for keyword in keywords:
+            for unit_name, unit in UNITS.items():
+                key = (unit_name, keyword, post.get("subreddit"), _floor(post["created_utc"], unit))
+                increments[key][name] += 1
+
+    return [
+        UpdateOne(
+            {"unit": unit_name, "keyword": keyword, "subreddit": subreddit, "bucket": bucket},
+            {"$inc": dict(inc)},
+            upsert=True
+        )
+        for (unit_name, keyword, subreddit, bucket), inc in increments.items()
+    ]
+
+
+async def _follow_step(db):
+    """Fold the next batch of new posts into the rollups; True once caught up"""
+    state = await db.rollup_state.find_one({"_id": STATE_ID})
+    polled_at = time.time()
+
+    if state is None:
+        # Start from now; older buckets stay on the raw pipeline until a rebuild
+        latest = await db.reddit.find_one({}, {"_id": 1}, sort=[("_id", -1)])
+        await db.rollup_state.update_one(
+            {"_id": STATE_ID},
+            {"$setOnInsert": {
+                "watermark": latest["_id"] if latest else None,
+                "covered_from": _ceil(polled_at, HOUR),
+                "covered_until": polled_at,
+                "rebuilding": False
+            }},
+            upsert=True
+        )
+        return False
+    if state.get("rebuilding"):
+        return True
+
+    watermark = state["watermark"]
+    query = {"_id": {"$gt": watermark}} if watermark is not None else {}
+    projection = {"keyword": 1, "subreddit": 1, "created_utc": 1, "sentiment_label": 1}
+    posts = await db.reddit.find(query, projection).sort("_id", 1).limit(FOLLOW_BATCH_SIZE).to_list(length=FOLLOW_BATCH_SIZE)
+
+    caught_up = len(posts) < FOLLOW_BATCH_SIZE
+    updates = _increments(posts)
+
+    # Claim the batch before applying it: of two followers that read the same
+    # watermark, or a follower racing a rebuild, only one wins the compare-and-swap.
+    # A follower dying between claim and apply loses that batch until the next rebuild.
+    if posts:
+        claimed = await db.rollup_state.update_one(
+            {"_id": STATE_ID, "watermark": watermark, "rebuilding": False},
+            {"$set": {"watermark": posts[-1]["_id"]}, "$inc": {"applying": 1 if updates else 0}}
+        )
+        if claimed.matched_count == 0:
+            return False
+
+    if updates:
+        try:
+            await db.sentiment_rollups.bulk_write(updates, ordered=False)
+        finally:
+            await db.rollup_state.update_one({"_id": STATE_ID}, {"$inc": {"applying": -1}})
+
+    # Only once the increments are in, so readers never trust buckets still missing them
+    if caught_up:
+        await db.rollup_state.update_one(
+            {"_id": STATE_ID, "rebuilding": False, "covered_until": {"$lt": polled_at}},
+            {"$set": {"covered_until": polled_at}}
+        )
+    return caught_up
+
+
+async def follow():
+    """Keep the rollups up to date with new posts until cancelled"""
+    db = get_db()
+    while True:
+        try:
+            caught_up = await _follow_step(db)
+        except asyncio.CancelledError:
+            raise
+        except PyMongoError as e:
+            print(f"Sentiment rollup follower interrupted, retrying: {e}")
+            await asyncio.sleep(RETRY_DELAY)
+            continue
+        if caught_up:
+            await asyncio.sleep(FOLLOW_INTERVAL)
+
+
+def rebuild(db, since: datetime = None):
+    """
+    Recompute all rollups from the raw `reddit` collection (blocking).
+
+    With `since`, only posts from that hour onwards are rolled up and older
+    buckets are left to the raw pipeline.
+    """
+    db.rollup_state.update_one({"_id": STATE_ID}, {"$set": {"rebuilding": True}}, upsert=True)
+
+    # A follower may still be applying a batch it claimed before the flag was set
+    deadline = time.time() + APPLY_GRACE
+    while time.time() < deadline:
+        state = db.rollup_state.find_one({"_id": STATE_ID})
+        if state.get("applying", 0) <= 0:
+            break
+        time.sleep(0.1)
+    started_at = time.time()
+
+    latest = db.reddit.find_one({}, {"_id": 1}, sort=[("_id", -1)])
+    covered_from = _floor(utc_timestamp(since), HOUR) if since else 0
+
+    db.sentiment_rollups.delete_many({})
+    db.sentiment_rollups.create_index(ROLLUP_KEY, unique=True)
+
+    if latest:
+        match = {
+            "_id": {"$lte": latest["_id"]},
+            "sentiment_label": {"$in": list(SENTIMENT_FIELDS)}
+        }
+        if since:
+            match["created_utc"] = {"$gte": covered_from}
+        for unit_name, unit in UNITS.items():
+            db.reddit.aggregate([
+                {"$match": match},
+                # One bucket per keyword of posts that have several, as the follower does
+                {"$unwind": "$keyword"},
+                {"$group": {
+                    "_id": {
+                        "keyword": "$keyword",
+                        "subreddit": "$subreddit",
+                        "bucket": _bucket_expr("$created_utc", unit)
+                    },
+                    **_count_fields(1)
+                }},
+                {"$project": {
+                    "_id": 0,
+                    "unit": {"$literal": unit_name},
+                    "keyword": "$_id.keyword",
+                    "subreddit": {"$ifNull": ["$_id.subreddit", None]},
+                    "bucket": {"$toLong": "$_id.bucket"},
+                    **{name: 1 for name in SENTIMENT_FIELDS.values()}
+                }},
+                {"$merge": {
+                    "into": "sentiment_rollups",
+                    "on": ["unit", "keyword", "bucket", "subreddit"],
+                    "whenMatched": "replace",
+                    "whenNotMatched": "insert"
+                }}
+            ], allowDiskUse=True)
+
+    db.rollup_state.replace_one(
+        {"_id": STATE_ID},
+        {
+            "watermark": latest["_id"] if latest else None,
+            "covered_from": covered_from,
+            "covered_until": started_at,
+            "rebuilding": False
+        },
+        upsert=True
+    )
+
+
+if __name__ == "__main__":
+    import argparse
+    from dotenv import load_dotenv
+    from .database import init_db, get_sync_db
+
+    load_dotenv()
+    parser = argparse.ArgumentParser(description="Maintain the sentiment rollup collection")
+    subcommands = parser.add_subparsers(dest="command", required=True)
+    rebuild_parser = subcommands.add_parser("rebuild", help="Recompute rollups from raw posts")
+    rebuild_parser.add_argument("--since", type=datetime.fromisoformat, default=None)
+    subcommands.add_parser("follow", help="Keep rollups up to date with new posts")
+    args = parser.parse_args()
+
+    init_db(os.getenv("MONGO_URI"), os.getenv("MONGO_DB"))
+    if args.command == "rebuild":
+        rebuild(get_sync_db(), args.since)
+    else:
+        asyncio.run(follow())
@@ -1,62 +1,318 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import HTTPException
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
-import openai
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient
+from ..cache import TTLCache
+from ..serialization import dumps_text
+from ..metrics import openai_duration
+import asyncio
+import hashlib
 import os
-from typing import List
-from fastapi import APIRouter, WebSocket, WebSocketDisconnect, Query
+import re
+import time
+import uuid
+from typing import List, Optional
+from fastapi import APIRouter
 import json
 
 router = APIRouter()
 
-# Setup OpenAI client
-openai.api_key = os.getenv("OPENAI_API_KEY")
+# OpenAI client, created on first use; OPENAI_BASE_URL can point it at a local fake server
+client = None
 assistant_id = os.getenv("OPENAI_ASSISTANT_ID")
 
+# Cap on assistant runs in flight per worker; requests wait up to LLM_QUEUE_TIMEOUT for a slot
+LLM_MAX_CONCURRENT_RUNS = int(os.getenv("LLM_MAX_CONCURRENT_RUNS", "8"))
+LLM_QUEUE_TIMEOUT = float(os.getenv("LLM_QUEUE_TIMEOUT", "10"))
+LLM_RUN_TIMEOUT = float(os.getenv("LLM_RUN_TIMEOUT", "120"))
+run_slots = asyncio.Semaphore(LLM_MAX_CONCURRENT_RUNS)
+
+# Run status polling backs off from the initial to the maximum delay
+POLL_INITIAL_DELAY = 0.25
+POLL_MAX_DELAY = 2.0
+TERMINAL_RUN_STATUSES = {"completed", "failed", "cancelled", "expired", "incomplete", "requires_action"}
+# Streamed events that end a run without an answer; a run requiring action is still open and gets cancelled
+FAILED_RUN_EVENTS = {
+    "thread.run.failed", "thread.run.cancelled", "thread.run.expired",
+    "thread.run.incomplete", "thread.run.requires_action",
+}
+
+# Conversation sessions, each backed by one assistant thread that only gets new messages appended
+LLM_SESSION_TTL = float(os.getenv("LLM_SESSION_TTL", "3600"))
+sessions = TTLCache(maxsize=10000, ttl=LLM_SESSION_TTL)
+
+# Responses by normalized conversation + assistant, for repeated questions
+LLM_CACHE_SIZE = int(os.getenv("LLM_CACHE_SIZE", "1024"))
+LLM_CACHE_TTL = float(os.getenv("LLM_CACHE_TTL", "300"))
+response_cache = TTLCache(maxsize=LLM_CACHE_SIZE, ttl=LLM_CACHE_TTL)
+
 class ChatMessage(BaseModel):
     role: str
     content: str
 
 class ChatRequest(BaseModel):
     messages: List[ChatMessage]
+    session_id: Optional[str] = None
 
 class ChatResponse(BaseModel):
     response: str
+    session_id: Optional[str] = None
+
+class ChatSession:
+    """An assistant thread and the conversation it already holds"""
+
+    def __init__(self):
+        self.thread_id = None
+        self.length = 0
+        self.digest = None
+        self.lock = asyncio.Lock()
+
+    def hold(self, messages: List[ChatMessage]):
+        """Record that the thread now holds `messages`"""
+        self.length = len(messages)
+        self.digest = conversation_digest(messages)
+
+    def remember(self, messages: List[ChatMessage], reply: str):
+        self.hold(messages + [ChatMessage(role="assistant", content=reply)])
+
+def conversation_digest(messages: List[ChatMessage]) -> str:
+    """Hash of the conversation, ignoring case of roles and differences in whitespace"""
+    normalized = [(m.role.lower(), " ".join(m.content.split())) for m in messages]
+    return hashlib.sha256(json.dumps(normalized).encode()).hexdigest()
+
+def get_session(session_id: Optional[str]):
+    """The session for session_id, or a new one (under that id, if given)"""
+    session_id = session_id or uuid.uuid4().hex
+    session = sessions.get(session_id)
+    if session is None:
+        session = ChatSession()
+    # Re-set to refresh the TTL on every turn
+    sessions.set(session_id, session)
+    return session_id, session
+
+async def sync_thread(session: ChatSession, messages: List[ChatMessage]):
+    """Append to the session's thread the messages it doesn't hold yet"""
+    held = messages[:session.length]
+    if session.thread_id is None or len(held) < session.length or conversation_digest(held) != session.digest:
+        # New session, or the client's history no longer matches the thread: start a thread with all of it
+        thread = await get_client().beta.threads.create(
+            messages=[{"role": m.role, "content": m.content} for m in messages]
+        )
+        session.thread_id = thread.id
+        session.hold(messages)
+        return
+
+    # Recorded as each message is posted, not after the run: a retry after a failed
+    # run or a failed append must not post the same messages again
+    for i in range(session.length, len(messages)):
+        await get_client().beta.threads.messages.create(
+            thread_id=session.thread_id,
+            role=messages[i].role,
+            content=messages[i].content
+        )
+        session.hold(messages[:i + 1])
+
+# OpenAI object ids in request paths, replaced so that timings group by endpoint
+OPENAI_ID = re.compile(r"/[a-z]+_[A-Za-z0-9]+")
+
+async def start_timer(request):
+    request.extensions["started_at"] = time.perf_counter()
+
+async def record_timing(response):
+    """Time to response headers of every OpenAI call, grouped by method and path with ids masked"""
+    request = response.request
+    operation = f"{request.method} {OPENAI_ID.sub('/{id}', request.url.path)}"
+    openai_duration.observe(time.perf_counter() - request.extensions["started_at"], operation)
+
+def get_client() -> AsyncOpenAI:
+    global client
+    if client is None:
+        client = AsyncOpenAI(
+            api_key=os.getenv("OPENAI_API_KEY"),
+            http_client=DefaultAsyncHttpxClient(event_hooks={"request": [start_timer], "response": [record_timing]})
+        )
+    return client
+
+async def acquire_run_slot():
+    try:
+        await asyncio.wait_for(run_slots.acquire(), timeout=LLM_QUEUE_TIMEOUT)
+    except asyncio.TimeoutError:
+        raise HTTPException(status_code=503, detail="Too many chats in progress, please retry shortly")
+
+async def wait_for_run(thread_id: str, run):
+    """Poll a run with exponential backoff until it reaches a terminal status"""
+    delay = POLL_INITIAL_DELAY
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + LLM_RUN_TIMEOUT
+    while run.status not in TERMINAL_RUN_STATUSES:
+        if loop.time() >= deadline:
+            await get_client().beta.threads.runs.cancel(thread_id=thread_id, run_id=run.id)
+            raise HTTPException(status_code=504, detail="Assistant run timed out")
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, POLL_MAX_DELAY)
+        run = await get_client().beta.threads.runs.retrieve(thread_id=thread_id, run_id=run.id)
+    if run.status != "completed":
+        raise HTTPException(status_code=502, detail=f"Assistant run ended with status '{run.status}'")
+    return run
 
 @router.post("/chat/", response_model=ChatResponse)
 async def chat_with_assistant(chat_request: ChatRequest):
-    try:
-        # Create a thread
-        thread = openai.beta.threads.create()
-
-        # Add messages to the thread
-        for message in chat_request.messages:
-            openai.beta.threads.messages.create(
-                thread_id=thread.id,
-                role=message.role,
-                content=message.content
-            )
+    """
+    Get the assistant's answer to a conversation.
 
-        # Run the assistant
-        run = openai.beta.threads.runs.create(
-            thread_id=thread.id,
-            assistant_id=assistant_id
-        )
+    Send the whole conversation in `messages`. Pass the returned `session_id` back on the
+    next turn (with the previous answer appended to `messages`) and only the new messages
+    are added to the session's thread. Identical conversations within LLM_CACHE_TTL
+    are answered from a cache.
+    """
+    cache_key = (assistant_id, conversation_digest(chat_request.messages))
+    cached = response_cache.get(cache_key)
+    if cached is not None:
+        return ChatResponse(response=cached, session_id=chat_request.session_id)
 
-        # Wait for the run to complete
-        while run.status != "completed":
-            run = openai.beta.threads.runs.retrieve(
-                thread_id=thread.id,
-                run_id=run.id
+    await acquire_run_slot()
+    try:
+        session_id, session = get_session(chat_request.session_id)
+        async with session.lock:
+            # Bring the session's thread up to date with the messages
+            await sync_thread(session, chat_request.messages)
+
+            # Run the assistant and wait for the run to complete
+            run = await get_client().beta.threads.runs.create(
+                thread_id=session.thread_id,
+                assistant_id=assistant_id
             )
+            with openai_duration.time("run"):
+                await wait_for_run(session.thread_id, run)
+
+            # Retrieve the newest message
+            messages = await get_client().beta.threads.messages.list(thread_id=session.thread_id, limit=1)
 
-        # Retrieve the messages
-        messages = openai.beta.threads.messages.list(thread_id=thread.id)
+            # Extract the assistant's response
+            assistant_response = messages.data[0].content[0].text.value
+            session.remember(chat_request.messages, assistant_response)
 
-        # Extract the assistant's response
-        assistant_response = messages.data[0].content[0].text.value
-        response = ChatResponse(response=assistant_response)
+        response_cache.set(cache_key, assistant_response)
+        response = ChatResponse(response=assistant_response, session_id=session_id)
 
         return response
 
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
+    finally:
+        run_slots.release()
+
+# Stream cleanups in flight, referenced so they are not garbage collected before they finish
+cleanups = set()
+
+async def end_stream(stream, thread_id: str, run_id: Optional[str], ended: bool):
+    """Close a run's event stream, cancelling the run unless it already ended"""
+    try:
+        await stream.close()
+    finally:
+        if run_id is not None and not ended:
+            try:
+                await get_client().beta.threads.runs.cancel(thread_id=thread_id, run_id=run_id)
+            except Exception as e:
+                print(f"Could not cancel assistant run {run_id}: {e}")
+
+async def shielded(coroutine):
+    """Run `coroutine` to completion even if the caller is cancelled meanwhile"""
+    task = asyncio.create_task(coroutine)
+    cleanups.add(task)
+    task.add_done_callback(cleanups.discard)
+    await asyncio.shield(task)
+
+def sse_event(data: dict, event: str = None) -> str:
+    prefix = f"event: {event}\n" if event else ""
+    return f"{prefix}data: {dumps_text(data)}\n\n"
+
+@router.post("/chat/stream")
+async def stream_chat_with_assistant(chat_request: ChatRequest):
+    """
+    Streaming variant of /chat/ using Server-Sent Events.
+
+    Takes the same body as /chat/, with the same sessions and response cache, and forwards
+    the assistant's answer as it is generated:
+    - `data: {"delta": "..."}` for each piece of text
+    - `event: done` with `data: {"response": "...", "session_id": "..."}` at the end
+    - `event: error` with `data: {"detail": "..."}` if the run does not complete (it fails,
+      ends incomplete or requires action, as /chat/ answers 502) or takes longer than
+      LLM_RUN_TIMEOUT seconds; nothing is cached or added to the session then
+    - `event: error` as well if no run slot frees up within LLM_QUEUE_TIMEOUT seconds, where
+      /chat/ answers 503
+
+    The run is cancelled if it times out or the client disconnects before it ends.
+    """
+    cache_key = (assistant_id, conversation_digest(chat_request.messages))
+    cached = response_cache.get(cache_key)
+    if cached is not None:
+        async def replay():
+            yield sse_event({"delta": cached})
+            yield sse_event({"response": cached, "session_id": chat_request.session_id}, "done")
+        return StreamingResponse(replay(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+    async def events():
+        # Take the slot inside the generator so it is released however the stream ends;
+        # as in /chat/, waiting up to LLM_QUEUE_TIMEOUT for one
+        try:
+            await acquire_run_slot()
+        except HTTPException as e:
+            yield sse_event({"detail": e.detail}, "error")
+            return
+        try:
+            session_id, session = get_session(chat_request.session_id)
+            async with session.lock:
+                await sync_thread(session, chat_request.messages)
+                stream = await get_client().beta.threads.runs.create(
+                    thread_id=session.thread_id,
+                    assistant_id=assistant_id,
+                    stream=True
+                )
+                # The run is cancelled if it times out or the client goes away before it ends
+                run_id, ended = None, False
+                try:
+                    parts = []
+                    loop = asyncio.get_running_loop()
+                    deadline = loop.time() + LLM_RUN_TIMEOUT
+                    run_events = stream.__aiter__()
+                    while True:
+                        try:
+                            event = await asyncio.wait_for(run_events.__anext__(), timeout=max(deadline - loop.time(), 0))
+                        except StopAsyncIteration:
+                            break
+                        except asyncio.TimeoutError:
+                            yield sse_event({"detail": "Assistant run timed out"}, "error")
+                            return
+                        if event.event == "thread.run.created":
+                            run_id = event.data.id
+                        elif event.event == "thread.message.delta":
+                            for block in event.data.delta.content or []:
+                                if block.type == "text" and block.text and block.text.value:
+                                    parts.append(block.text.value)
+                                    yield sse_event({"delta": block.text.value})
+                        elif event.event == "thread.run.completed":
+                            ended = True
+                        elif event.event in FAILED_RUN_EVENTS:
+                            ended = event.event != "thread.run.requires_action"
+                            yield sse_event({"detail": f"Assistant run ended with status '{event.data.status}'"}, "error")
+                            return
+                    if not ended:
+                        yield sse_event({"detail": "Assistant run stream ended before the run completed"}, "error")
+                        return
+                finally:
+                    # A client disconnect cancels this generator, and with it any await in here
+                    await shielded(end_stream(stream, session.thread_id, run_id, ended))
+                assistant_response = "".join(parts)
+                session.remember(chat_request.messages, assistant_response)
+
+            response_cache.set(cache_key, assistant_response)
+            yield sse_event({"response": assistant_response, "session_id": session_id}, "done")
+        except Exception as e:
+            yield sse_event({"detail": str(e)}, "error")
+        finally:
+            run_slots.release()
+
+    return StreamingResponse(events(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
@@ -1,17 +1,33 @@
 from fastapi import APIRouter, WebSocket, WebSocketDisconnect, Query
 from ..database import get_db
-import json
+from ..export import export_response, utc
+from ..hub import Hub, Subscriber, encode_cursor, decode_cursor, at_capacity
+from ..indexes import register_index, register_query
+from ..serialization import encode_item, encode_batch
 from datetime import datetime, timezone
 from typing import List, Optional
 
 router = APIRouter()
 
+register_index("stock_news", [("insights.ticker", 1), ("published_utc", 1)])
+register_query("stock_news", {"insights.ticker": {"$in": ["AAPL"]}}, sort=[("published_utc", -1)])
+register_query("stock_news", {"insights.ticker": {"$in": ["AAPL"]}, "published_utc": {"$gte": "2024-01-01"}}, sort=[("published_utc", 1), ("_id", 1)])
+register_query("stock_news", {"insights.ticker": {"$in": ["AAPL"]}, "published_utc": {"$gte": "2024-01-01", "$lt": "2024-02-01"}}, sort=[("published_utc", 1)])
+
+# Columns of CSV exports
+NEWS_COLUMNS = (
+    "_id", "published_utc", "title", "author", "publisher", "article_url", "image_url",
+    "description", "tickers", "keywords", "sentiment", "sentiment_reasoning",
+)
+
+def published(value: datetime) -> str:
+    """A datetime as stored in `published_utc` (e.g. 2024-01-31T14:05:00Z), which compares as a string"""
+    return utc(value).strftime("%Y-%m-%dT%H:%M:%SZ")
+
 def format_news(news, requested_tickers):
     """Helper function to format a single news article with sentiment"""
     formatted = dict(news)
-    formatted['_id'] = str(formatted['_id'])
-    formatted['published_utc'] = formatted['published_utc']
-    formatted['fetched_at'] = formatted['fetched_at']
+    formatted['cursor'] = encode_cursor(news['published_utc'], news['_id'])
     
     # Extract sentiment for requested tickers
     formatted['ticker_sentiment'] = {}
@@ -24,62 +40,186 @@ def format_news(news, requested_tickers):
     
     return formatted
 
+class PreparedArticle:
+    """A news article formatted once, with its encoding cached per ticker sentiment and wire format"""
+
+    def __init__(self, article):
+        self.id = article['_id']
+        self.tickers = [insight['ticker'] for insight in article.get('insights', [])]
+        self.sentiments = {
+            insight['ticker']: {
+                'sentiment': insight['sentiment'],
+                'sentiment_reasoning': insight['sentiment_reasoning']
+            }
+            for insight in article.get('insights', [])
+        }
+        self.formatted = format_news(article, ())
+        self._encoded = {}
+
+    def encoded_for(self, requested_tickers, format="json"):
+        """This article as seen by a client tracking `requested_tickers`"""
+        # Same rule as format_news: the last matching insight wins
+        ticker = next((t for t in reversed(self.tickers) if t in requested_tickers), None)
+        if (ticker, format) not in self._encoded:
+            formatted = dict(self.formatted)
+            formatted['ticker_sentiment'] = self.sentiments.get(ticker, {})
+            self._encoded[(ticker, format)] = encode_item(format, formatted)
+        return self._encoded[(ticker, format)]
+
+class NewsHub(Hub):
+    """Routes new `stock_news` articles to subscribers of any ticker in their insights"""
+
+    collection = "stock_news"
+    timestamp_field = "published_utc"
+
+    def prepare(self, article):
+        return PreparedArticle(article)
+
+    def item_id(self, article):
+        return article.id
+
+    def routing_keys(self, article):
+        return set(article.tickers)
+
+    def encode(self, subscriber, articles):
+        return encode_batch(subscriber.format, [a.encoded_for(subscriber.keys, subscriber.format) for a in articles])
+
+hub = NewsHub()
+
 @router.websocket("/ws/ticker_news")
 async def websocket_news(
     websocket: WebSocket, 
     tickers: str = Query(..., description="Comma-separated list of stock tickers"),
-    limit: int = Query(100, description="Number of news articles to fetch per request")
+    limit: int = Query(100, description="Number of news articles to send on connect"),
+    format: str = Query("json", pattern="^(json|msgpack)$", description="Wire format: json or msgpack"),
+    since: Optional[str] = Query(None, description="Cursor of the last article received, to resume from")
 ):
     """
     WebSocket endpoint for receiving live news for multiple stock tickers.
     
     This endpoint allows clients to connect via WebSocket and receive updates on news articles
-    related to any of the specified stock tickers. The server will send only new articles since the last message.
+    related to any of the specified stock tickers. On connect the server sends the latest articles
+    (oldest first), then pushes every new article mentioning one of the tickers as soon as it is inserted.
     Each article includes a 'ticker_sentiment' field with sentiment information for the requested tickers.
     
     To use this endpoint:
     1. Connect to ws://your-server-address/ws/ticker_news?tickers=AAPL,GOOGL,MSFT
-    2. Send any message to request an update
-    3. Receive JSON data containing the latest news articles for any of the specified tickers
+    2. Receive JSON data containing the latest news articles for any of the specified tickers
+    3. Keep the connection open to receive new articles as JSON lists; messages sent by the
+       client are treated as keep-alives
+    4. After a disconnect, reconnect with since=<cursor of the last article received>
+    
+    Every article has an opaque `cursor`. Reconnecting with `since` sends only the articles
+    after that cursor (oldest first, in frames of FEED_BACKFILL_BATCH_SIZE) instead of the
+    latest `limit` articles. If more than FEED_BACKFILL_LIMIT were missed, the latest articles
+    are sent as on a fresh connect.
     
     Query parameters:
     - tickers: Comma-separated list of stock tickers to track (required)
-    - limit: Number of news articles to fetch per request (default: 100)
+    - limit: Number of news articles to send on connect (default: 100)
+    - format: "json" (default, text frames) or "msgpack" (binary frames, each one a msgpack
+      array of articles with the same fields as the JSON)
+    - since: Cursor to resume from (optional); an invalid cursor closes the socket with code 1008
+
+    Connections over FEED_MAX_CONNECTIONS per worker are closed with code 1013 (try again later).
+    A client that falls behind loses pending messages, or is disconnected with code
+    1008, depending on FEED_OVERFLOW_POLICY.
+
+    permessage-deflate compression is used when the client offers it.
     
     Note: This endpoint is not testable via Swagger UI. Use a WebSocket client to interact with it.
     """
+    # Accept first: a close before the handshake reaches the client as an HTTP 403, not as the close code
     await websocket.accept()
-    db = get_db()
-    last_timestamp = datetime.min.replace(tzinfo=timezone.utc).isoformat()
+    try:
+        position = decode_cursor(since) if since else None
+    except ValueError:
+        await websocket.close(code=1008, reason="Invalid cursor")
+        return
+    if at_capacity():
+        await websocket.close(code=1013, reason="Too many connections")
+        return
+    db = get_db("analytics")
     
     # Split the tickers string into a list
     ticker_list = [t.strip().upper() for t in tickers.split(',')]
+
+    # Subscribe before taking the snapshot so nothing inserted in between is lost
+    subscriber = Subscriber(websocket, ticker_list, format)
+    hub.subscribe(subscriber)
     
     try:
-        while True:
-            # Prepare the query
-            query = {
-                "insights.ticker": {"$in": ticker_list},
-                "published_utc": {"$gt": last_timestamp}
-            }
+        query = {"insights.ticker": {"$in": ticker_list}}
+
+        # Send what the client missed since its cursor, if that is not too much
+        pages = await hub.backfill(db, query, position) if position else None
+        sent_ids = []
+        if pages is not None:
+            async for page in pages:
+                page = [PreparedArticle(a) for a in page]
+                await hub.send(subscriber, page)
+                sent_ids.extend(a.id for a in page)
+        else:
+            # Fetch the latest news articles for any of the specified tickers, oldest first in cursor
+            # order like everything after them, so the last cursor received is the one to resume from
+            latest_articles = await db.stock_news.find(query).sort("published_utc", -1).limit(limit).to_list(length=limit)
+            latest_articles.sort(key=lambda a: (a['published_utc'], a['_id']))
+            latest_articles = [PreparedArticle(a) for a in latest_articles]
+            await hub.send(subscriber, latest_articles)
+            sent_ids = [a.id for a in latest_articles]
 
-            # Fetch new news articles from the database for any of the specified tickers
-            new_articles = list(db.stock_news.find(query).sort("published_utc", -1).limit(limit))
-            
-            if new_articles:
-                # Update the last timestamp
-                last_timestamp = new_articles[0]["published_utc"]
-                
-                # Format news articles
-                formatted_articles = [format_news(a, ticker_list) for a in new_articles]
-                
-                # Send the new articles to the client
-                await websocket.send_text(json.dumps(formatted_articles))
-            else:
-                # If no new articles, send an empty list
-                await websocket.send_text(json.dumps([]))
-            
-            # Wait for a message from the client (you can adjust the logic here)
-            _ = await websocket.receive_text()
+        # Push new articles from the shared hub until the client goes away
+        await hub.serve(subscriber, skip_ids=sent_ids)
     except WebSocketDisconnect:
-        print(f"Client disconnected from multi-ticker news feed")
\ No newline at end of file
+        print(f"Client disconnected from multi-ticker news feed")
+    finally:
+        hub.unsubscribe(subscriber)
+
+@router.get("/export")
+async def export_news(
+    tickers: str = Query(..., description="Comma-separated list of stock tickers"),
+    start_time: Optional[datetime] = None,
+    end_time: Optional[datetime] = None,
+    format: str = Query("ndjson", pattern="^(ndjson|csv)$", description="ndjson or csv")
+):
+    """
+    Export every news article for the tickers, oldest first, as a streamed download.
+
+    Unlike the feeds there is no cap on the number of articles: they are read from a
+    server-side cursor in batches of EXPORT_BATCH_SIZE and streamed as they come,
+    so any time range can be exported with constant memory.
+
+    Query parameters:
+    - tickers: Comma-separated list of stock tickers (required)
+    - start_time: Only articles published at or after this time, UTC if no timezone is given (optional)
+    - end_time: Only articles published before this time (optional)
+    - format: "ndjson" (default, one article per line, same fields as the feed) or "csv"
+      (the NEWS_COLUMNS fields, with the publisher name, the tickers comma-separated
+      and the sentiment for the requested tickers)
+    """
+    db = get_db("analytics")
+    ticker_list = [t.strip().upper() for t in tickers.split(',')]
+
+    # A single range on the (insights.ticker, published_utc) index also yields the
+    # sort order, so the export streams without a blocking sort
+    query = {"insights.ticker": {"$in": ticker_list}}
+    if start_time or end_time:
+        query["published_utc"] = {}
+        if start_time:
+            query["published_utc"]["$gte"] = published(start_time)
+        if end_time:
+            query["published_utc"]["$lt"] = published(end_time)
+
+    def csv_row(article):
+        formatted = format_news(article, ticker_list)
+        return {
+            **formatted,
+            "publisher": (formatted.get("publisher") or {}).get("name"),
+            "tickers": ",".join(formatted.get("tickers") or []),
+            "keywords": ",".join(formatted.get("keywords") or []),
+            **formatted["ticker_sentiment"],
+        }
+
+    row = csv_row if format == "csv" else lambda article: format_news(article, ticker_list)
+    cursor = db.stock_news.find(query).sort("published_utc", 1)
+    return export_response(cursor, format, "news", NEWS_COLUMNS, row)
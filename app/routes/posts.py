@@ -1,75 +1,201 @@
 from fastapi import APIRouter, WebSocket, WebSocketDisconnect, Query
 from ..database import get_db
-import json
+from ..export import export_response, utc_timestamp
+from ..hub import Hub, Subscriber, encode_cursor, decode_cursor, at_capacity
+from ..indexes import register_index, register_query
+from ..serialization import encode_item, encode_batch
 from datetime import datetime, timezone
 from typing import List, Optional
 
 router = APIRouter()
 
+register_index("reddit", [("keyword", 1), ("created_utc", 1), ("subreddit", 1)])
+register_query("reddit", {"keyword": {"$in": ["tsla"]}, "subreddit": "wallstreetbets"}, sort=[("created_utc", -1)])
+register_query("reddit", {"keyword": {"$in": ["tsla"]}, "created_utc": {"$gte": 0}}, sort=[("created_utc", 1), ("_id", 1)])
+register_query("reddit", {"keyword": {"$in": ["tsla"]}, "created_utc": {"$gte": 0, "$lt": 60}}, sort=[("created_utc", 1)])
+
+# Columns of CSV exports; posts without one of the fields leave it empty
+POST_COLUMNS = (
+    "_id", "created_utc", "keyword", "subreddit", "author", "title", "selftext",
+    "url", "score", "num_comments", "sentiment_label",
+)
+
 def format_post(post):
     """Helper function to format a single post"""
-    formatted = dict(post)
-    formatted['_id'] = str(formatted['_id'])
-    formatted['created_utc'] = datetime.fromtimestamp(formatted['created_utc']).isoformat()
-    return formatted
+    return {
+        **post,
+        'created_utc': datetime.fromtimestamp(post['created_utc']).isoformat(),
+        'cursor': encode_cursor(post['created_utc'], post['_id'])
+    }
+
+class PreparedPost:
+    """A post with its encoding per wire format, computed once however many sockets it goes to"""
+
+    def __init__(self, post):
+        self.id = post['_id']
+        self.keyword = post.get('keyword')
+        self.subreddit = post.get('subreddit')
+        self.formatted = format_post(post)
+        self._encoded = {}
+
+    def encoded(self, format):
+        if format not in self._encoded:
+            self._encoded[format] = encode_item(format, self.formatted)
+        return self._encoded[format]
+
+class PostHub(Hub):
+    """Routes new `reddit` posts by (keyword, subreddit); `None` subreddit means any"""
+
+    collection = "reddit"
+    timestamp_field = "created_utc"
+
+    def prepare(self, post):
+        return PreparedPost(post)
+
+    def item_id(self, post):
+        return post.id
+
+    def routing_keys(self, post):
+        keywords = post.keyword
+        if isinstance(keywords, str):
+            keywords = [keywords]
+        for keyword in keywords or ():
+            yield (keyword, None)
+            yield (keyword, post.subreddit)
+
+    def encode(self, subscriber, posts):
+        return encode_batch(subscriber.format, [p.encoded(subscriber.format) for p in posts])
+
+hub = PostHub()
 
 @router.websocket("/ws/keyword_posts")
 async def websocket_posts(
     websocket: WebSocket, 
     keywords: str = Query(..., description="Comma-separated list of keywords"),
-    subreddit: Optional[str] = Query(None)
+    subreddit: Optional[str] = Query(None),
+    format: str = Query("json", pattern="^(json|msgpack)$", description="Wire format: json or msgpack"),
+    since: Optional[str] = Query(None, description="Cursor of the last post received, to resume from")
 ):
     """
     WebSocket endpoint for receiving live posts for multiple keywords.
     
     This endpoint allows clients to connect via WebSocket and receive updates on posts
-    containing any of the specified keywords. The server will send only new posts since the last message.
+    containing any of the specified keywords. On connect the server sends the latest posts
+    (oldest first), then pushes every new post matching the subscription as soon as it is inserted.
     
     To use this endpoint:
     1. Connect to ws://your-server-address/ws/keyword_posts?keywords=keyword1,keyword2,keyword3
-    2. Send any message to request an update
-    3. Receive JSON data containing the latest posts with any of the specified keywords
+    2. Receive JSON data containing the latest posts with any of the specified keywords
+    3. Keep the connection open to receive new posts as JSON lists; messages sent by the
+       client are treated as keep-alives
+    4. After a disconnect, reconnect with since=<cursor of the last post received>
+    
+    Every post has an opaque `cursor`. Reconnecting with `since` sends only the posts after
+    that cursor (oldest first, in frames of FEED_BACKFILL_BATCH_SIZE) instead of the latest
+    posts. If more than FEED_BACKFILL_LIMIT were missed, the latest posts are sent as on a
+    fresh connect.
     
     Query parameters:
     - keywords: Comma-separated list of keywords to track (required)
     - subreddit: Filter posts by subreddit (optional)
+    - format: "json" (default, text frames) or "msgpack" (binary frames, each one a msgpack
+      array of posts with the same fields as the JSON)
+    - since: Cursor to resume from (optional); an invalid cursor closes the socket with code 1008
+
+    Connections over FEED_MAX_CONNECTIONS per worker are closed with code 1013 (try again later).
+    A client that falls behind loses pending messages, or is disconnected with code
+    1008, depending on FEED_OVERFLOW_POLICY.
+
+    permessage-deflate compression is used when the client offers it.
     
     Note: This endpoint is not testable via Swagger UI. Use a WebSocket client to interact with it.
     """
+    # Accept first: a close before the handshake reaches the client as an HTTP 403, not as the close code
     await websocket.accept()
-    db = get_db()
-    last_timestamp = 0
+    try:
+        position = decode_cursor(since) if since else None
+    except ValueError:
+        await websocket.close(code=1008, reason="Invalid cursor")
+        return
+    if at_capacity():
+        await websocket.close(code=1013, reason="Too many connections")
+        return
+    db = get_db("analytics")
     
     # Split the keywords string into a list
     keyword_list = [k.strip().lower() for k in keywords.split(',')]
+
+    # Subscribe before taking the snapshot so nothing inserted in between is lost
+    subscriber = Subscriber(websocket, [(k, subreddit) for k in keyword_list], format)
+    hub.subscribe(subscriber)
     
     try:
-        while True:
-            # Prepare the query
-            query = {
-                "keyword": {"$in": keyword_list},
-                "created_utc": {"$gt": last_timestamp}
-            }
-            if subreddit:
-                query["subreddit"] = subreddit
-
-            # Fetch new posts from the database for any of the specified keywords
-            new_posts = list(db.reddit.find(query).sort("created_utc", -1).limit(100))
-            
-            if new_posts:
-                # Update the last timestamp
-                last_timestamp = new_posts[0]["created_utc"]
-                
-                # Format posts
-                formatted_posts = [format_post(p) for p in new_posts]
-                
-                # Send the new posts to the client
-                await websocket.send_text(json.dumps(formatted_posts))
-            else:
-                # If no new posts, send an empty list
-                await websocket.send_text(json.dumps([]))
-            
-            # Wait for a message from the client (you can adjust the logic here)
-            _ = await websocket.receive_text()
+        # Prepare the query
+        query = {"keyword": {"$in": keyword_list}}
+        if subreddit:
+            query["subreddit"] = subreddit
+
+        # Send what the client missed since its cursor, if that is not too much
+        pages = await hub.backfill(db, query, position) if position else None
+        sent_ids = []
+        if pages is not None:
+            async for page in pages:
+                page = [PreparedPost(p) for p in page]
+                await hub.send(subscriber, page)
+                sent_ids.extend(p.id for p in page)
+        else:
+            # Send the latest posts for any of the specified keywords, oldest first in cursor
+            # order like everything after them, so the last cursor received is the one to resume from
+            latest_posts = await db.reddit.find(query).sort("created_utc", -1).limit(100).to_list(length=100)
+            latest_posts.sort(key=lambda p: (p['created_utc'], p['_id']))
+            latest_posts = [PreparedPost(p) for p in latest_posts]
+            await hub.send(subscriber, latest_posts)
+            sent_ids = [p.id for p in latest_posts]
+
+        # Push new posts from the shared hub until the client goes away
+        await hub.serve(subscriber, skip_ids=sent_ids)
     except WebSocketDisconnect:
-        print(f"Client disconnected from multi-keyword posts feed")
\ No newline at end of file
+        print(f"Client disconnected from multi-keyword posts feed")
+    finally:
+        hub.unsubscribe(subscriber)
+
+@router.get("/export")
+async def export_posts(
+    keywords: str = Query(..., description="Comma-separated list of keywords"),
+    subreddit: Optional[str] = Query(None),
+    start_time: Optional[datetime] = None,
+    end_time: Optional[datetime] = None,
+    format: str = Query("ndjson", pattern="^(ndjson|csv)$", description="ndjson or csv")
+):
+    """
+    Export every post matching the filters, oldest first, as a streamed download.
+
+    Unlike the feeds there is no cap on the number of posts: they are read from a
+    server-side cursor in batches of EXPORT_BATCH_SIZE and streamed as they come,
+    so any time range can be exported with constant memory.
+
+    Query parameters:
+    - keywords: Comma-separated list of keywords (required)
+    - subreddit: Filter posts by subreddit (optional)
+    - start_time: Only posts created at or after this time, UTC if no timezone is given (optional)
+    - end_time: Only posts created before this time (optional)
+    - format: "ndjson" (default, one post per line, same fields as the feed) or "csv"
+      (the POST_COLUMNS fields, nested values as JSON)
+    """
+    db = get_db("analytics")
+    keyword_list = [k.strip().lower() for k in keywords.split(',')]
+
+    query = {"keyword": {"$in": keyword_list}}
+    if subreddit:
+        query["subreddit"] = subreddit
+    if start_time or end_time:
+        query["created_utc"] = {}
+        if start_time:
+            query["created_utc"]["$gte"] = utc_timestamp(start_time)
+        if end_time:
+            query["created_utc"]["$lt"] = utc_timestamp(end_time)
+
+    # Merged from the (keyword, created_utc) index ranges, so the sort needs no memory;
+    # disk use only matters if the planner picks something else
+    cursor = db.reddit.find(query).sort("created_utc", 1).allow_disk_use(True)
+    return export_response(cursor, format, "posts", POST_COLUMNS, format_post)
@@ -1,139 +1,262 @@
-from fastapi import APIRouter, HTTPException, Query
+from fastapi import APIRouter, HTTPException, Query, Response
 from ..database import get_db
+from ..rollups import sentiment_counts, SENTIMENT_FIELDS, MINUTE, HOUR, DAY, WEEK
+from ..cache import TTLCache, SingleFlight
+from ..export import utc_timestamp
+from ..indexes import register_index
 from datetime import datetime, timedelta
-from pymongo import DESCENDING
-from typing import List, Optional, Dict
+from typing import List, Optional, Dict, NamedTuple
+import numpy as np
+import os
+import re
+import time
 
 router = APIRouter()
 
-def generate_time_series(start_time: datetime, end_time: datetime, aggregation_type: str) -> List[str]:
-    """Generate a complete time series between start_time and end_time."""
-    time_format = "%Y-%m-%d %H:00" if aggregation_type == 'hourly' else "%Y-%m-%d %H:%M"
-    delta = timedelta(hours=1) if aggregation_type == 'hourly' else timedelta(minutes=1)
-    time_series = []
-    current_time = start_time
-    while current_time <= end_time:
-        time_series.append(current_time.strftime(time_format))
-        current_time += delta
-    return time_series
-
-def fill_missing_data(data: List[dict], time_series: List[str]) -> List[dict]:
-    """Fill in missing time units with zero counts."""
-    data_dict = {item['time_unit']: item for item in data}
-    filled_data = []
-    for time_unit in time_series:
-        if time_unit in data_dict:
-            filled_data.append(data_dict[time_unit])
-        else:
-            filled_data.append({
-                'time_unit': time_unit,
-                'positives': 0,
-                'negatives': 0,
-                'neutrals': 0
-            })
-    return filled_data
+register_index("reddit", [("keyword", 1), ("created_utc", 1), ("subreddit", 1)])
+
+COUNT_FIELDS = tuple(SENTIMENT_FIELDS.values())
+
+class Resolution(NamedTuple):
+    name: str
+    seconds: int
+    offset: int  # bucket boundaries are offset seconds past a multiple of `seconds`
+    label_unit: str  # numpy datetime64 unit time_unit labels are printed at
+    default_span: timedelta
+
+# 1970-01-05 was a Monday, so weekly buckets start on Mondays
+MONDAY_OFFSET = 4 * DAY
+
+AGGREGATION_TYPES = {
+    'minutes': Resolution('minutes', MINUTE, 0, 'm', timedelta(hours=1)),
+    'hourly': Resolution('hourly', HOUR, 0, 'h', timedelta(hours=24)),
+    'daily': Resolution('daily', DAY, 0, 'D', timedelta(days=30)),
+    'weekly': Resolution('weekly', WEEK, MONDAY_OFFSET, 'D', timedelta(weeks=12)),
+}
+
+# Resolutions max_points can step up to, finest first
+DOWNSAMPLING_STEPS = [1, 2, 5, 10, 15, 30, 60, 120, 180, 360, 720, 1440, 7 * 1440]
+
+def parse_aggregation_type(aggregation_type: str) -> Resolution:
+    """Resolve 'minutes', 'hourly', 'daily', 'weekly' or '<N>min'"""
+    if aggregation_type in AGGREGATION_TYPES:
+        return AGGREGATION_TYPES[aggregation_type]
+    match = re.fullmatch(r"([1-9][0-9]*)min", aggregation_type)
+    if match and int(match.group(1)) <= WEEK // MINUTE:
+        return minutes_resolution(int(match.group(1)))
+    raise HTTPException(
+        status_code=400,
+        detail="Invalid aggregation_type. Must be 'hourly', 'minutes', 'daily', 'weekly' or '<N>min'."
+    )
+
+def minutes_resolution(minutes: int) -> Resolution:
+    """Resolution for N-minute buckets, using the named type where there is one"""
+    for resolution in AGGREGATION_TYPES.values():
+        if resolution.seconds == minutes * MINUTE:
+            return resolution
+    return Resolution(f"{minutes}min", minutes * MINUTE, 0, 'm', timedelta(minutes=60 * minutes))
+
+def fit_resolution(resolution: Resolution, start_ts: float, end_ts: float, max_points: int) -> Resolution:
+    """The finest resolution, no finer than `resolution`, giving at most max_points buckets"""
+    def points(r):
+        return (bucket_start(end_ts, r.seconds, r.offset) - bucket_start(start_ts, r.seconds, r.offset)) // r.seconds + 1
+
+    if points(resolution) <= max_points:
+        return resolution
+    for minutes in DOWNSAMPLING_STEPS:
+        candidate = minutes_resolution(minutes)
+        if candidate.seconds > resolution.seconds and points(candidate) <= max_points:
+            return candidate
+
+    # Longer than max_points weeks: evenly sized buckets, grown until the span from the
+    # floored start to the ceiled end boundary holds at most max_points of them
+    minutes = max(-(-int(end_ts - start_ts) // (MINUTE * max_points)), resolution.seconds // MINUTE, 1)
+    while points(minutes_resolution(minutes)) > max_points:
+        seconds = minutes * MINUTE
+        aligned = bucket_start(end_ts, seconds) + seconds - bucket_start(start_ts, seconds)
+        minutes = max(-(-aligned // (MINUTE * max_points)), minutes + 1)
+    return minutes_resolution(minutes)
+
+def bucket_start(timestamp: float, seconds: int, offset: int = 0) -> int:
+    """Start of the bucket containing `timestamp`"""
+    return int((timestamp - offset) // seconds * seconds + offset)
+
+def resolve_range(aggregation_type: str, start_time: Optional[datetime], end_time: Optional[datetime], max_points: Optional[int]):
+    """Resolution and time range for a series request, applying defaults and max_points"""
+    resolution = parse_aggregation_type(aggregation_type)
+
+    # Set default time range if not provided
+    if not start_time:
+        start_time = datetime.utcnow() - resolution.default_span
+    if not end_time:
+        end_time = datetime.utcnow()
+
+    # Step up to a coarser resolution if the range would exceed max_points
+    if max_points:
+        resolution = fit_resolution(resolution, utc_timestamp(start_time), utc_timestamp(end_time), max_points)
+    return resolution, start_time, end_time
+
+def series_bounds(resolution: Resolution, start_time: datetime, end_time: datetime):
+    """First bucket and number of buckets covering start_time to end_time"""
+    first_bucket = bucket_start(utc_timestamp(start_time), resolution.seconds, resolution.offset)
+    last_bucket = bucket_start(utc_timestamp(end_time), resolution.seconds, resolution.offset)
+    return first_bucket, max((last_bucket - first_bucket) // resolution.seconds + 1, 0)
+
+# Results for closed buckets, keyed on the normalized query
+SENTIMENT_CACHE_SIZE = int(os.getenv("SENTIMENT_CACHE_SIZE", "1024"))
+SENTIMENT_CACHE_TTL = float(os.getenv("SENTIMENT_CACHE_TTL", "30"))
+sentiment_cache = TTLCache(maxsize=SENTIMENT_CACHE_SIZE, ttl=SENTIMENT_CACHE_TTL)
+inflight = SingleFlight()
+
+async def cached_sentiment_counts(db, keyword_list, subreddit, start_time, end_time, unit, offset=0, snap=None, by=()):
+    """
+    sentiment_counts in `unit` buckets over whole `snap` buckets (default: the
+    `unit` buckets themselves), from the one containing start_time to the one
+    containing end_time.
+
+    Closed buckets are cached; only the still-open current bucket is recomputed
+    on every call. Identical concurrent queries share one aggregation.
+    """
+    snap, snap_offset = (unit, offset) if snap is None else (snap, 0)
+    keywords = tuple(sorted(set(keyword_list)))
+    start_ts = bucket_start(utc_timestamp(start_time), snap, snap_offset)
+    end_ts = bucket_start(utc_timestamp(end_time), snap, snap_offset) + snap
+    open_bucket = bucket_start(time.time(), snap, snap_offset)
+
+    async def compute(start, end):
+        return await sentiment_counts(db, list(keywords), subreddit, start, end, unit, offset, by)
+
+    parts = []
+    closed_end = min(end_ts, open_bucket)
+    if start_ts < closed_end:
+        key = ("closed", keywords, subreddit, unit, offset, by, start_ts, closed_end)
+        closed = sentiment_cache.get(key)
+        if closed is None:
+            closed = await inflight.run(key, lambda: compute(start_ts, closed_end))
+            sentiment_cache.set(key, closed)
+        parts.append(closed)
+    if open_bucket < end_ts:
+        key = ("open", keywords, subreddit, unit, offset, by, max(start_ts, open_bucket), end_ts)
+        parts.append(await inflight.run(key, lambda: compute(max(start_ts, open_bucket), end_ts)))
+
+    if len(parts) == 1:
+        return parts[0]
+
+    # The open bucket can share a `unit` bucket with the last closed one
+    counts = {}
+    for part in parts:
+        for bucket, values in part.items():
+            if bucket in counts:
+                counts[bucket] = {name: counts[bucket][name] + values[name] for name in values}
+            else:
+                counts[bucket] = values
+    return counts
+
+def generate_time_series(first_bucket: int, length: int, resolution: Resolution) -> np.ndarray:
+    """Labels for `length` consecutive buckets starting at first_bucket."""
+    if length == 0:
+        # np.char.replace fails on an empty array (start_time after end_time)
+        return np.array([], dtype=str)
+    times = (first_bucket + np.arange(length, dtype=np.int64) * resolution.seconds).astype('datetime64[s]')
+    labels = np.char.replace(np.datetime_as_string(times, unit=resolution.label_unit), 'T', ' ')
+    if resolution.label_unit == 'h':
+        labels = np.char.add(labels, ':00')
+    return labels
+
+def fill_missing_data(counts: Dict[int, dict], first_bucket: int, length: int, seconds: int) -> np.ndarray:
+    """Counts per bucket as a (field, bucket) array, zero where there is no data."""
+    filled = np.zeros((len(COUNT_FIELDS), length), dtype=np.int64)
+    if counts:
+        buckets = np.fromiter(counts.keys(), dtype=np.int64, count=len(counts))
+        values = np.array([[c[name] for name in COUNT_FIELDS] for c in counts.values()], dtype=np.int64).T
+        index = (buckets - first_bucket) // seconds
+        inside = (index >= 0) & (index < length)
+        filled[:, index[inside]] = values[:, inside]
+    return filled
+
+def fill_grouped_data(counts: Dict[tuple, dict], dimension: int, names: List[str], first_bucket: int, length: int, seconds: int) -> np.ndarray:
+    """
+    Counts keyed by (bucket, ...) tuples as a (name, field, bucket) array, summed over every key
+    whose element at `dimension` is that name, and zero where there is no data.
+    """
+    filled = np.zeros((len(names), len(COUNT_FIELDS), length), dtype=np.int64)
+    positions = {name: i for i, name in enumerate(names)}
+    keys = [key for key in counts if key[dimension] in positions]
+    if keys:
+        buckets = np.fromiter((key[0] for key in keys), dtype=np.int64, count=len(keys))
+        groups = np.fromiter((positions[key[dimension]] for key in keys), dtype=np.int64, count=len(keys))
+        values = np.array([[counts[key][name] for name in COUNT_FIELDS] for key in keys], dtype=np.int64).T
+        index = (buckets - first_bucket) // seconds
+        inside = (index >= 0) & (index < length)
+        for field in range(len(COUNT_FIELDS)):
+            np.add.at(filled[:, field, :], (groups[inside], index[inside]), values[field][inside])
+    return filled
+
+def serialize_series(labels: np.ndarray, filled: np.ndarray) -> List[dict]:
+    """Response rows for a filled series"""
+    return [
+        {"time_unit": time_unit, **dict(zip(COUNT_FIELDS, row))}
+        for time_unit, row in zip(labels.tolist(), filled.T.tolist())
+    ]
 
 @router.get("/sentiment_aggregation")
 async def get_sentiment_aggregation(
+    response: Response,
     keywords: str,
-    aggregation_type: str = Query(..., description="Type of aggregation: 'hourly' or 'minutes'"),
+    aggregation_type: str = Query(..., description="Type of aggregation: 'minutes', 'hourly', 'daily', 'weekly' or '<N>min'"),
     start_time: Optional[datetime] = None,
     end_time: Optional[datetime] = None,
-    subreddit: Optional[str] = None
+    subreddit: Optional[str] = None,
+    max_points: Optional[int] = Query(None, ge=1, description="Upper bound on the number of time units returned")
 ):
     """
     Endpoint to get aggregated sentiment data for specified keywords.
 
     This endpoint provides a summary of positive, negative, and neutral posts
-    for each time unit (hour or minute) within the specified time range.
+    for each time unit (minute, hour, day, week or N minutes) within the specified time range.
+    Counts cover whole time units: the range is widened to the boundaries of the
+    units containing start_time and end_time. Results for elapsed units are cached
+    for a short time (SENTIMENT_CACHE_TTL); the current unit is always recomputed.
+    A post mentioning several of the keywords is counted once for each of them.
 
     Query parameters:
     - keywords: Comma-separated list of keywords to track (required)
-    - aggregation_type: Type of aggregation, either 'hourly' or 'minutes' (required)
-    - start_time: Start of the time range (optional, defaults to 24 hours ago for hourly, 1 hour ago for minutes)
+    - aggregation_type: Type of aggregation (required), one of:
+      'minutes', 'hourly', 'daily', 'weekly' (weeks start on Monday) or '<N>min' for N-minute buckets, e.g. '15min'
+    - start_time: Start of the time range (optional, defaults to 1 hour ago for minutes, 24 hours ago for hourly,
+      30 days ago for daily, 12 weeks ago for weekly and 60 buckets ago for N-minute buckets)
     - end_time: End of the time range (optional, defaults to current time)
     - subreddit: Filter posts by subreddit (optional)
+    - max_points: Maximum number of time units to return (optional). When the range holds more
+      units than this at the requested aggregation_type, the finest coarser resolution that fits
+      is used instead (e.g. '15min' or 'hourly'); the one used is sent in the X-Aggregation-Type header
 
     Returns a list of aggregations, each containing:
-    - time_unit: The hour or minute of aggregation
+    - time_unit: Start of the time unit, formatted as "%Y-%m-%d %H:%M" ("%Y-%m-%d %H:00" for hourly,
+      "%Y-%m-%d" for daily and weekly)
     - positives: Count of positive sentiment posts
     - negatives: Count of negative sentiment posts
     - neutrals: Count of neutral sentiment posts
     """
-    db = get_db()
+    db = get_db("analytics")
 
-    # Validate aggregation_type
-    if aggregation_type not in ['hourly', 'minutes']:
-        raise HTTPException(status_code=400, detail="Invalid aggregation_type. Must be 'hourly' or 'minutes'.")
+    # Validate aggregation_type and resolve the time range
+    resolution, start_time, end_time = resolve_range(aggregation_type, start_time, end_time, max_points)
+    response.headers["X-Aggregation-Type"] = resolution.name
 
     # Process keywords
     keyword_list = [k.strip().lower() for k in keywords.split(',')]
 
-    # Set default time range if not provided
-    if not start_time:
-        start_time = datetime.utcnow() - timedelta(hours=24 if aggregation_type == 'hourly' else 1)
-    if not end_time:
-        end_time = datetime.utcnow()
+    # Counts per bucket, from the cache or the rollups where they cover the range
+    counts = await cached_sentiment_counts(
+        db, keyword_list, subreddit, start_time, end_time, resolution.seconds, resolution.offset
+    )
 
-    # Prepare the query
-    query = {
-        "keyword": {"$in": keyword_list},
-        "created_utc": {"$gte": start_time.timestamp(), "$lte": end_time.timestamp()}
-    }
-    if subreddit:
-        query["subreddit"] = subreddit
-
-    # Set time format based on aggregation type
-    time_format = "%Y-%m-%d %H:00" if aggregation_type == 'hourly' else "%Y-%m-%d %H:%M"
-
-    # Aggregation pipeline
-    pipeline = [
-        {"$match": query},
-        {"$project": {
-            "created_time": {
-                "$dateToString": {
-                    "format": time_format,
-                    "date": {"$toDate": {"$multiply": ["$created_utc", 1000]}}
-                }
-            },
-            "sentiment_label": 1
-        }},
-        {"$group": {
-            "_id": "$created_time",
-            "positives": {
-                "$sum": {"$cond": [{"$eq": ["$sentiment_label", "positive"]}, 1, 0]}
-            },
-            "negatives": {
-                "$sum": {"$cond": [{"$eq": ["$sentiment_label", "negative"]}, 1, 0]}
-            },
-            "neutrals": {
-                "$sum": {"$cond": [{"$eq": ["$sentiment_label", "neutral"]}, 1, 0]}
-            }
-        }},
-        {"$sort": {"_id": 1}}
-    ]
-
-    results = list(db.reddit.aggregate(pipeline))
-
-    # Format the initial output
-    formatted_output = [
-        {
-            "time_unit": result["_id"],
-            "positives": result["positives"],
-            "negatives": result["negatives"],
-            "neutrals": result["neutrals"]
-        }
-        for result in results
-    ]
-
-    # Generate complete time series
-    time_series = generate_time_series(start_time, end_time, aggregation_type)
-
-    # Fill in missing data with zeros
-    filled_output = fill_missing_data(formatted_output, time_series)
-
-    return filled_output
+    # Place counts into the complete series by bucket index, zero elsewhere
+    first_bucket, length = series_bounds(resolution, start_time, end_time)
+    filled = fill_missing_data(counts, first_bucket, length, resolution.seconds)
 
+    return serialize_series(generate_time_series(first_bucket, length, resolution), filled)
 
 
 @router.get("/sentiment_pie_chart")
@@ -148,6 +271,9 @@ async def get_sentiment_pie_chart(
 
     This endpoint provides a summary of positive, negative, and neutral posts
     for the entire specified time range.
+    The range is widened to whole minutes, and totals for elapsed minutes are cached
+    for a short time (SENTIMENT_CACHE_TTL).
+    A post mentioning several of the keywords is counted once for each of them.
 
     Query parameters:
     - keywords: Comma-separated list of keywords to track (required)
@@ -160,7 +286,7 @@ async def get_sentiment_pie_chart(
     - negatives: Total count of negative sentiment posts
     - neutrals: Total count of neutral sentiment posts
     """
-    db = get_db()
+    db = get_db("analytics")
 
     # Process keywords
     keyword_list = [k.strip().lower() for k in keywords.split(',')]
@@ -171,38 +297,93 @@ async def get_sentiment_pie_chart(
     if not end_time:
         end_time = datetime.utcnow()
 
-    # Prepare the query
-    query = {
-        "keyword": {"$in": keyword_list},
-        "created_utc": {"$gte": start_time.timestamp(), "$lte": end_time.timestamp()}
-    }
-    if subreddit:
-        query["subreddit"] = subreddit
-
-    # Aggregation pipeline
-    pipeline = [
-        {"$match": query},
-        {"$group": {
-            "_id": None,
-            "positives": {
-                "$sum": {"$cond": [{"$eq": ["$sentiment_label", "positive"]}, 1, 0]}
-            },
-            "negatives": {
-                "$sum": {"$cond": [{"$eq": ["$sentiment_label", "negative"]}, 1, 0]}
-            },
-            "neutrals": {
-                "$sum": {"$cond": [{"$eq": ["$sentiment_label", "neutral"]}, 1, 0]}
-            }
-        }}
-    ]
+    # Sum hourly buckets over whole minutes, from the cache or the rollups where they cover the range
+    counts = await cached_sentiment_counts(db, keyword_list, subreddit, start_time, end_time, HOUR, snap=MINUTE)
+
+    totals = dict.fromkeys(COUNT_FIELDS, 0)
+    for bucket in counts.values():
+        for name in totals:
+            totals[name] += bucket[name]
+
+    return totals
+
+
+
+@router.get("/dashboard")
+async def get_sentiment_dashboard(
+    response: Response,
+    keywords: str,
+    aggregation_type: str = Query(..., description="Type of aggregation: 'minutes', 'hourly', 'daily', 'weekly' or '<N>min'"),
+    start_time: Optional[datetime] = None,
+    end_time: Optional[datetime] = None,
+    subreddit: Optional[str] = None,
+    max_points: Optional[int] = Query(None, ge=1, description="Upper bound on the number of time units returned")
+):
+    """
+    Endpoint to get everything a sentiment dashboard shows in one round trip.
+
+    Combines sentiment_aggregation and sentiment_pie_chart, and splits the counts per keyword
+    and per subreddit. All of it comes from a single grouped query over the rollups (and the raw
+    posts for anything the rollups don't cover yet), instead of one query per chart and keyword.
+
+    Query parameters are the same as for sentiment_aggregation:
+    - keywords: Comma-separated list of keywords to track (required)
+    - aggregation_type: 'minutes', 'hourly', 'daily', 'weekly' or '<N>min' (required)
+    - start_time: Start of the time range (optional, defaults depend on aggregation_type)
+    - end_time: End of the time range (optional, defaults to current time)
+    - subreddit: Filter posts by subreddit (optional)
+    - max_points: Maximum number of time units per series (optional)
+
+    Returns a dictionary containing:
+    - aggregation_type: The resolution used for the series (also in the X-Aggregation-Type header)
+    - timeline: Same list as sentiment_aggregation
+    - totals: Same dictionary as sentiment_pie_chart, over the whole time units in the series
+    - keywords: For each requested keyword, its own "totals" and "timeline"
+    - subreddits: For each subreddit with posts in the range, its own "totals" and "timeline"
+
+    As in sentiment_aggregation and sentiment_pie_chart, a post mentioning several of the
+    keywords is counted once for each of them, in every series and total.
+    """
+    db = get_db("analytics")
+
+    # Validate aggregation_type and resolve the time range
+    resolution, start_time, end_time = resolve_range(aggregation_type, start_time, end_time, max_points)
+    response.headers["X-Aggregation-Type"] = resolution.name
+
+    # Process keywords
+    keyword_list = sorted(set(k.strip().lower() for k in keywords.split(',')))
+
+    # One grouped query for every series on the dashboard
+    counts = await cached_sentiment_counts(
+        db, keyword_list, subreddit, start_time, end_time, resolution.seconds, resolution.offset,
+        by=("keyword", "subreddit")
+    )
 
-    result = list(db.reddit.aggregate(pipeline))
+    first_bucket, length = series_bounds(resolution, start_time, end_time)
+    labels = generate_time_series(first_bucket, length, resolution)
 
-    if not result:
-        return {"positives": 0, "negatives": 0, "neutrals": 0}
+    # (keyword, field, bucket) and (subreddit, field, bucket) arrays
+    by_keyword = fill_grouped_data(counts, 1, keyword_list, first_bucket, length, resolution.seconds)
+    subreddit_list = sorted({sub for (_, _, sub) in counts if sub is not None})
+    by_subreddit = fill_grouped_data(counts, 2, subreddit_list, first_bucket, length, resolution.seconds)
+
+    # Counts are per keyword (a post with two of the keywords counts for both), so the
+    # overall series is the sum of the keyword series, as in sentiment_aggregation
+    timeline = by_keyword.sum(axis=0)
+
+    def breakdown(names, filled):
+        return {
+            name: {
+                "totals": dict(zip(COUNT_FIELDS, series.sum(axis=1).tolist())),
+                "timeline": serialize_series(labels, series)
+            }
+            for name, series in zip(names, filled)
+        }
 
     return {
-        "positives": result[0]["positives"],
-        "negatives": result[0]["negatives"],
-        "neutrals": result[0]["neutrals"]
-    }
\ No newline at end of file
+        "aggregation_type": resolution.name,
+        "timeline": serialize_series(labels, timeline),
+        "totals": dict(zip(COUNT_FIELDS, timeline.sum(axis=1).tolist())),
+        "keywords": breakdown(keyword_list, by_keyword),
+        "subreddits": breakdown(subreddit_list, by_subreddit)
+    }
@@ -1,78 +1,156 @@
-from fastapi import APIRouter, HTTPException
+from fastapi import APIRouter, HTTPException, Header, Query, Response
 from ..database import get_db
-from typing import Optional
-from pymongo import MongoClient
-from bson import json_util
+from ..indexes import register_index, register_query
+from ..cache import TTLCache
+from typing import Optional, List
 import json
-from dotenv import load_dotenv
+import hashlib
 import os
 
-load_dotenv()
-
 router = APIRouter()
 
-# MongoDB connection details
-MONGODB_URI = os.getenv("MONGO_URI") 
-DB_NAME = "tinyteam"
-COLLECTION_NAME = "stock_details"
+# Also covers the (ticker, updated_at) version lookups
+register_index("stock_details", [("ticker", 1), ("updated_at", 1)])
+register_query("stock_details", {"ticker": "AAPL"})
+
+# Fields returned for every stock, in response order
+STOCK_FIELDS = [
+    "active", "address", "branding", "cik", "composite_figi", "currency_name", "description",
+    "homepage_url", "list_date", "locale", "market", "market_cap", "name", "phone_number",
+    "primary_exchange", "round_lot", "share_class_figi", "share_class_shares_outstanding",
+    "sic_code", "sic_description", "ticker", "ticker_root", "total_employees", "type",
+    "weighted_shares_outstanding", "updated_at"
+]
+STOCK_PROJECTION = {"_id": 0, **{field: 1 for field in STOCK_FIELDS}}
+
+# ticker -> updated_at, refreshed every STOCK_VERSION_TTL seconds
+STOCK_VERSION_TTL = float(os.getenv("STOCK_VERSION_TTL", "60"))
+version_cache = TTLCache(maxsize=20000, ttl=STOCK_VERSION_TTL)
+# (ticker, updated_at) -> formatted details; a new updated_at is a new key
+STOCK_DETAILS_CACHE_SIZE = int(os.getenv("STOCK_DETAILS_CACHE_SIZE", "5000"))
+details_cache = TTLCache(maxsize=STOCK_DETAILS_CACHE_SIZE, ttl=24 * 3600)
+
+def format_stock(stock_info):
+    """Helper function to format a stock_details document"""
+    formatted = {field: stock_info.get(field) for field in STOCK_FIELDS}
+    formatted["address"] = stock_info.get("address", {})
+    formatted["branding"] = stock_info.get("branding", {})
+    return formatted
+
+async def get_versions(tickers: List[str]) -> dict:
+    """updated_at for each ticker that exists, from the version cache where possible"""
+    versions, missing = {}, []
+    for ticker in tickers:
+        version = version_cache.get(ticker)
+        if version is None:
+            missing.append(ticker)
+        else:
+            versions[ticker] = version
+
+    if missing:
+        cursor = get_db().stock_details.find({"ticker": {"$in": missing}}, {"_id": 0, "ticker": 1, "updated_at": 1})
+        for doc in await cursor.to_list(length=None):
+            # Cache as a string so that a missing updated_at is still a cacheable version
+            versions[doc["ticker"]] = str(doc.get("updated_at"))
+            version_cache.set(doc["ticker"], versions[doc["ticker"]])
+    return versions
 
-# Initialize MongoDB client
-client = MongoClient(MONGODB_URI)
-db = client[DB_NAME]
-collection = db[COLLECTION_NAME]
+async def get_details(versions: dict) -> dict:
+    """Formatted details for each ticker in `versions`, fetching only cache misses"""
+    details, missing = {}, []
+    for ticker, version in versions.items():
+        cached = details_cache.get((ticker, version))
+        if cached is None:
+            missing.append(ticker)
+        else:
+            details[ticker] = cached
+
+    if missing:
+        cursor = get_db().stock_details.find({"ticker": {"$in": missing}}, STOCK_PROJECTION)
+        for doc in await cursor.to_list(length=None):
+            version = str(doc.get("updated_at"))
+            details[doc["ticker"]] = format_stock(doc)
+            details_cache.set((doc["ticker"], version), details[doc["ticker"]])
+            version_cache.set(doc["ticker"], version)
+    return details
+
+def make_etag(versions: dict) -> str:
+    """ETag of the stocks at `versions` (ticker -> updated_at, as cached)"""
+    digest = hashlib.sha1(json.dumps(sorted(versions.items())).encode()).hexdigest()
+    return f'W/"{digest}"'
+
+def details_etag(details: dict) -> str:
+    """ETag of the details actually served, which may be newer than the version cache"""
+    return make_etag({ticker: str(stock.get("updated_at")) for ticker, stock in details.items()})
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    return if_none_match.strip() == "*" or etag in [tag.strip() for tag in if_none_match.split(",")]
+
+@router.get("/stock_details")
+async def get_stock_details_batch(
+    response: Response,
+    tickers: str = Query(..., description="Comma-separated list of stock tickers"),
+    if_none_match: Optional[str] = Header(None)
+):
+    """
+    Endpoint to get detailed information about several stocks in one request.
+
+    Serves a whole watchlist with a single query, from an in-process cache keyed on
+    ticker and updated_at. The response carries an ETag; send it back in If-None-Match
+    to get a 304 Not Modified while none of the stocks has changed.
+
+    Query parameters:
+    - tickers: Comma-separated list of stock tickers (e.g., AAPL,MSFT,GOOGL)
+
+    Returns a dictionary containing:
+    - results: Detailed stock information per ticker, as in /stock_details/{ticker}
+    - not_found: Requested tickers with no stock data
+    """
+    ticker_list = list(dict.fromkeys(t.strip() for t in tickers.split(',') if t.strip()))
+
+    versions = await get_versions(ticker_list)
+    etag = make_etag(versions)
+    if etag_matches(if_none_match, etag):
+        return Response(status_code=304, headers={"ETag": etag})
+
+    details = await get_details(versions)
+    response.headers["ETag"] = details_etag(details)
+    return {
+        "results": {ticker: details[ticker] for ticker in ticker_list if ticker in details},
+        "not_found": [ticker for ticker in ticker_list if ticker not in details]
+    }
 
 @router.get("/stock_details/{ticker}")
-async def get_stock_details(ticker: str):
+async def get_stock_details(
+    ticker: str,
+    response: Response,
+    if_none_match: Optional[str] = Header(None)
+):
     """
     Endpoint to get detailed information about a specific stock from MongoDB.
 
     This endpoint fetches comprehensive data about a given stock ticker,
     including company information, financials, and market data.
+    Responses carry an ETag and are answered with 304 Not Modified when it matches If-None-Match.
 
     Path parameters:
     - ticker: The stock ticker symbol (e.g., AAPL for Apple Inc.)
 
     Returns a dictionary containing detailed stock information.
     """
-    # Query MongoDB for the stock details
-    stock_info = collection.find_one({"ticker": ticker})
-
-    if not stock_info:
+    versions = await get_versions([ticker])
+    if ticker not in versions:
         raise HTTPException(status_code=404, detail=f"Stock data for ticker {ticker} not found")
 
-    # Remove the MongoDB-specific _id field and convert to JSON
-    stock_info.pop('_id', None)
-    
-    # Format the response to match the desired structure
-    formatted_response = {
-        "results": {
-            "active": stock_info.get("active"),
-            "address": stock_info.get("address", {}),
-            "branding": stock_info.get("branding", {}),
-            "cik": stock_info.get("cik"),
-            "composite_figi": stock_info.get("composite_figi"),
-            "currency_name": stock_info.get("currency_name"),
-            "description": stock_info.get("description"),
-            "homepage_url": stock_info.get("homepage_url"),
-            "list_date": stock_info.get("list_date"),
-            "locale": stock_info.get("locale"),
-            "market": stock_info.get("market"),
-            "market_cap": stock_info.get("market_cap"),
-            "name": stock_info.get("name"),
-            "phone_number": stock_info.get("phone_number"),
-            "primary_exchange": stock_info.get("primary_exchange"),
-            "round_lot": stock_info.get("round_lot"),
-            "share_class_figi": stock_info.get("share_class_figi"),
-            "share_class_shares_outstanding": stock_info.get("share_class_shares_outstanding"),
-            "sic_code": stock_info.get("sic_code"),
-            "sic_description": stock_info.get("sic_description"),
-            "ticker": stock_info.get("ticker"),
-            "ticker_root": stock_info.get("ticker_root"),
-            "total_employees": stock_info.get("total_employees"),
-            "type": stock_info.get("type"),
-            "weighted_shares_outstanding": stock_info.get("weighted_shares_outstanding"),
-            "updated_at": stock_info.get("updated_at")
-        }
-    }
+    etag = make_etag(versions)
+    if etag_matches(if_none_match, etag):
+        return Response(status_code=304, headers={"ETag": etag})
+
+    details = await get_details(versions)
+    if ticker not in details:
+        raise HTTPException(status_code=404, detail=f"Stock data for ticker {ticker} not found")
 
-    return formatted_response
\ No newline at end of file
+    response.headers["ETag"] = details_etag(details)
+    return {"results": details[ticker]}
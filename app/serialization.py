@@ -0,0 +1,61 @@
+"""
+JSON encoding shared by REST responses and the websocket feeds, backed by orjson.
+
+orjson writes datetimes and numpy values natively, and ObjectIds are written
+as their hex string, so documents can be encoded as they come from Mongo
+without copying them into JSON-friendly dicts first.
+
+Feeds can also be sent as msgpack (`format=msgpack`), with the same values:
+ObjectIds as strings and datetimes as ISO 8601 strings.
+"""
+import msgpack
+import orjson
+from bson import ObjectId
+from datetime import datetime
+from fastapi.responses import JSONResponse
+
+OPTIONS = orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY
+
+
+def _default(value):
+    if isinstance(value, ObjectId):
+        return str(value)
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+def dumps(value) -> bytes:
+    return orjson.dumps(value, default=_default, option=OPTIONS)
+
+def dumps_text(value) -> str:
+    """`dumps` for websocket text frames and other places that need a str"""
+    return dumps(value).decode()
+
+def _msgpack_default(value):
+    if isinstance(value, ObjectId):
+        return str(value)
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError(f"Object of type {type(value).__name__} is not msgpack serializable")
+
+def packb(value) -> bytes:
+    return msgpack.packb(value, default=_msgpack_default)
+
+
+# Wire formats of the websocket feeds: how one item is encoded, and how encoded items make a batch
+FORMATS = {
+    "json": (dumps_text, lambda parts: "[" + ",".join(parts) + "]"),
+    "msgpack": (packb, lambda parts: msgpack.Packer().pack_array_header(len(parts)) + b"".join(parts)),
+}
+
+def encode_item(format: str, value):
+    return FORMATS[format][0](value)
+
+def encode_batch(format: str, parts: list):
+    """A list of items already encoded with `encode_item`: str for json, bytes for msgpack"""
+    return FORMATS[format][1](parts)
+
+
+class ORJSONResponse(JSONResponse):
+    """Default response class of the app"""
+
+    def render(self, content) -> bytes:
+        return dumps(content)
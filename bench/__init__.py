@@ -0,0 +1,19 @@
+"""
+Endpoint benchmarks and load tests.
+
+Seeds a dedicated database with synthetic `reddit`, `stock_news`,
+`stock_details` and `users` data, then drives the REST endpoints and many
+concurrent websocket clients through the app in-process (no network, no
+uvicorn) and reports throughput and p50/p95/p99 latency per scenario.
+
+Usage:
+    python -m bench                                  # local mongod, database tinyteam_bench
+    python -m bench --mongo-uri mongodb://host:27017 --scale 5
+    python -m bench --in-process                     # mongomock stand-in, no mongod needed
+    python -m bench --save-baseline bench/baseline.json
+    python -m bench --baseline bench/baseline.json   # exit 1 on a regression
+
+The seeder drops the collections it fills, so it only runs against a
+database whose name ends in "_bench". Numbers from --in-process measure the
+app's own overhead only; use a real mongod for anything query-bound.
+"""
@@ -0,0 +1,277 @@
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import time
+from datetime import datetime, timedelta
+
+import numpy as np
+
+from .seed import KEYWORDS, TICKERS, PASSWORD, seed
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark the API in-process against a seeded database")
+    parser.add_argument("--mongo-uri", default=os.getenv("BENCH_MONGO_URI", "mongodb://localhost:27017"))
+    parser.add_argument("--db", default=os.getenv("BENCH_DB", "tinyteam_bench"))
+    parser.add_argument("--in-process", action="store_true", help="Use mongomock instead of a mongod")
+    parser.add_argument("--scale", type=float, default=1.0, help="Multiplier on the seeded data volume")
+    parser.add_argument("--no-seed", action="store_true", help="Reuse the data of a previous run")
+    parser.add_argument("--requests", type=int, default=500, help="Requests per REST scenario")
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--ws-clients", type=int, default=200, help="Concurrent websocket clients")
+    parser.add_argument("--ws-posts", type=int, default=200, help="Posts inserted while the clients listen")
+    parser.add_argument("--only", default=None, help="Comma-separated scenario names to run")
+    parser.add_argument("--output", default=None, help="Write the results as JSON here")
+    parser.add_argument("--baseline", default=None, help="Compare against this results file; exit 1 on a regression")
+    parser.add_argument("--save-baseline", default=None, help="Write the results as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Allowed relative regression (0.2 = 20%%)")
+    return parser.parse_args()
+
+
+def configure(args):
+    """Point the app at the benchmark database; must run before the app is imported"""
+    from dotenv import load_dotenv
+    load_dotenv()
+
+    if not args.db.endswith("_bench"):
+        sys.exit(f"Refusing to seed {args.db!r}: the benchmark database name must end in '_bench'")
+    os.environ["MONGO_URI"] = args.mongo_uri
+    os.environ["MONGO_DB"] = args.db
+    # The rollups are rebuilt once after seeding instead of followed
+    os.environ["ROLLUP_FOLLOW"] = "0"
+    os.environ.setdefault("FEED_BROKER", "0")
+
+    if args.in_process:
+        if args.no_seed:
+            sys.exit("--in-process starts from an empty database every run; drop --no-seed")
+        import mongomock_motor
+        from pymongo.errors import OperationFailure
+        from app import database
+
+        client = mongomock_motor.AsyncMongoMockClient()
+        database.AsyncIOMotorClient = lambda *a, **k: client
+
+        # Behave like a standalone mongod, so the hubs fall back to polling
+        def watch(*args, **kwargs):
+            raise OperationFailure("The $changeStream stage is only supported on replica sets")
+        mongomock_motor.AsyncMongoMockCollection.watch = watch
+
+
+def summarize(latencies, errors: int, elapsed: float) -> dict:
+    latencies = np.array(latencies) * 1000
+    p50, p95, p99 = np.percentile(latencies, [50, 95, 99]) if len(latencies) else (0.0, 0.0, 0.0)
+    return {
+        "count": int(len(latencies)),
+        "errors": errors,
+        "throughput": round(len(latencies) / elapsed, 2) if elapsed else 0.0,
+        "p50_ms": round(float(p50), 2),
+        "p95_ms": round(float(p95), 2),
+        "p99_ms": round(float(p99), 2),
+    }
+
+
+async def run_requests(request, total: int, concurrency: int) -> dict:
+    """Issue `total` requests from `concurrency` concurrent workers"""
+    latencies, errors = [], 0
+    issued = iter(range(total))
+
+    async def worker():
+        nonlocal errors
+        for i in issued:
+            started = time.perf_counter()
+            try:
+                response = await request(i)
+                failed = response.status_code >= 400
+            except Exception:
+                failed = True
+            if failed:
+                errors += 1
+            else:
+                latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return summarize(latencies, errors, time.perf_counter() - started)
+
+
+def rest_scenarios(client, rng: random.Random, total: int, counts: dict):
+    """name -> (request for the i-th call, number of calls)"""
+    def keywords():
+        return ",".join(rng.sample(KEYWORDS, rng.randint(1, 3)))
+
+    week_ago = (datetime.utcnow() - timedelta(days=7)).isoformat()
+    seeded_tickers = TICKERS[:min(counts["stock_details"], 50)]
+    user_count = counts["users"]
+    return {
+        "sentiments_hourly": (lambda i: client.get("/sentiments/sentiment_aggregation", params={
+            "keywords": keywords(), "aggregation_type": "hourly"}), total),
+        "sentiments_minutes_week": (lambda i: client.get("/sentiments/sentiment_aggregation", params={
+            "keywords": keywords(), "aggregation_type": "minutes", "start_time": week_ago, "max_points": 500}), total),
+        "sentiments_pie": (lambda i: client.get("/sentiments/sentiment_pie_chart", params={
+            "keywords": keywords(), "start_time": week_ago}), total),
+        "sentiments_dashboard": (lambda i: client.get("/sentiments/dashboard", params={
+            "keywords": keywords(), "aggregation_type": "daily", "start_time": week_ago}), total),
+        "tickers_batch": (lambda i: client.get("/tickers/stock_details", params={
+            "tickers": ",".join(rng.sample(seeded_tickers, min(len(seeded_tickers), 20)))}), total),
+        "tickers_single": (lambda i: client.get(f"/tickers/stock_details/{rng.choice(seeded_tickers)}"), total),
+        # bcrypt bound, so fewer calls
+        "jwt_login": (lambda i: client.post("/jwt/login", data={
+            "username": f"user{i % user_count}@bench.example", "password": PASSWORD}), max(total // 10, 20)),
+    }
+
+
+async def websocket_scenarios(app, db, clients: int, post_count: int, rng: random.Random) -> dict:
+    """
+    Connect `clients` posts subscribers, then insert `post_count` posts and time
+    how long each takes to reach every subscriber of its keyword.
+    """
+    from .asgi import ASGIWebSocket
+
+    connect_latencies, delivery_latencies = [], []
+    connect_errors = 0
+    subscriptions = {}
+    sockets = []
+
+    async def connect(i):
+        nonlocal connect_errors
+        keywords = rng.sample(KEYWORDS, rng.randint(1, 3))
+        socket = ASGIWebSocket(app, "/posts/ws/keyword_posts", {"keywords": ",".join(keywords)})
+        started = time.perf_counter()
+        try:
+            await socket.connect()
+            await socket.receive()  # the snapshot
+        except Exception:
+            connect_errors += 1
+            return
+        connect_latencies.append(time.perf_counter() - started)
+        subscriptions[socket] = set(keywords)
+        sockets.append(socket)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(connect(i) for i in range(clients)))
+    connect_result = summarize(connect_latencies, connect_errors, time.perf_counter() - started)
+
+    expected = 0
+    received = 0
+
+    async def listen(socket):
+        nonlocal received
+        while True:
+            frame = json.loads(await socket.receive())
+            now = time.time()
+            for post in frame:
+                if "bench_sent_at" in post:
+                    delivery_latencies.append(now - post["bench_sent_at"])
+                    received += 1
+
+    listeners = [asyncio.create_task(listen(socket)) for socket in sockets]
+    started = time.perf_counter()
+    for start in range(0, post_count, 10):
+        batch = []
+        for i in range(start, min(start + 10, post_count)):
+            keyword = rng.choice(KEYWORDS)
+            expected += sum(keyword in keywords for keywords in subscriptions.values())
+            batch.append({
+                "keyword": keyword, "subreddit": "bench", "created_utc": time.time(),
+                "sentiment_label": "neutral", "title": f"Live post {i}", "bench_sent_at": time.time(),
+            })
+        await db.reddit.insert_many(batch)
+        await asyncio.sleep(0.05)
+    deadline = time.perf_counter() + 30
+    while received < expected and time.perf_counter() < deadline:
+        await asyncio.sleep(0.01)
+    elapsed = time.perf_counter() - started
+
+    for task in listeners:
+        task.cancel()
+    await asyncio.gather(*(socket.close() for socket in sockets))
+    return {
+        "ws_connect_snapshot": connect_result,
+        "ws_delivery": summarize(delivery_latencies, expected - received, elapsed),
+    }
+
+
+def compare(results: dict, baseline: dict, tolerance: float):
+    """Scenarios whose p95 latency or throughput got worse than the baseline by more than `tolerance`"""
+    regressions = []
+    for name, base in baseline["scenarios"].items():
+        current = results["scenarios"].get(name)
+        if current is None:
+            continue
+        if base["p95_ms"] and current["p95_ms"] > base["p95_ms"] * (1 + tolerance):
+            regressions.append(f"{name}: p95 {current['p95_ms']}ms vs baseline {base['p95_ms']}ms")
+        if base["throughput"] and current["throughput"] < base["throughput"] * (1 - tolerance):
+            regressions.append(f"{name}: {current['throughput']} req/s vs baseline {base['throughput']} req/s")
+        if current["errors"] > base["errors"]:
+            regressions.append(f"{name}: {current['errors']} errors vs baseline {base['errors']}")
+    if baseline.get("settings") != results["settings"]:
+        print(f"Note: baseline settings {baseline.get('settings')} differ from this run's {results['settings']}")
+    return regressions
+
+
+def report(results: dict):
+    print(f"{'scenario':<26}{'count':>8}{'errors':>8}{'req/s':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for name, r in results["scenarios"].items():
+        print(f"{name:<26}{r['count']:>8}{r['errors']:>8}{r['throughput']:>10}{r['p50_ms']:>10}{r['p95_ms']:>10}{r['p99_ms']:>10}")
+
+
+async def main(args) -> dict:
+    import httpx
+    import main as server
+    from app import rollups
+    from app.database import get_db, get_sync_db
+
+    app = server.create_app()
+    db = get_db()
+    rng = random.Random(1)
+    only = set(args.only.split(",")) if args.only else None
+
+    if args.no_seed:
+        counts = {
+            "users": await db.users.count_documents({"email": {"$regex": "@bench\\.example$"}}),
+            "stock_details": await db.stock_details.count_documents({}),
+        }
+    else:
+        counts = await seed(db, args.scale)
+        print(f"Seeded {counts}")
+        if not args.in_process:
+            await asyncio.to_thread(rollups.rebuild, get_sync_db())
+
+    results = {
+        "settings": {"scale": args.scale, "requests": args.requests, "concurrency": args.concurrency,
+                     "ws_clients": args.ws_clients, "ws_posts": args.ws_posts, "in_process": args.in_process},
+        "scenarios": {},
+    }
+    async with app.router.lifespan_context(app):
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+            for name, (request, total) in rest_scenarios(client, rng, args.requests, counts).items():
+                if only is None or name in only:
+                    results["scenarios"][name] = await run_requests(request, total, args.concurrency)
+                    print(f"{name}: {results['scenarios'][name]}")
+
+        if only is None or only & {"ws_connect_snapshot", "ws_delivery"}:
+            results["scenarios"].update(await websocket_scenarios(app, db, args.ws_clients, args.ws_posts, rng))
+    return results
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    configure(args)
+    results = asyncio.run(main(args))
+    report(results)
+
+    for path in (args.output, args.save_baseline):
+        if path:
+            with open(path, "w") as f:
+                json.dump(results, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f"Regression: {regression}")
+        sys.exit(1 if regressions else 0)
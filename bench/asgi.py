@@ -0,0 +1,54 @@
+"""Minimal in-process websocket client speaking ASGI directly to the app"""
+import asyncio
+from urllib.parse import urlencode
+
+
+class WebSocketClosed(Exception):
+    def __init__(self, code):
+        super().__init__(f"websocket closed with code {code}")
+        self.code = code
+
+
+class ASGIWebSocket:
+    def __init__(self, app, path: str, params: dict):
+        self.app = app
+        self.path = path
+        self.query = urlencode(params)
+        self._to_app = asyncio.Queue()
+        self._from_app = asyncio.Queue()
+        self._task = None
+
+    async def connect(self):
+        scope = {
+            "type": "websocket",
+            "asgi": {"version": "3.0"},
+            "scheme": "ws",
+            "path": self.path,
+            "raw_path": self.path.encode(),
+            "root_path": "",
+            "query_string": self.query.encode(),
+            "headers": [(b"host", b"bench")],
+            "client": ("127.0.0.1", 0),
+            "server": ("bench", 80),
+            "subprotocols": [],
+            "state": {},
+        }
+        self._task = asyncio.create_task(self.app(scope, self._to_app.get, self._from_app.put))
+        await self._to_app.put({"type": "websocket.connect"})
+        message = await self._from_app.get()
+        if message["type"] != "websocket.accept":
+            raise WebSocketClosed(message.get("code"))
+
+    async def receive(self):
+        """Next text or bytes frame from the app"""
+        message = await self._from_app.get()
+        if message["type"] == "websocket.close":
+            raise WebSocketClosed(message.get("code"))
+        return message.get("text") if message.get("text") is not None else message.get("bytes")
+
+    async def close(self):
+        await self._to_app.put({"type": "websocket.disconnect", "code": 1000})
+        try:
+            await asyncio.wait_for(self._task, timeout=5)
+        except (asyncio.TimeoutError, Exception):
+            self._task.cancel()
@@ -0,0 +1,114 @@
+"""Synthetic data for the benchmarks, at a configurable scale"""
+import random
+import time
+from datetime import datetime, timedelta
+
+KEYWORDS = [
+    "tsla", "aapl", "nvda", "msft", "amzn", "goog", "meta", "amd", "intc", "pltr",
+    "gme", "amc", "spy", "qqq", "coin", "nflx", "dis", "ba", "f", "sofi",
+]
+SUBREDDITS = ["wallstreetbets", "stocks", "investing", "options", "StockMarket", "pennystocks"]
+SENTIMENTS = ["positive", "negative", "neutral"]
+TICKERS = [keyword.upper() for keyword in KEYWORDS] + [f"T{i:03d}" for i in range(980)]
+
+PASSWORD = "bench-password"
+DAYS = 14
+BATCH_SIZE = 5000
+
+
+def iso(value: datetime) -> str:
+    return value.strftime("%Y-%m-%dT%H:%M:%SZ")
+
+def users(count: int, hashed_password: str):
+    return [
+        {
+            "email": f"user{i}@bench.example",
+            "username": f"bench_user_{i}",
+            "mobile": f"+1555{i:07d}",
+            "hashed_password": hashed_password,
+            "role": "client",
+            "id": f"{i:024x}",
+        }
+        for i in range(count)
+    ]
+
+def posts(count: int, rng: random.Random, now: float):
+    return [
+        {
+            "keyword": rng.choice(KEYWORDS),
+            "subreddit": rng.choice(SUBREDDITS),
+            "created_utc": now - rng.random() * DAYS * 86400,
+            "sentiment_label": rng.choice(SENTIMENTS),
+            "title": f"Synthetic post {i}",
+            "selftext": "lorem ipsum " * rng.randint(5, 60),
+            "score": rng.randint(0, 5000),
+            "num_comments": rng.randint(0, 800),
+        }
+        for i in range(count)
+    ]
+
+def articles(count: int, rng: random.Random, now: datetime):
+    docs = []
+    for i in range(count):
+        tickers = rng.sample(KEYWORDS, rng.randint(1, 4))
+        docs.append({
+            "title": f"Synthetic article {i}",
+            "author": "Bench",
+            "publisher": {"name": "Bench Wire", "homepage_url": "https://bench.example"},
+            # ISO 8601 strings, as the news ingester stores them
+            "published_utc": iso(now - timedelta(seconds=rng.random() * DAYS * 86400)),
+            "fetched_at": iso(now),
+            "article_url": f"https://bench.example/articles/{i}",
+            "description": "lorem ipsum " * rng.randint(10, 40),
+            "tickers": [t.upper() for t in tickers],
+            "insights": [
+                {
+                    "ticker": t.upper(),
+                    "sentiment": rng.choice(SENTIMENTS),
+                    "sentiment_reasoning": "lorem ipsum " * rng.randint(5, 20),
+                }
+                for t in tickers
+            ],
+        })
+    return docs
+
+def stocks(count: int, rng: random.Random, now: datetime):
+    return [
+        {
+            "ticker": ticker,
+            "name": f"{ticker} Inc.",
+            "active": True,
+            "market": "stocks",
+            "locale": "us",
+            "currency_name": "usd",
+            "market_cap": rng.randint(10**8, 3 * 10**12),
+            "total_employees": rng.randint(10, 200000),
+            "description": "lorem ipsum " * rng.randint(20, 80),
+            "address": {"address1": "1 Bench Way", "city": "Benchville", "state": "CA"},
+            "branding": {"logo_url": f"https://bench.example/{ticker}.svg"},
+            "updated_at": now,
+        }
+        for ticker in TICKERS[:count]
+    ]
+
+
+async def seed(db, scale: float = 1.0, rng_seed: int = 0):
+    """Replace the benchmark collections with `scale` times the default volume; returns the counts"""
+    from app.auth import pwd_context
+
+    rng = random.Random(rng_seed)
+    now = datetime.utcnow()
+    collections = {
+        "reddit": posts(int(20000 * scale), rng, time.time()),
+        "stock_news": articles(int(2000 * scale), rng, now),
+        "stock_details": stocks(min(int(500 * scale), len(TICKERS)), rng, now),
+        # Every user shares one hash; bcrypt would otherwise dominate seeding
+        "users": users(max(int(50 * scale), 1), pwd_context.hash(PASSWORD)),
+    }
+    for name, docs in collections.items():
+        await db[name].drop()
+        for start in range(0, len(docs), BATCH_SIZE):
+            await db[name].insert_many(docs[start:start + BATCH_SIZE])
+    await db.rollup_state.drop()
+    await db.sentiment_rollups.drop()
+    return {name: len(docs) for name, docs in collections.items()}
@@ -1,35 +1,106 @@
-from fastapi import FastAPI
+from dotenv import load_dotenv
+
+# Before the app modules, which read their settings from the environment at import
+load_dotenv()
+
+from fastapi import FastAPI, Depends
 from fastapi.middleware.cors import CORSMiddleware
+from contextlib import asynccontextmanager
 from app.routes import auth, user, posts, sentiments, tickers, news, llm 
-from app.database import init_db
-from dotenv import load_dotenv
+from app.database import init_db, get_db, query_budget
+from app import rollups, indexes, broker, metrics, profiling, dates
+from app.serialization import ORJSONResponse
+from app.compression import CompressionMiddleware
+import asyncio
 import os
 
-load_dotenv()
+WORKERS = int(os.getenv("WORKERS", "1"))
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    background_tasks = []
+
+    # Create the indexes route modules registered, and audit query plans if INDEX_AUDIT is set
+    await indexes.reconcile(get_db())
+
+    # Keep the sentiment rollups current unless they are maintained by `python -m app.rollups follow`
+    once_per_deployment = []
+    if os.getenv("ROLLUP_FOLLOW", "1") == "1":
+        once_per_deployment.append(rollups.follow)
+    # Convert new posts and articles of started date migrations (`python -m app.dates backfill`)
+    if os.getenv("DATE_MIGRATION_FOLLOW", "1") == "1":
+        once_per_deployment.append(dates.follow)
+
+    if broker.ENABLED:
+        # However many processes there are, one of them tails Mongo for everybody and runs the jobs above
+        background_tasks.append(asyncio.create_task(broker.run(once_per_deployment)))
+    else:
+        background_tasks.extend(asyncio.create_task(job()) for job in once_per_deployment)
+
+    yield
+
+    for task in background_tasks:
+        task.cancel()
+
+def create_app() -> FastAPI:
+    """App factory; every uvicorn worker builds its own app and database client"""
+    app = FastAPI(lifespan=lifespan, default_response_class=ORJSONResponse)
+
+    app.add_middleware(
+        CORSMiddleware,
+        allow_origins=["*"],  # Allows all origins
+        allow_credentials=True,
+        allow_methods=["*"],  # Allows all methods
+        allow_headers=["*"],  # Allows all headers
+        expose_headers=["X-Aggregation-Type"],  # Resolution picked for max_points, read by the frontend
+    )
+
+    # gzip/brotli for REST responses above COMPRESSION_MIN_SIZE bytes
+    app.add_middleware(CompressionMiddleware, minimum_size=int(os.getenv("COMPRESSION_MIN_SIZE", "1024")))
+
+    # Opt-in sampling profiler, see app/profiling.py
+    app.add_middleware(profiling.ProfilingMiddleware)
 
-app = FastAPI()
+    # Outermost, so request latencies include the other middleware
+    app.add_middleware(metrics.MetricsMiddleware)
 
+    # Initialize database
+    init_db(os.getenv("MONGO_URI"), os.getenv("MONGO_DB"))
 
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=["*"],  # Allows all origins
-    allow_credentials=True,
-    allow_methods=["*"],  # Allows all methods
-    allow_headers=["*"],  # Allows all headers
-)
+    # Include routers
+    # Per-route budgets for time spent in Mongo (websocket routes are long-lived and have none)
+    # The auth routes wait on the bcrypt pool too, so they budget their Mongo calls themselves (mongo_budget)
+    app.include_router(auth.router, prefix="/jwt", tags=["authentication"])
+    app.include_router(user.router, prefix="/auth", tags=["user"])
+    app.include_router(posts.router, prefix="/posts",tags=["websocket"])
+    app.include_router(sentiments.router, prefix="/sentiments",tags=["sentiments"], dependencies=[Depends(query_budget("analytics"))])
+    app.include_router(tickers.router, prefix="/tickers",tags=["tickers"], dependencies=[Depends(query_budget("default"))])
+    app.include_router(news.router, prefix="/news",tags=["news"])
+    app.include_router(llm.router, prefix="/llm",tags=["LLM"])
+    app.include_router(metrics.router)
+    app.include_router(profiling.router, prefix="/debug", tags=["debug"], dependencies=[Depends(profiling.require_admin)])
 
-# Initialize database
-init_db(os.getenv("MONGO_URI"), os.getenv("MONGO_DB"))
+    return app
 
-# Include routers
-app.include_router(auth.router, prefix="/jwt", tags=["authentication"])
-app.include_router(user.router, prefix="/auth", tags=["user"])
-app.include_router(posts.router, prefix="/posts",tags=["websocket"])
-app.include_router(sentiments.router, prefix="/sentiments",tags=["sentiments"])
-app.include_router(tickers.router, prefix="/tickers",tags=["tickers"])
-app.include_router(news.router, prefix="/news",tags=["news"])
-app.include_router(llm.router, prefix="/llm",tags=["LLM"])
+def __getattr__(name):
+    # `uvicorn main:app` and other ASGI servers importing the module get an app on first use
+    if name == "app":
+        globals()["app"] = create_app()
+        return globals()["app"]
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
+    # WORKERS processes share the port; the feeds go through app.broker.
+    # Websocket frames are compressed with permessage-deflate when the client offers it, and
+    # connections that do not answer a ping within WS_PING_TIMEOUT seconds are closed
+    uvicorn.run(
+        "main:create_app",
+        factory=True,
+        workers=WORKERS,
+        host="0.0.0.0",
+        port=8000,
+        ws_per_message_deflate=True,
+        ws_ping_interval=float(os.getenv("WS_PING_INTERVAL", "20")),
+        ws_ping_timeout=float(os.getenv("WS_PING_TIMEOUT", "20")),
+    )
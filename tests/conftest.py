@@ -0,0 +1,72 @@
+"""
+Shared fixtures. Mongo is mongomock_motor, as in `python -m bench --in-process`,
+so the suite needs pytest and mongomock-motor but no mongod:
+
+    pip install pytest mongomock-motor
+    python -m pytest tests
+"""
+import asyncio
+import httpx
+import mongomock_motor
+import pytest
+from pymongo.errors import OperationFailure
+from app import database, dates
+
+
+@pytest.fixture
+def anyio_backend():
+    return "asyncio"
+
+
+@pytest.fixture
+def db(monkeypatch):
+    """A fresh in-memory database behind get_db(), behaving like a standalone mongod"""
+    client = mongomock_motor.AsyncMongoMockClient()
+    monkeypatch.setattr(database, "AsyncIOMotorClient", lambda *args, **kwargs: client)
+
+    # No change streams, so the feed hubs fall back to polling
+    def watch(*args, **kwargs):
+        raise OperationFailure("The $changeStream stage is only supported on replica sets")
+    monkeypatch.setattr(mongomock_motor.AsyncMongoMockCollection, "watch", watch, raising=False)
+    database.init_db("mongodb://localhost:27017", "tinyteam_test")
+    dates.migration_states.clear()
+    yield database.get_db()
+    database.databases.clear()
+
+
+@pytest.fixture
+def app(db, monkeypatch):
+    """The whole app on the test database; its lifespan (index builds, followers) is not run"""
+    from main import create_app
+
+    monkeypatch.setenv("MONGO_DB", "tinyteam_test")
+    return create_app()
+
+
+@pytest.fixture
+async def client(app):
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test") as client:
+        yield client
+
+
+@pytest.fixture
+def interleave(monkeypatch):
+    """
+    interleave(collection, hook=None): after every find_one on `collection`, yield
+    to the event loop and then await `hook()` if given, so concurrent tasks all
+    read before any of them writes. mongomock_motor otherwise never yields.
+    """
+    def install(name, hook=None):
+        find_one = mongomock_motor.AsyncMongoMockCollection.find_one
+
+        async def patched(self, *args, **kwargs):
+            result = await find_one(self, *args, **kwargs)
+            if self.name == name:
+                await asyncio.sleep(0)
+                if hook is not None:
+                    await hook()
+            return result
+
+        monkeypatch.setattr(mongomock_motor.AsyncMongoMockCollection, "find_one", patched)
+
+    return install
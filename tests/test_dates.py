@@ -0,0 +1,82 @@
+import itertools
+import pytest
+import time
+from bson import ObjectId
+from app import dates
+from app.dates import backfilled, dual_range, to_date, _step
+
+T0 = 1700000000
+counter = itertools.count()
+
+
+@pytest.fixture
+def migration(monkeypatch):
+    """The reddit migration, with a conversion mongomock can evaluate ($toDate is not supported)"""
+    monkeypatch.setitem(dates.MIGRATIONS, "reddit", ("created_utc", "created_at", {"$add": ["$created_utc", 0]}))
+    monkeypatch.setattr(dates, "BATCH_SIZE", 3)
+
+
+def oid(seconds_ago=0):
+    """An ObjectId as generated by a client whose clock is `seconds_ago` behind"""
+    return ObjectId(int(time.time() - seconds_ago).to_bytes(4, "big") + next(counter).to_bytes(8, "big"))
+
+
+async def unconverted(db):
+    return sorted([doc["created_utc"] async for doc in db.reddit.find({"created_at": {"$exists": False}})])
+
+
+async def run(db, state):
+    steps = 1
+    while not await _step(db, "reddit", state):
+        steps += 1
+    return steps
+
+
+@pytest.mark.anyio
+async def test_backfill_converts_in_batches_and_keeps_existing_dates(db, migration):
+    await db.reddit.insert_many([{"_id": oid(), "created_utc": T0 + i} for i in range(7)])
+    await db.reddit.update_one({"created_utc": T0}, {"$set": {"created_at": "already set"}})
+
+    state = {"watermark": None, "backfilled": False}
+    assert await run(db, state) == 3
+    assert await unconverted(db) == []
+    assert (await db.reddit.find_one({"created_utc": T0}))["created_at"] == "already set"
+    saved = await db.date_migrations.find_one({"_id": "reddit"})
+    assert saved["backfilled"] and saved["watermark"] == state["watermark"]
+
+
+@pytest.mark.anyio
+async def test_follower_picks_up_ids_behind_the_watermark(db, migration, monkeypatch):
+    monkeypatch.setattr(dates, "LOOKBACK", 600)
+    await db.reddit.insert_many([{"_id": oid(), "created_utc": T0 + i} for i in range(4)])
+    state = {"watermark": None, "backfilled": False}
+    await run(db, state)
+
+    # Inserted after the watermark was taken, by clients with slower clocks
+    await db.reddit.insert_many([
+        {"_id": oid(60), "created_utc": T0 + 10},
+        {"_id": oid(3600), "created_utc": T0 + 11},
+    ])
+    await run(db, state)
+    assert await unconverted(db) == [T0 + 11]
+
+
+@pytest.mark.anyio
+async def test_dual_range_reads_stragglers_through_the_legacy_field(db, migration):
+    await db.reddit.insert_many([
+        {"created_utc": T0, "created_at": to_date(T0)},
+        {"created_utc": T0 + 10},
+        {"created_utc": T0 + 100, "created_at": to_date(T0 + 100)},
+    ])
+    query = {"$or": dual_range("reddit", {"$gte": to_date(T0), "$lt": to_date(T0 + 50)}, {"$gte": T0, "$lt": T0 + 50})}
+    assert sorted([doc["created_utc"] async for doc in db.reddit.find(query)]) == [T0, T0 + 10]
+
+
+@pytest.mark.anyio
+async def test_backfilled_state_is_cached(db):
+    assert await backfilled(db, "reddit") is False
+    await db.date_migrations.insert_one({"_id": "reddit", "watermark": None, "backfilled": True})
+    # Not backfilled (False) is cached too, until the state expires
+    assert await backfilled(db, "reddit") is False
+    dates.migration_states.clear()
+    assert await backfilled(db, "reddit") is True
@@ -0,0 +1,112 @@
+import csv
+import io
+import json
+import pytest
+from datetime import datetime, timedelta, timezone
+from app import export
+from app.export import csv_chunks, ndjson_chunks, export_response, utc, utc_timestamp
+
+T0 = 1700000000  # 2023-11-14T22:13:20Z
+
+
+class FakeCursor:
+    def __init__(self, docs):
+        self.docs = docs
+        self.read = 0
+        self.closed = False
+
+    def batch_size(self, size):
+        return self
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self.read == len(self.docs):
+            raise StopAsyncIteration
+        self.read += 1
+        return self.docs[self.read - 1]
+
+    async def close(self):
+        self.closed = True
+
+
+DOCS = [{"n": i, "text": "x" * 40, "tags": ["a", "b"]} for i in range(100)]
+
+
+async def collect(chunks):
+    return [chunk async for chunk in chunks]
+
+
+@pytest.mark.anyio
+async def test_ndjson_chunks(monkeypatch):
+    monkeypatch.setattr(export, "EXPORT_CHUNK_SIZE", 500)
+    chunks = await collect(ndjson_chunks(FakeCursor(DOCS), lambda doc: doc))
+    assert len(chunks) > 1
+    assert all(len(chunk) >= 500 for chunk in chunks[:-1])
+    assert all(chunk.endswith(b"\n") for chunk in chunks)
+    assert [json.loads(line) for line in b"".join(chunks).splitlines()] == DOCS
+
+
+@pytest.mark.anyio
+async def test_csv_chunks_write_the_header_once(monkeypatch):
+    monkeypatch.setattr(export, "EXPORT_CHUNK_SIZE", 500)
+    chunks = await collect(csv_chunks(FakeCursor(DOCS), lambda doc: doc, ("n", "tags", "missing")))
+    assert len(chunks) > 1
+    rows = list(csv.reader(io.StringIO(b"".join(chunks).decode())))
+    assert rows[0] == ["n", "tags", "missing"]
+    assert rows[1:] == [[str(i), '["a","b"]', ""] for i in range(100)]
+
+
+@pytest.mark.anyio
+async def test_empty_export_is_just_the_header():
+    assert await collect(ndjson_chunks(FakeCursor([]), lambda doc: doc)) == []
+    assert await collect(csv_chunks(FakeCursor([]), lambda doc: doc, ("n",))) == [b"n\r\n"]
+
+
+@pytest.mark.anyio
+async def test_cursor_is_closed_when_the_client_goes_away(monkeypatch):
+    monkeypatch.setattr(export, "EXPORT_CHUNK_SIZE", 100)
+    cursor = FakeCursor(DOCS)
+    body = export_response(cursor, "ndjson", "test", ()).body_iterator
+    await body.__anext__()
+    await body.aclose()
+    assert cursor.closed
+    assert cursor.read < len(DOCS)
+
+
+def test_naive_times_are_utc():
+    naive = datetime(2023, 11, 14, 22, 13, 20)
+    aware = datetime(2023, 11, 15, 0, 13, 20, tzinfo=timezone(timedelta(hours=2)))
+    assert utc(naive) == naive
+    assert utc(aware) == naive
+    assert utc_timestamp(naive) == utc_timestamp(aware) == T0
+
+
+@pytest.mark.anyio
+async def test_posts_export_filters_on_utc(client, db):
+    await db.reddit.insert_many([
+        {"created_utc": T0 + i * 60, "keyword": "tsla", "subreddit": "stocks"} for i in range(5)
+    ])
+    for start, end in [("2023-11-14T22:14:00", "2023-11-14T22:16:00"), ("2023-11-15T00:14:00+02:00", "2023-11-14T22:16:00Z")]:
+        response = await client.get("/posts/export", params={"keywords": "TSLA", "start_time": start, "end_time": end})
+        assert response.status_code == 200
+        assert response.headers["content-type"] == "application/x-ndjson"
+        lines = [json.loads(line) for line in response.text.splitlines()]
+        assert len(lines) == 2
+
+
+@pytest.mark.anyio
+async def test_news_export_filters_published_strings(client, db):
+    await db.stock_news.insert_many([
+        {"published_utc": f"2024-01-31T1{hour}:00:00Z", "title": f"at {hour}", "tickers": ["AAPL"],
+         "publisher": {"name": "Wire"}, "insights": [{"ticker": "AAPL", "sentiment": "positive", "sentiment_reasoning": "r"}]}
+        for hour in range(5)
+    ])
+    response = await client.get("/news/export", params={
+        "tickers": "aapl", "start_time": "2024-01-31T11:00:00", "end_time": "2024-01-31T13:00:00", "format": "csv"
+    })
+    assert response.status_code == 200
+    rows = list(csv.DictReader(io.StringIO(response.text)))
+    assert [row["title"] for row in rows] == ["at 1", "at 2"]
+    assert rows[0]["publisher"] == "Wire" and rows[0]["sentiment"] == "positive"
@@ -0,0 +1,102 @@
+import pytest
+from bson import ObjectId
+from app import hub
+from app.hub import Hub, Subscriber, encode_cursor, decode_cursor
+
+
+class KeywordHub(Hub):
+    collection = "test_posts"
+    timestamp_field = "created_utc"
+
+    def routing_keys(self, doc):
+        return {doc["keyword"]}
+
+    def encode(self, subscriber, docs):
+        return [doc["_id"] for doc in docs]
+
+
+@pytest.fixture
+def small_queue(monkeypatch):
+    monkeypatch.setattr(hub, "SEND_QUEUE_SIZE", 2)
+
+
+def fill(subscriber, count):
+    for i in range(count):
+        subscriber.offer([i])
+
+
+def pending(subscriber):
+    return [subscriber.queue.get_nowait() for _ in range(subscriber.queue.qsize())]
+
+
+def test_drop_oldest_makes_room_for_one_batch(small_queue, monkeypatch):
+    monkeypatch.setattr(hub, "OVERFLOW_POLICY", "drop_oldest")
+    subscriber = Subscriber(None, ["tsla"])
+    fill(subscriber, 4)
+    assert pending(subscriber) == [[2], [3]]
+    assert subscriber.dropped == 2
+    assert not subscriber.evicted.is_set()
+
+
+def test_latest_keeps_only_the_newest_batch(small_queue, monkeypatch):
+    monkeypatch.setattr(hub, "OVERFLOW_POLICY", "latest")
+    subscriber = Subscriber(None, ["tsla"])
+    fill(subscriber, 3)
+    assert pending(subscriber) == [[2]]
+    assert subscriber.dropped == 2
+
+
+def test_disconnect_evicts_and_stops_queueing(small_queue, monkeypatch):
+    monkeypatch.setattr(hub, "OVERFLOW_POLICY", "disconnect")
+    subscriber = Subscriber(None, ["tsla"])
+    fill(subscriber, 4)
+    assert subscriber.evicted.is_set()
+    assert pending(subscriber) == [[0], [1]]
+
+
+def test_cursor_round_trip():
+    _id = ObjectId()
+    assert decode_cursor(encode_cursor(1700000000, _id)) == (1700000000, _id)
+    assert decode_cursor(encode_cursor("2024-01-31T14:05:00Z", _id)) == ("2024-01-31T14:05:00Z", _id)
+
+
+@pytest.mark.parametrize("token", ["", "not-a-cursor", encode_cursor(1, 2)[:-3], "e30"])
+def test_invalid_cursor(token):
+    with pytest.raises(ValueError):
+        decode_cursor(token)
+
+
+def test_dispatch_routes_by_key():
+    feed = KeywordHub()
+    tsla, aapl = Subscriber(None, ["tsla"]), Subscriber(None, ["aapl", "tsla"])
+    feed.subscribers.update((tsla, aapl))
+    for subscriber in (tsla, aapl):
+        for key in subscriber.keys:
+            feed.index[key].add(subscriber)
+
+    feed.dispatch([{"_id": 1, "keyword": "tsla"}, {"_id": 2, "keyword": "aapl"}])
+    assert [[doc["_id"] for doc in batch] for batch in pending(tsla)] == [[1]]
+    assert [[doc["_id"] for doc in batch] for batch in pending(aapl)] == [[1, 2]]
+
+
+@pytest.mark.anyio
+async def test_backfill_resumes_after_the_cursor(db, monkeypatch):
+    monkeypatch.setattr(hub, "BACKFILL_BATCH_SIZE", 2)
+    ids = [ObjectId() for _ in range(5)]
+    # Two posts share the cursor's timestamp; only the one after it in _id order is missed
+    times = [100, 200, 200, 300, 400]
+    await db.test_posts.insert_many([
+        {"_id": _id, "created_utc": ts, "keyword": "tsla"} for _id, ts in zip(ids, times)
+    ])
+    await db.test_posts.insert_one({"_id": ObjectId(), "created_utc": 500, "keyword": "aapl"})
+
+    pages = await KeywordHub().backfill(db, {"keyword": "tsla"}, (200, ids[1]))
+    assert [[doc["_id"] for doc in page] async for page in pages] == [ids[2:4], ids[4:]]
+
+
+@pytest.mark.anyio
+async def test_backfill_gives_up_past_the_limit(db, monkeypatch):
+    monkeypatch.setattr(hub, "BACKFILL_LIMIT", 3)
+    await db.test_posts.insert_many([{"created_utc": ts, "keyword": "tsla"} for ts in range(10)])
+    assert await KeywordHub().backfill(db, {"keyword": "tsla"}, (5, ObjectId())) is None
+    assert await KeywordHub().backfill(db, {"keyword": "tsla"}, (7, ObjectId())) is not None
@@ -0,0 +1,243 @@
+import asyncio
+import json
+import pytest
+from types import SimpleNamespace
+from fastapi import HTTPException
+from app.routes import llm
+from app.routes.llm import ChatMessage, ChatRequest
+
+
+def event(name, **data):
+    return SimpleNamespace(event=name, data=SimpleNamespace(**data))
+
+def delta(text):
+    block = SimpleNamespace(type="text", text=SimpleNamespace(value=text))
+    return event("thread.message.delta", delta=SimpleNamespace(content=[block]))
+
+
+class FakeStream:
+    def __init__(self, events, stall=False):
+        self.events = iter(events)
+        self.stall = stall
+        self.closed = False
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        try:
+            return next(self.events)
+        except StopIteration:
+            if self.stall:
+                await asyncio.sleep(3600)
+            raise StopAsyncIteration
+
+    async def close(self):
+        # A network round trip, where a cancelled task would be interrupted
+        await asyncio.sleep(0)
+        self.closed = True
+
+
+class FakeOpenAI:
+    """Just enough of AsyncOpenAI's assistants API, recording the calls made"""
+
+    def __init__(self, run_status="completed", stream=None, reply="Hi there"):
+        self.run_status = run_status
+        self.stream = stream
+        self.reply = reply
+        self.threads_created = []
+        self.messages_posted = []
+        self.cancelled = []
+        threads = SimpleNamespace(
+            create=self.create_thread,
+            messages=SimpleNamespace(create=self.post_message, list=self.list_messages),
+            runs=SimpleNamespace(create=self.create_run, retrieve=self.create_run, cancel=self.cancel_run),
+        )
+        self.beta = SimpleNamespace(threads=threads)
+
+    async def create_thread(self, messages):
+        self.threads_created.append([m["content"] for m in messages])
+        return SimpleNamespace(id=f"thread_{len(self.threads_created)}")
+
+    async def post_message(self, thread_id, role, content):
+        self.messages_posted.append(content)
+
+    async def list_messages(self, thread_id, limit):
+        text = SimpleNamespace(value=self.reply)
+        return SimpleNamespace(data=[SimpleNamespace(content=[SimpleNamespace(text=text)])])
+
+    async def create_run(self, thread_id, assistant_id=None, run_id=None, stream=False):
+        if stream:
+            return self.stream
+        return SimpleNamespace(id="run_1", status=self.run_status)
+
+    async def cancel_run(self, thread_id, run_id):
+        await asyncio.sleep(0)
+        self.cancelled.append(run_id)
+
+
+@pytest.fixture(autouse=True)
+def fresh_state():
+    llm.sessions.clear()
+    llm.response_cache.clear()
+
+
+def fake_client(monkeypatch, **kwargs):
+    fake = FakeOpenAI(**kwargs)
+    monkeypatch.setattr(llm, "client", fake)
+    return fake
+
+
+def conversation(*contents):
+    roles = ["user", "assistant"]
+    return [ChatMessage(role=roles[i % 2], content=content) for i, content in enumerate(contents)]
+
+
+async def sse(response):
+    """(event, data) pairs of a streamed response, read until the end"""
+    return [parse(chunk) async for chunk in response.body_iterator]
+
+def parse(chunk):
+    lines = dict(line.split(": ", 1) for line in chunk.strip().splitlines())
+    return lines.get("event"), json.loads(lines["data"])
+
+
+@pytest.mark.anyio
+async def test_only_new_messages_are_appended(monkeypatch):
+    fake = fake_client(monkeypatch)
+    first = await llm.chat_with_assistant(ChatRequest(messages=conversation("Hello")))
+    await llm.chat_with_assistant(ChatRequest(
+        messages=conversation("Hello", first.response, "And then?"), session_id=first.session_id
+    ))
+    assert fake.threads_created == [["Hello"]]
+    assert fake.messages_posted == ["And then?"]
+
+
+@pytest.mark.anyio
+async def test_retry_after_a_failed_run_does_not_repeat_messages(monkeypatch):
+    fake = fake_client(monkeypatch)
+    first = await llm.chat_with_assistant(ChatRequest(messages=conversation("Hello")))
+    retry = ChatRequest(messages=conversation("Hello", first.response, "And then?"), session_id=first.session_id)
+
+    fake.run_status = "failed"
+    with pytest.raises(HTTPException) as failed:
+        await llm.chat_with_assistant(retry)
+    assert failed.value.status_code == 502
+
+    fake.run_status = "completed"
+    await llm.chat_with_assistant(retry)
+    assert fake.threads_created == [["Hello"]]
+    assert fake.messages_posted == ["And then?"]
+
+
+@pytest.mark.anyio
+async def test_stream_forwards_deltas(monkeypatch):
+    stream = FakeStream([
+        event("thread.run.created", id="run_1"), delta("Hi "), delta("there"),
+        event("thread.run.completed", status="completed"),
+    ])
+    fake = fake_client(monkeypatch, stream=stream)
+    response = await llm.stream_chat_with_assistant(ChatRequest(messages=conversation("Hello")))
+    events = await sse(response)
+    assert events[:2] == [(None, {"delta": "Hi "}), (None, {"delta": "there"})]
+    assert events[2][0] == "done" and events[2][1]["response"] == "Hi there"
+    assert stream.closed and fake.cancelled == []
+
+    # Answered from the cache the second time
+    replay = await sse(await llm.stream_chat_with_assistant(ChatRequest(messages=conversation("Hello"))))
+    assert replay[0] == (None, {"delta": "Hi there"})
+
+
+@pytest.mark.anyio
+async def test_stream_times_out_and_cancels_the_run(monkeypatch):
+    monkeypatch.setattr(llm, "LLM_RUN_TIMEOUT", 0.05)
+    stream = FakeStream([event("thread.run.created", id="run_1"), delta("Hi")], stall=True)
+    fake = fake_client(monkeypatch, stream=stream)
+    events = await sse(await llm.stream_chat_with_assistant(ChatRequest(messages=conversation("Hello"))))
+    assert events[-1] == ("error", {"detail": "Assistant run timed out"})
+    assert stream.closed and fake.cancelled == ["run_1"]
+    assert not llm.run_slots.locked()
+
+
+async def post_and_disconnect(app, path: str, body: dict):
+    """POST through ASGI and disconnect once the first chunk of the response body arrives"""
+    received = asyncio.Queue()
+    received.put_nowait({"type": "http.request", "body": json.dumps(body).encode(), "more_body": False})
+    chunks = []
+
+    async def send(message):
+        if message["type"] == "http.response.body" and message.get("body"):
+            chunks.append(message["body"].decode())
+            received.put_nowait({"type": "http.disconnect"})
+
+    scope = {
+        "type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1", "method": "POST",
+        "scheme": "http", "path": path, "raw_path": path.encode(), "root_path": "", "query_string": b"",
+        "headers": [(b"host", b"test"), (b"content-type", b"application/json")],
+        "client": ("127.0.0.1", 0), "server": ("test", 80), "state": {},
+    }
+    await app(scope, received.get, send)
+    return chunks
+
+
+@pytest.mark.anyio
+async def test_stream_cancels_the_run_when_the_client_disconnects(app, monkeypatch):
+    stream = FakeStream([event("thread.run.created", id="run_1"), delta("Hi")], stall=True)
+    fake = fake_client(monkeypatch, stream=stream)
+    chunks = await post_and_disconnect(app, "/llm/chat/stream", {"messages": [{"role": "user", "content": "Hello"}]})
+    assert [parse(chunk) for chunk in chunks] == [(None, {"delta": "Hi"})]
+
+    await asyncio.gather(*llm.cleanups)
+    assert stream.closed and fake.cancelled == ["run_1"]
+    assert llm.response_cache.get((llm.assistant_id, llm.conversation_digest(conversation("Hello")))) is None
+    assert not llm.run_slots.locked()
+
+
+@pytest.mark.anyio
+async def test_failed_stream_run_is_not_cancelled(monkeypatch):
+    stream = FakeStream([event("thread.run.created", id="run_1"), event("thread.run.failed", status="failed")])
+    fake = fake_client(monkeypatch, stream=stream)
+    events = await sse(await llm.stream_chat_with_assistant(ChatRequest(messages=conversation("Hello"))))
+    assert events == [("error", {"detail": "Assistant run ended with status 'failed'"})]
+    assert fake.cancelled == []
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize("name, status, cancelled", [
+    ("thread.run.incomplete", "incomplete", []),
+    ("thread.run.requires_action", "requires_action", ["run_1"]),
+    (None, None, ["run_1"]),
+])
+async def test_stream_without_a_completed_run_is_an_error(monkeypatch, name, status, cancelled):
+    events = [event("thread.run.created", id="run_1"), delta("Partial")]
+    if name:
+        events.append(event(name, status=status))
+    fake = fake_client(monkeypatch, stream=FakeStream(events))
+    chat = ChatRequest(messages=conversation("Hello"), session_id="s1")
+    received = await sse(await llm.stream_chat_with_assistant(chat))
+    assert received[-1][0] == "error"
+    assert fake.cancelled == cancelled
+    assert llm.response_cache.get((llm.assistant_id, llm.conversation_digest(chat.messages))) is None
+    assert llm.sessions.get("s1").length == 1
+
+
+@pytest.mark.anyio
+async def test_stream_waits_for_a_run_slot(monkeypatch):
+    monkeypatch.setattr(llm, "run_slots", asyncio.Semaphore(1))
+    stream = FakeStream([event("thread.run.created", id="run_1"), delta("Hi"), event("thread.run.completed", status="completed")])
+    fake_client(monkeypatch, stream=stream)
+    await llm.run_slots.acquire()
+    response = await llm.stream_chat_with_assistant(ChatRequest(messages=conversation("Hello")))
+    asyncio.get_running_loop().call_later(0.05, llm.run_slots.release)
+    received = await sse(response)
+    assert received[-1][0] == "done"
+
+
+@pytest.mark.anyio
+async def test_stream_gives_up_waiting_for_a_run_slot(monkeypatch):
+    monkeypatch.setattr(llm, "run_slots", asyncio.Semaphore(1))
+    monkeypatch.setattr(llm, "LLM_QUEUE_TIMEOUT", 0.05)
+    fake_client(monkeypatch)
+    await llm.run_slots.acquire()
+    received = await sse(await llm.stream_chat_with_assistant(ChatRequest(messages=conversation("Hello"))))
+    assert received == [("error", {"detail": "Too many chats in progress, please retry shortly"})]
@@ -0,0 +1,121 @@
+import asyncio
+import pytest
+from app import rollups
+from app.rollups import STATE_ID, sentiment_counts, _follow_step, _increments
+
+# 2023-11-14T22:13:20Z, an hour boundary plus 320 seconds
+T0 = 1700000000
+
+
+def post(ts, keyword, label="positive", subreddit="stocks"):
+    return {"created_utc": ts, "keyword": keyword, "sentiment_label": label, "subreddit": subreddit}
+
+
+async def start_following(db):
+    """Rollup state covering everything, with no post folded in yet"""
+    await db.rollup_state.insert_one(
+        {"_id": STATE_ID, "watermark": None, "covered_from": 0, "covered_until": 0, "rebuilding": False}
+    )
+
+
+async def rollup_totals(db):
+    totals = {}
+    async for doc in db.sentiment_rollups.find({"unit": "minute"}):
+        for name in rollups.SENTIMENT_FIELDS.values():
+            totals[doc["keyword"]] = totals.get(doc["keyword"], 0) + doc.get(name, 0)
+    return totals
+
+
+def test_increments_count_each_keyword_of_a_post():
+    updates = _increments([
+        post(T0, ["tsla", "aapl"]),
+        post(T0 + 30, "tsla", "negative"),
+        post(T0, "tsla", label=None),
+    ])
+    docs = {
+        (u._filter["unit"], u._filter["keyword"], u._filter["bucket"]): u._doc["$inc"] for u in updates
+    }
+    assert docs == {
+        ("minute", "tsla", T0 - T0 % 60): {"positives": 1, "negatives": 1},
+        ("hour", "tsla", T0 - T0 % 3600): {"positives": 1, "negatives": 1},
+        ("minute", "aapl", T0 - T0 % 60): {"positives": 1},
+        ("hour", "aapl", T0 - T0 % 3600): {"positives": 1},
+    }
+
+
+@pytest.mark.anyio
+async def test_follower_starts_from_the_latest_post(db):
+    await db.reddit.insert_one(post(T0, "tsla"))
+    assert await _follow_step(db) is False
+    assert await _follow_step(db) is True
+    assert await db.sentiment_rollups.count_documents({}) == 0
+
+
+@pytest.mark.anyio
+async def test_racing_followers_apply_a_batch_once(db, interleave):
+    await start_following(db)
+    await db.reddit.insert_many([post(T0 + i, "tsla") for i in range(10)])
+
+    # Both read the same watermark before either claims
+    interleave("rollup_state")
+    await asyncio.gather(_follow_step(db), _follow_step(db))
+
+    state = await db.rollup_state.find_one({"_id": STATE_ID})
+    assert state["applying"] == 0
+    assert await rollup_totals(db) == {"tsla": 10}
+
+
+@pytest.mark.anyio
+async def test_follower_yields_to_a_rebuild_started_after_it_read(db, interleave):
+    await start_following(db)
+    await db.reddit.insert_many([post(T0 + i, "tsla") for i in range(10)])
+
+    async def start_rebuild():
+        await db.rollup_state.update_one({"_id": STATE_ID}, {"$set": {"rebuilding": True}})
+
+    interleave("rollup_state", start_rebuild)
+    assert await _follow_step(db) is False
+    state = await db.rollup_state.find_one({"_id": STATE_ID})
+    assert state["watermark"] is None and state["covered_until"] == 0
+    assert await db.sentiment_rollups.count_documents({}) == 0
+
+
+@pytest.mark.anyio
+async def test_covered_until_only_advances_once_caught_up(db, monkeypatch):
+    monkeypatch.setattr(rollups, "FOLLOW_BATCH_SIZE", 4)
+    await start_following(db)
+    await db.reddit.insert_many([post(T0 + i, "tsla") for i in range(10)])
+
+    assert await _follow_step(db) is False
+    assert (await db.rollup_state.find_one({"_id": STATE_ID}))["covered_until"] == 0
+    assert await _follow_step(db) is False
+    assert await _follow_step(db) is True
+    assert (await db.rollup_state.find_one({"_id": STATE_ID}))["covered_until"] > T0
+    assert await rollup_totals(db) == {"tsla": 10}
+
+
+@pytest.mark.anyio
+async def test_rollups_and_raw_pipeline_agree(db):
+    posts = [
+        post(T0 + 37 * i, keyword, label, subreddit)
+        for i in range(300)
+        for keyword, label, subreddit in [
+            (["tsla", "aapl"] if i % 3 == 0 else "tsla", ("positive", "negative", "neutral")[i % 3], "stocks"),
+            ("aapl", "negative", None),
+        ]
+    ]
+    await db.reddit.insert_many(posts)
+    # Ragged edges on both sides of the whole minutes and hours read from the rollups
+    start, end = T0 + 7, T0 + 37 * 300 - 11
+    args = (["tsla", "aapl"], None, start, end, 900)
+
+    raw = await sentiment_counts(db, *args, by=("keyword",))
+
+    await start_following(db)
+    while not await _follow_step(db):
+        pass
+    assert await sentiment_counts(db, *args, by=("keyword",)) == raw
+
+    expected = sum(1 for p in posts if start <= p["created_utc"] < end and "tsla" in p["keyword"])
+    assert sum(counts[name] for (bucket, keyword), counts in raw.items() if keyword == "tsla"
+               for name in rollups.SENTIMENT_FIELDS.values()) == expected
@@ -0,0 +1,106 @@
+import asyncio
+import json
+import pytest
+from bson import ObjectId
+from bench.asgi import ASGIWebSocket, WebSocketClosed
+from app.routes import tickers
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize("path, params", [
+    ("/posts/ws/keyword_posts", {"keywords": "tsla"}),
+    ("/news/ws/ticker_news", {"tickers": "AAPL"}),
+])
+async def test_invalid_resume_cursor_closes_with_1008(app, path, params):
+    socket = ASGIWebSocket(app, path, {**params, "since": "not-a-cursor"})
+    await socket.connect()
+    with pytest.raises(WebSocketClosed) as closed:
+        await socket.receive()
+    assert closed.value.code == 1008
+    await socket.close()
+
+
+async def receive_all(socket):
+    """Every item of the frames the feed sends right after connecting"""
+    items = []
+    while True:
+        try:
+            frame = await asyncio.wait_for(socket.receive(), timeout=0.2)
+        except asyncio.TimeoutError:
+            return items
+        items.extend(json.loads(frame))
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize("path, params, collection, make", [
+    ("/posts/ws/keyword_posts", {"keywords": "tsla"}, "reddit",
+     lambda i, ts: {"_id": i, "created_utc": ts, "keyword": "tsla", "title": f"post {i}"}),
+    ("/news/ws/ticker_news", {"tickers": "AAPL"}, "stock_news",
+     lambda i, ts: {"_id": i, "published_utc": f"2024-01-31T14:{ts % 60:02d}:00Z", "title": f"article {i}",
+                    "insights": [{"ticker": "AAPL", "sentiment": "positive", "sentiment_reasoning": "r"}]}),
+])
+async def test_resuming_from_the_snapshot_repeats_nothing(app, db, path, params, collection, make):
+    ids = sorted(ObjectId() for _ in range(5))
+    # The two newest share a timestamp and are inserted in _id order
+    await db[collection].insert_many([make(i, ts) for i, ts in zip(ids[:4], [10, 20, 30, 30])])
+
+    socket = ASGIWebSocket(app, path, params)
+    await socket.connect()
+    snapshot = await receive_all(socket)
+    await socket.close()
+    assert [item["title"].split()[1] for item in snapshot] == [str(i) for i in ids[:4]]
+
+    await db[collection].insert_one(make(ids[4], 40))
+    socket = ASGIWebSocket(app, path, {**params, "since": snapshot[-1]["cursor"]})
+    await socket.connect()
+    resumed = await receive_all(socket)
+    await socket.close()
+    assert [item["title"] for item in resumed] == [make(ids[4], 40)["title"]]
+
+
+@pytest.fixture
+def empty_caches():
+    tickers.version_cache.clear()
+    tickers.details_cache.clear()
+
+
+@pytest.mark.anyio
+async def test_stock_details_etag_and_304(client, db, empty_caches):
+    await db.stock_details.insert_one({"ticker": "AAPL", "name": "Apple", "updated_at": "2024-01-01"})
+    response = await client.get("/tickers/stock_details/AAPL")
+    assert response.status_code == 200
+    etag = response.headers["etag"]
+
+    response = await client.get("/tickers/stock_details/AAPL", headers={"If-None-Match": etag})
+    assert response.status_code == 304 and response.headers["etag"] == etag
+
+
+@pytest.mark.anyio
+async def test_stock_details_etag_follows_the_body_not_the_version_cache(client, db, empty_caches):
+    await db.stock_details.insert_one({"ticker": "AAPL", "name": "Apple", "updated_at": "2024-01-01"})
+    old_etag = (await client.get("/tickers/stock_details/AAPL")).headers["etag"]
+
+    # Updated, and the version cache has not caught up but the body read misses the details cache
+    await db.stock_details.update_one({"ticker": "AAPL"}, {"$set": {"name": "Apple Inc.", "updated_at": "2024-02-01"}})
+    tickers.details_cache.clear()
+    response = await client.get("/tickers/stock_details/AAPL")
+    assert response.json()["results"]["name"] == "Apple Inc."
+    assert response.headers["etag"] != old_etag
+
+    # Once the version cache catches up, that ETag is still current
+    tickers.version_cache.clear()
+    response = await client.get("/tickers/stock_details/AAPL", headers={"If-None-Match": response.headers["etag"]})
+    assert response.status_code == 304
+
+
+@pytest.mark.anyio
+async def test_stock_details_batch(client, db, empty_caches):
+    await db.stock_details.insert_many([
+        {"ticker": "AAPL", "updated_at": "2024-01-01"}, {"ticker": "MSFT", "updated_at": "2024-01-01"}
+    ])
+    response = await client.get("/tickers/stock_details", params={"tickers": "MSFT,AAPL,NOPE,AAPL"})
+    body = response.json()
+    assert list(body["results"]) == ["MSFT", "AAPL"] and body["not_found"] == ["NOPE"]
+    response = await client.get("/tickers/stock_details", params={"tickers": "AAPL,MSFT"},
+                                headers={"If-None-Match": response.headers["etag"]})
+    assert response.status_code == 304
@@ -0,0 +1,150 @@
+import random
+import pytest
+import time
+from datetime import datetime, timezone
+from app.routes.sentiments import (
+    AGGREGATION_TYPES, COUNT_FIELDS, DAY, HOUR, WEEK, fill_grouped_data, fill_missing_data, fit_resolution,
+    generate_time_series, minutes_resolution, parse_aggregation_type, resolve_range, series_bounds
+)
+
+T0 = 1700000000
+
+
+def points(resolution, start_ts, end_ts):
+    start = datetime.fromtimestamp(start_ts, timezone.utc)
+    end = datetime.fromtimestamp(end_ts, timezone.utc)
+    return series_bounds(resolution, start, end)[1]
+
+
+def test_keeps_the_resolution_when_it_fits():
+    assert fit_resolution(AGGREGATION_TYPES["hourly"], T0, T0 + DAY, 25) == AGGREGATION_TYPES["hourly"]
+
+
+def test_steps_up_to_the_finest_resolution_that_fits():
+    assert fit_resolution(AGGREGATION_TYPES["minutes"], T0, T0 + DAY, 100) == minutes_resolution(15)
+    assert fit_resolution(AGGREGATION_TYPES["minutes"], T0, T0 + DAY, 24) == minutes_resolution(120)
+
+
+def test_never_finer_than_requested():
+    resolution = fit_resolution(AGGREGATION_TYPES["daily"], T0, T0 + 3 * DAY, 1000)
+    assert resolution == AGGREGATION_TYPES["daily"]
+
+
+@pytest.mark.parametrize("max_points", [1, 2, 3])
+def test_spans_beyond_the_steps(max_points):
+    start, end = T0, T0 + 5 * 52 * WEEK + 12345
+    resolution = fit_resolution(AGGREGATION_TYPES["minutes"], start, end, max_points)
+    assert points(resolution, start, end) <= max_points
+    # Evenly sized buckets no larger than it takes to cover the span
+    assert resolution.seconds < 2 * (end - start) / max_points + 60
+
+
+def test_max_points_is_a_hard_cap_on_random_ranges():
+    rng = random.Random(7)
+    for _ in range(2000):
+        start = T0 + rng.uniform(-1e8, 1e8)
+        end = start + rng.choice([60, 3600, DAY, WEEK, 400 * WEEK]) * rng.random() * 3
+        max_points = rng.choice([1, 2, 3, 7, 24, 100, 1000])
+        requested = rng.choice(list(AGGREGATION_TYPES.values()))
+        resolution = fit_resolution(requested, start, end, max_points)
+        assert points(resolution, start, end) <= max_points, (requested.name, start, end, max_points)
+        assert resolution.seconds >= requested.seconds
+
+
+def test_resolve_range_applies_max_points():
+    start = datetime(2024, 1, 1)
+    resolution, _, _ = resolve_range("minutes", start, datetime(2024, 1, 2), 1)
+    assert points(resolution, start.timestamp(), datetime(2024, 1, 2).timestamp()) == 1
+
+
+def at(*args):
+    return datetime(*args, tzinfo=timezone.utc)
+
+
+@pytest.fixture
+def new_york(monkeypatch):
+    """A host clock that is not on UTC"""
+    monkeypatch.setenv("TZ", "America/New_York")
+    time.tzset()
+    yield
+    monkeypatch.undo()
+    time.tzset()
+
+
+def test_default_range_ends_now_on_a_non_utc_host(new_york):
+    resolution, start_time, end_time = resolve_range("hourly", None, None, None)
+    first_bucket, length = series_bounds(resolution, start_time, end_time)
+    now = time.time()
+    assert first_bucket + (length - 1) * HOUR == now - now % HOUR
+    assert length == 25
+
+
+def test_naive_times_are_utc_on_a_non_utc_host(new_york):
+    naive = series_bounds(AGGREGATION_TYPES["hourly"], datetime(2024, 1, 3, 12), datetime(2024, 1, 3, 14))
+    assert naive == series_bounds(AGGREGATION_TYPES["hourly"], at(2024, 1, 3, 12), at(2024, 1, 3, 14))
+
+
+def counts(positives, negatives=0, neutrals=0):
+    return dict(zip(COUNT_FIELDS, (positives, negatives, neutrals)))
+
+
+@pytest.mark.parametrize("aggregation_type, first_label, second_label", [
+    ("minutes", "2024-01-03 12:07", "2024-01-03 12:08"),
+    ("15min", "2024-01-03 12:00", "2024-01-03 12:15"),
+    ("hourly", "2024-01-03 12:00", "2024-01-03 13:00"),
+    ("daily", "2024-01-03", "2024-01-04"),
+    # 2024-01-03 is a Wednesday; weeks start on Mondays
+    ("weekly", "2024-01-01", "2024-01-08"),
+])
+def test_series_labels_are_aligned(aggregation_type, first_label, second_label):
+    resolution = parse_aggregation_type(aggregation_type)
+    first_bucket, length = series_bounds(resolution, at(2024, 1, 3, 12, 7, 30), at(2024, 1, 20))
+    labels = generate_time_series(first_bucket, length, resolution)
+    assert labels[:2].tolist() == [first_label, second_label]
+    assert len(labels) == length
+
+
+def test_empty_range():
+    resolution = AGGREGATION_TYPES["hourly"]
+    first_bucket, length = series_bounds(resolution, at(2024, 1, 2), at(2024, 1, 1))
+    assert length == 0
+    assert generate_time_series(first_bucket, length, resolution).tolist() == []
+    assert fill_missing_data({first_bucket: counts(1)}, first_bucket, length, HOUR).shape == (3, 0)
+    assert fill_grouped_data({(first_bucket, "tsla"): counts(1)}, 1, ["tsla"], first_bucket, length, HOUR).shape == (1, 3, 0)
+
+
+def test_fill_missing_data_zero_fills_gaps_and_drops_outside_buckets():
+    first = 1704067200  # 2024-01-01T00:00:00Z
+    filled = fill_missing_data(
+        {first: counts(1, 2, 3), first + 2 * HOUR: counts(4), first - HOUR: counts(9), first + 4 * HOUR: counts(9)},
+        first, 4, HOUR
+    )
+    assert filled.T.tolist() == [[1, 2, 3], [0, 0, 0], [4, 0, 0], [0, 0, 0]]
+
+
+def test_fill_grouped_data_sums_per_name():
+    first = 1704067200
+    grouped = {
+        (first, "tsla", "stocks"): counts(1),
+        (first, "tsla", "wallstreetbets"): counts(2),
+        (first + HOUR, "aapl", "stocks"): counts(0, 5),
+        (first + HOUR, "ignored", "stocks"): counts(7),
+        (first + 9 * HOUR, "tsla", "stocks"): counts(7),
+    }
+    filled = fill_grouped_data(grouped, 1, ["tsla", "aapl"], first, 2, HOUR)
+    assert filled[0].T.tolist() == [[3, 0, 0], [0, 0, 0]]
+    assert filled[1].T.tolist() == [[0, 0, 0], [0, 5, 0]]
+    by_subreddit = fill_grouped_data(grouped, 2, ["stocks"], first, 2, HOUR)
+    assert by_subreddit[0].T.tolist() == [[1, 0, 0], [7, 5, 0]]
+
+
+@pytest.mark.anyio
+async def test_reversed_range_is_empty(client):
+    params = {
+        "keywords": "tsla", "aggregation_type": "hourly",
+        "start_time": "2024-01-02T00:00:00", "end_time": "2024-01-01T00:00:00",
+    }
+    response = await client.get("/sentiments/sentiment_aggregation", params=params)
+    assert response.status_code == 200 and response.json() == []
+    response = await client.get("/sentiments/dashboard", params=params)
+    assert response.status_code == 200 and response.json()["timeline"] == []